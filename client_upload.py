@@ -1,12 +1,23 @@
+import argparse
+import hashlib
+import json
 import os
+import random
 import sys
+import threading
+import time
 import requests
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 
-API_URL = "http://localhost:8000"
+API_URL = os.getenv("API_URL", "http://localhost:8000")
 CHUNK_SIZE = 5 * 1024 * 1024
 SMALL_LIMIT = 50 * 1024 * 1024
+SUPPORTED_SUFFIXES = {".htm", ".html", ".pdf", ".csv", ".parquet"}
+MANIFEST_NAME = ".upload_manifest.json"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 def resolve_path(path: str) -> Path | None:
     p = Path(path).expanduser()
@@ -29,6 +40,70 @@ def resolve_path(path: str) -> Path | None:
                 return matches[0].resolve()
     return None
 
+def make_session(pool_size: int = 16) -> requests.Session:
+    """Сессия с пулом keep-alive соединений: потоки не открывают TCP-соединение на каждую часть."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def post_with_retry(session: requests.Session, url: str, retries: int = 5, backoff: float = 0.5, **kwargs):
+    """POST с повтором на сетевых ошибках, 429 и 5xx; пауза растёт экспоненциально с джиттером."""
+    kwargs.setdefault("timeout", 600)
+    for attempt in range(retries + 1):
+        try:
+            response = session.post(url, **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"{response.status_code}: {response.text[:200]}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt == retries:
+            raise error
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+def chunk_count(file_size: int, chunk_size: int = CHUNK_SIZE) -> int:
+    return max(1, -(-file_size // chunk_size))
+
+def read_chunk(path: Path, chunk_index: int, chunk_size: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(chunk_index * chunk_size)
+        return f.read(chunk_size)
+
+def upload_chunks(session: requests.Session, pool: ThreadPoolExecutor, path: Path, file_id: str,
+                  chunk_size: int = CHUNK_SIZE, api_url: str = API_URL) -> dict:
+    """
+    Chunked upload одного файла: части уходят параллельно через общий пул потоков,
+    уже принятые сервером (после обрыва) пропускаются. Возвращает ответ merge_file.
+    """
+    file_size = path.stat().st_size
+    total_chunks = chunk_count(file_size, chunk_size)
+    status = post_with_retry(session, f"{api_url}/files/init_upload", data={
+        "file_id": file_id, "total_size": file_size, "chunk_size": chunk_size, "filename": path.name,
+    }).json()
+    received = {c["chunk_index"] for c in status["received"]}
+
+    def send(chunk_index: int):
+        chunk = read_chunk(path, chunk_index, chunk_size)
+        post_with_retry(
+            session,
+            f"{api_url}/files/upload_chunk",
+            data={"file_id": file_id, "chunk_index": chunk_index, "checksum": hashlib.sha256(chunk).hexdigest()},
+            files={"chunk": (f"{path.name}.part{chunk_index}", chunk)},
+        )
+
+    futures = [pool.submit(send, i) for i in range(total_chunks) if i not in received]
+    for future in as_completed(futures):
+        future.result()
+
+    return post_with_retry(
+        session,
+        f"{api_url}/files/merge_file",
+        data={"file_id": file_id, "total_chunks": total_chunks, "filename": path.name},
+    ).json()
+
 def upload_file(path: str):
     resolved = resolve_path(path)
     if resolved is None:
@@ -37,37 +112,115 @@ def upload_file(path: str):
             f"Текущая рабочая директория: {os.getcwd()}"
         )
 
-    file_id = str(uuid.uuid4())
     file_size = resolved.stat().st_size
-    total_chunks = (file_size // CHUNK_SIZE) + 1
     filename = resolved.name
+    session = make_session()
 
     if file_size <= SMALL_LIMIT:
         with open(resolved, "rb") as f:
-            response = requests.post(
+            response = session.post(
                 f"{API_URL}/load_documents",
                 files={"files": (filename, f)},
                 timeout=600
             )
         print("Обычная загрузка:", response.json())
     else:
-        with open(resolved, "rb") as f:
-            for chunk_index in range(total_chunks):
-                chunk = f.read(CHUNK_SIZE)
-                response = requests.post(
-                    f"{API_URL}/files/upload_chunk",
-                    data={"file_id": file_id, "chunk_index": chunk_index},
-                    files={"chunk": (f"{filename}.part{chunk_index}", chunk)},
-                )
-                print(f"Uploaded chunk {chunk_index + 1}/{total_chunks}", response.status_code)
-
-        response = requests.post(
-            f"{API_URL}/files/merge_file",
-            data={"file_id": file_id, "total_chunks": total_chunks, "filename": filename},
-        )
-        print("Merge response:", response.json())
+        with ThreadPoolExecutor(4) as pool:
+            response = upload_chunks(session, pool, resolved, str(uuid.uuid4()))
+        print("Merge response:", response)
+
+
+class Manifest:
+    """
+    Журнал bulk-загрузки: путь -> размер, mtime, file_id и статус.
+    Повторный запуск пропускает загруженные файлы и докачивает начатые под тем же file_id.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: dict[str, dict] = json.loads(path.read_text()) if path.exists() else {}
+
+    def entry(self, file: Path) -> dict:
+        stat = file.stat()
+        key = str(file)
+        with self._lock:
+            entry = self.entries.get(key)
+            if not entry or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                # новый или изменившийся файл загружается заново под новым file_id
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime, "file_id": str(uuid.uuid4()), "status": "pending"}
+                self.entries[key] = entry
+            return dict(entry)
+
+    def update(self, file: Path, **fields):
+        with self._lock:
+            self.entries[str(file)].update(fields)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.entries, ensure_ascii=False, indent=1))
+            os.replace(tmp, self.path)
+
+
+def upload_directory(root: Path, workers: int = 8, file_workers: int = 4,
+                     chunk_size: int = CHUNK_SIZE, manifest_path: Path | None = None,
+                     api_url: str = API_URL) -> dict:
+    """
+    Bulk-режим: все поддерживаемые файлы каталога грузятся через chunked upload.
+    file_workers файлов обрабатываются одновременно, их части делят общий пул из workers потоков
+    и пул keep-alive соединений одной сессии.
+    """
+    files = sorted(p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in SUPPORTED_SUFFIXES)
+    manifest = Manifest(manifest_path or root / MANIFEST_NAME)
+    session = make_session(workers + file_workers)
+    summary = {"files": len(files), "uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def upload_one(path: Path, chunk_pool: ThreadPoolExecutor):
+        entry = manifest.entry(path)
+        if entry["status"] == "done":
+            with lock:
+                summary["skipped"] += 1
+            return
+        try:
+            result = upload_chunks(session, chunk_pool, path, entry["file_id"], chunk_size, api_url)
+        except Exception as e:
+            manifest.update(path, status="failed", error=str(e))
+            with lock:
+                summary["failed"] += 1
+            print(f"[FAIL] {path}: {e}")
+            return
+        manifest.update(path, status="done", job_id=result.get("job_id"), error=None)
+        with lock:
+            summary["uploaded"] += 1
+            summary["bytes"] += entry["size"]
+            done = summary["uploaded"] + summary["skipped"] + summary["failed"]
+            elapsed = time.perf_counter() - started
+            print(f"[{done}/{len(files)}] {path.name}: {entry['size'] / 2**20:.1f} MB, "
+                  f"{summary['bytes'] / 2**20 / elapsed:.1f} MB/s")
+
+    with ThreadPoolExecutor(workers) as chunk_pool, ThreadPoolExecutor(file_workers) as file_pool:
+        for future in as_completed([file_pool.submit(upload_one, p, chunk_pool) for p in files]):
+            future.result()
+
+    elapsed = time.perf_counter() - started
+    summary["seconds"] = round(elapsed, 2)
+    summary["mb_per_sec"] = round(summary["bytes"] / 2**20 / elapsed, 2) if elapsed else 0.0
+    summary["files_per_sec"] = round(summary["uploaded"] / elapsed, 2) if elapsed else 0.0
+    return summary
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        raise Exception("Укажи имя файла: python client_upload.py <filename>")
-    upload_file(sys.argv[1])
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Загрузка документов в API базы знаний")
+    parser.add_argument("path", help="файл или каталог (для каталога — bulk-режим)")
+    parser.add_argument("--workers", type=int, default=8, help="одновременных запросов с частями")
+    parser.add_argument("--file-workers", type=int, default=4, help="одновременно загружаемых файлов")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--manifest", type=Path, default=None, help=f"по умолчанию <каталог>/{MANIFEST_NAME}")
+    args = parser.parse_args()
+
+    target = Path(args.path).expanduser()
+    if target.is_dir():
+        result = upload_directory(target.resolve(), args.workers, args.file_workers, args.chunk_size, args.manifest)
+        print("Итог:", json.dumps(result, ensure_ascii=False))
+        sys.exit(1 if result["failed"] else 0)
+    upload_file(args.path)
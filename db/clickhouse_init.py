@@ -1,21 +1,55 @@
-import clickhouse_connect
+"""
+Версионированная схема ClickHouse.
 
-def init_clickhouse():
-    client = clickhouse_connect.get_client(
-        host='localhost',
-        port=8123,
-        username='default',
-        password='default_pass',
+    python -m db.clickhouse_init            # применить все миграции
+    python -m db.clickhouse_init status     # текущая версия схемы
+    python -m db.clickhouse_init bench      # латентность поиска до/после миграции v2
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from fastapi_app.config import EMBED_MODEL_NAME
+from fastapi_app.db import create_client
+
+SETTINGS = {
+    "allow_experimental_json_type": 1,
+    "allow_experimental_vector_similarity_index": 1,
+}
+
+BACKUP_TABLE = "embeddings_v1_backup"
+COPY_BUCKETS = 16
+
+
+def get_init_client():
+    # скрипт обычно запускают с хоста, поэтому по умолчанию localhost
+    return create_client(
+        host=os.getenv("CLICKHOUSE_HOST", "localhost"),
+        autogenerate_session_id=True,
+        settings=SETTINGS,
     )
 
-    try:
-        client.command("SET allow_experimental_json_type = 1")
-        print("Настройка allow_experimental_json_type установлена")
-    except Exception as e:
-        print(f"Ошибка установки настройки: {e}")
 
+def table_exists(client, name: str) -> bool:
+    return bool(client.command(f"EXISTS TABLE {name}"))
+
+
+def copy_missing_rows(client, source: str, target: str, buckets: int = 1):
+    """Докопирует строки, которых ещё нет в target, порциями по хешу id — без долгих блокировок."""
+    for bucket in range(buckets):
+        client.command(f"""
+            INSERT INTO {target} (id, text, metadata, vector)
+            SELECT id, text, metadata, vector FROM {source}
+            WHERE cityHash64(id) % {buckets} = {bucket}
+              AND id NOT IN (SELECT id FROM {target} WHERE cityHash64(id) % {buckets} = {bucket})
+        """)
+
+
+def migration_1(client):
     client.command("""
-        CREATE TABLE IF NOT EXISTS embeddings (       
+        CREATE TABLE IF NOT EXISTS embeddings (
             id UUID DEFAULT generateUUIDv4(),
             text String,
             metadata JSON,
@@ -23,7 +57,195 @@ def init_clickhouse():
         ) ENGINE=MergeTree
         ORDER BY id
     """)
-    print("Таблица embeddings создана (если её не было)")
+
+
+def migration_2(client):
+    """
+    Новая раскладка: партиции по формату, сортировка по (format, source_file) для локальности,
+    типизированные MATERIALIZED-колонки из metadata и HNSW-индекс vector_similarity.
+    Переезд онлайн: копия порциями, EXCHANGE TABLES, докопирование того, что успело прийти в старую таблицу.
+    """
+    client.command("DROP TABLE IF EXISTS embeddings_v2")
+    client.command("""
+        CREATE TABLE embeddings_v2 (
+            id UUID DEFAULT generateUUIDv4(),
+            text String,
+            metadata JSON,
+            vector Array(Float32),
+            source_file LowCardinality(String) MATERIALIZED ifNull(metadata.source_file.:String, ''),
+            format LowCardinality(String) MATERIALIZED ifNull(metadata.format.:String, ''),
+            chunk_index UInt32 MATERIALIZED toUInt32(ifNull(metadata.chunk_index.:Int64, 0)),
+            INDEX vector_idx vector TYPE vector_similarity('hnsw', 'cosineDistance') GRANULARITY 100000000
+        ) ENGINE=MergeTree
+        PARTITION BY format
+        ORDER BY (format, source_file, id)
+    """)
+
+    copy_missing_rows(client, "embeddings", "embeddings_v2", COPY_BUCKETS)
+    client.command("EXCHANGE TABLES embeddings AND embeddings_v2")
+    # после обмена старая таблица называется embeddings_v2; забираем вставки, пришедшие во время копирования
+    copy_missing_rows(client, "embeddings_v2", "embeddings")
+    client.command(f"DROP TABLE IF EXISTS {BACKUP_TABLE}")
+    client.command(f"RENAME TABLE embeddings_v2 TO {BACKUP_TABLE}")
+
+
+VECTOR_I8_EXPR = (
+    "arrayMap((x, m) -> toInt8(round(x / m * 127)), vector, "
+    "arrayWithConstant(length(vector), greatest(arrayMax(arrayMap(y -> abs(y), vector)), 1e-12)))"
+)
+VECTOR_BIN_EXPR = (
+    "arrayMap(w -> arraySum(arrayMap(j -> bitShiftLeft(toUInt64(vector[w * 64 + j + 1] > 0), 63 - j), range(64))), "
+    "range(intDiv(length(vector) + 63, 64)))"
+)
+
+
+def migration_3(client):
+    """
+    Квантованные копии вектора для двухэтапного поиска: int8 (масштаб на вектор) и знаковые биты в UInt64.
+    Новые строки пишутся с готовыми значениями из embeddings.quantization, старые досчитываются мутацией по DEFAULT.
+    """
+    client.command(f"""
+        ALTER TABLE embeddings
+            ADD COLUMN IF NOT EXISTS vector_i8 Array(Int8) DEFAULT {VECTOR_I8_EXPR},
+            ADD COLUMN IF NOT EXISTS vector_bin Array(UInt64) DEFAULT {VECTOR_BIN_EXPR}
+    """)
+    client.command("ALTER TABLE embeddings MATERIALIZE COLUMN vector_i8")
+    client.command("ALTER TABLE embeddings MATERIALIZE COLUMN vector_bin")
+
+
+def migration_4(client):
+    """
+    content_hash = sha256(модель \\0 текст) для дедупликации при повторной загрузке (см. embeddings.content_cache).
+    Существующие строки считаются под текущей EMBED_MODEL_NAME; bloom-индекс ускоряет проверку IN по списку хэшей.
+    """
+    client.command("""
+        ALTER TABLE embeddings
+            ADD COLUMN IF NOT EXISTS content_hash String DEFAULT '',
+            ADD INDEX IF NOT EXISTS content_hash_idx content_hash TYPE bloom_filter(0.01) GRANULARITY 1
+    """)
+    client.command(
+        "ALTER TABLE embeddings UPDATE content_hash = lower(hex(SHA256(concat({model:String}, '\\0', text)))) "
+        "WHERE content_hash = ''",
+        parameters={"model": EMBED_MODEL_NAME},
+    )
+    client.command("ALTER TABLE embeddings MATERIALIZE INDEX content_hash_idx")
+
+
+def migration_5(client):
+    """
+    Skip-индекс по source_file для фильтрованного поиска: format отсекается партициями и первым ключом
+    сортировки, а фильтр только по source_file без формата иначе читал бы все гранулы.
+    """
+    client.command("""
+        ALTER TABLE embeddings
+            ADD INDEX IF NOT EXISTS source_file_idx source_file TYPE bloom_filter(0.01) GRANULARITY 1
+    """)
+    client.command("ALTER TABLE embeddings MATERIALIZE INDEX source_file_idx")
+
+
+def migration_6(client):
+    """
+    Токенный bloom-индекс по lowerUTF8(text) для гибридного поиска: hasToken(lowerUTF8(text), ...) читает только
+    гранулы, где могут быть токены запроса. 32 КБ фильтра на гранулу, 3 хэша.
+    """
+    client.command("""
+        ALTER TABLE embeddings
+            ADD INDEX IF NOT EXISTS text_tokens_idx lowerUTF8(text) TYPE tokenbf_v1(32768, 3, 0) GRANULARITY 1
+    """)
+    client.command("ALTER TABLE embeddings MATERIALIZE INDEX text_tokens_idx")
+
+
+MIGRATIONS = [
+    (1, "base embeddings table", migration_1),
+    (2, "partitioned layout, materialized metadata columns, vector similarity index", migration_2),
+    (3, "int8 and binary quantized vector columns", migration_3),
+    (4, "content hash column for idempotent re-ingestion", migration_4),
+    (5, "source_file skip index for metadata-filtered search", migration_5),
+    (6, "token bloom filter index on text for hybrid search", migration_6),
+]
+
+
+def ensure_migrations_table(client):
+    client.command("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version UInt32,
+            description String,
+            applied_at DateTime DEFAULT now()
+        ) ENGINE=MergeTree
+        ORDER BY version
+    """)
+
+
+def current_version(client) -> int:
+    ensure_migrations_table(client)
+    version = client.command("SELECT max(version) FROM schema_migrations")
+    if not version and table_exists(client, "embeddings"):
+        # база создана старым init_clickhouse без журнала миграций
+        client.insert("schema_migrations", [(1, MIGRATIONS[0][1])], column_names=["version", "description"])
+        return 1
+    return int(version or 0)
+
+
+def migrate(client, target: int | None = None):
+    version = current_version(client)
+    for number, description, apply in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        print(f"Применяется миграция {number}: {description}")
+        start = time.perf_counter()
+        apply(client)
+        client.insert("schema_migrations", [(number, description)], column_names=["version", "description"])
+        print(f"Миграция {number} применена за {time.perf_counter() - start:.1f} с")
+    print(f"Версия схемы: {current_version(client)}")
+
+
+def init_clickhouse():
+    migrate(get_init_client())
+
+
+def bench_search(client, table: str, queries: np.ndarray, top_k: int = 5) -> dict:
+    latencies, read_rows = [], []
+    for q in queries:
+        start = time.perf_counter()
+        result = client.query(
+            f"""
+            SELECT id, cosineDistance(vector, {{q:Array(Float32)}}) AS distance
+            FROM {table}
+            ORDER BY distance ASC
+            LIMIT {{k:UInt32}}
+            """,
+            parameters={"q": q.tolist(), "k": top_k},
+        )
+        latencies.append(time.perf_counter() - start)
+        read_rows.append(int(result.summary.get("read_rows", 0)))
+    return {
+        "table": table,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        "avg_read_rows": int(np.mean(read_rows)),
+    }
+
+
+def bench(client, n_queries: int = 50, top_k: int = 5):
+    if not table_exists(client, BACKUP_TABLE):
+        raise SystemExit(f"Нет таблицы {BACKUP_TABLE}: сравнение возможно только после миграции 2")
+    result = client.query(f"SELECT vector FROM embeddings ORDER BY rand() LIMIT {int(n_queries)}")
+    queries = np.asarray([row[0] for row in result.result_rows], dtype=np.float32)
+    for table in (BACKUP_TABLE, "embeddings"):
+        print(bench_search(client, table, queries, top_k))
+
 
 if __name__ == '__main__':
-    init_clickhouse()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Миграции схемы ClickHouse")
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "status", "bench"])
+    parser.add_argument("--target", type=int, default=None, help="остановиться на этой версии")
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    ch = get_init_client()
+    if args.command == "status":
+        print(f"Версия схемы: {current_version(ch)}")
+    elif args.command == "bench":
+        bench(ch, args.queries)
+    else:
+        migrate(ch, args.target)
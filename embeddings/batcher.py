@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from embeddings.embeddings import EmbeddingsModel
+from embeddings.service import EmbedBatch, embed_new, insert_batch
+from fastapi_app import config
+from fastapi_app.metrics.metrics import EMBED_BATCH_SIZE, EMBED_QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    texts: list[str]
+    meta: dict
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class EmbeddingBatcher:
+    """
+    Динамический micro-batching для /api/embed.
+    Конкурентные запросы собираются в общий батч (до max_batch_size текстов или max_wait_ms ожидания),
+    модель считает его в отдельном потоке, вставка батча в ClickHouse идёт параллельно со следующим проходом модели.
+    """
+
+    def __init__(self, model: EmbeddingsModel, client,
+                 max_batch_size: int = config.EMBED_MAX_BATCH,
+                 max_wait_ms: float = config.EMBED_MAX_WAIT_MS):
+        self.model = model
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inserts: set[asyncio.Task] = set()
+        self._insert_slots: Optional[asyncio.Semaphore] = None
+        # один поток на модель: проходы не конкурируют друг с другом за ядра
+        self._model_executor = ThreadPoolExecutor(1, thread_name_prefix="embed-model")
+        self._insert_executor = ThreadPoolExecutor(2, thread_name_prefix="embed-insert")
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._insert_slots = asyncio.Semaphore(2)
+            self._task = asyncio.create_task(self._loop())
+
+    async def submit(self, texts: list[str], meta: dict) -> int:
+        if not texts:
+            return 0
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(texts, meta, future))
+        return await future
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._model_executor.shutdown(wait=False)
+        self._insert_executor.shutdown(wait=False)
+
+    async def _collect(self) -> list[_Request]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            now = time.perf_counter()
+            for request in batch:
+                EMBED_QUEUE_WAIT_SECONDS.observe(now - request.enqueued)
+
+            texts = [t for r in batch for t in r.texts]
+            metas = [r.meta for r in batch for _ in r.texts]
+            EMBED_BATCH_SIZE.observe(len(texts))
+            try:
+                embedded = await loop.run_in_executor(
+                    self._model_executor, embed_new, self.client, self.model, texts, metas
+                )
+            except Exception as e:
+                logger.error(f"[EMBED] Ошибка модели на батче из {len(texts)} текстов: {e}", exc_info=True)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            # вставка не блокирует сбор и расчёт следующего батча; не больше двух вставок в полёте
+            await self._insert_slots.acquire()
+            task = asyncio.create_task(self._insert(batch, embedded))
+            self._inserts.add(task)
+            task.add_done_callback(self._insert_done)
+
+    def _insert_done(self, task: asyncio.Task):
+        self._inserts.discard(task)
+        self._insert_slots.release()
+
+    async def _insert(self, batch: list[_Request], embedded: EmbedBatch):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._insert_executor, insert_batch, self.client, embedded)
+        except Exception as e:
+            logger.error(f"[EMBED] Ошибка вставки батча: {e}", exc_info=True)
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        # дубликаты не вставляются: каждому запросу — число его новых текстов
+        kept = set(embedded.kept)
+        offset = 0
+        for request in batch:
+            inserted = sum(1 for i in range(offset, offset + len(request.texts)) if i in kept)
+            offset += len(request.texts)
+            if not request.future.done():
+                request.future.set_result(inserted)
@@ -0,0 +1,70 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from fastapi_app import config
+
+
+def content_hash(text: str, model_name: str) -> str:
+    """Идентичность чанка: один и тот же текст под другой моделью — другой эмбеддинг."""
+    return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Персистентный кэш content_hash -> вектор в SQLite; известные чанки не проходят через модель повторно."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=10)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                    hash TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL
+                )
+            """)
+            self._conn.commit()
+
+    def get_many(self, hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            # SQLite ограничивает число параметров в запросе
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM chunk_embeddings WHERE hash IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                found.update((h, np.frombuffer(blob, dtype=np.float32).tolist()) for h, blob in rows)
+        return found
+
+    def put_many(self, hashes: list[str], vectors: list[list[float]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunk_embeddings (hash, vector) VALUES (?, ?)",
+                [(h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in zip(hashes, vectors)],
+            )
+            self._conn.commit()
+
+    def encode(self, model, texts: list[str], hashes: list[str]) -> tuple[list[list[float]], int, float]:
+        """Возвращает (векторы, попадания в кэш, секунды модели)."""
+        cached = self.get_many(hashes)
+        missing = [i for i, h in enumerate(hashes) if h not in cached]
+        model_seconds = 0.0
+        if missing:
+            start = time.perf_counter()
+            fresh = model.encode([texts[i] for i in missing])
+            model_seconds = time.perf_counter() - start
+            self.put_many([hashes[i] for i in missing], fresh)
+            for i, vector in zip(missing, fresh):
+                cached[hashes[i]] = vector
+        return [cached[h] for h in hashes], len(hashes) - len(missing), model_seconds
+
+
+embedding_cache: Optional[EmbeddingCache] = EmbeddingCache(config.EMBED_CACHE_PATH) if config.EMBED_CACHE_ENABLED else None
@@ -1,8 +1,12 @@
-from sentence_transformers import SentenceTransformer
+from typing import Optional
+
+from embeddings.registry import registry
+from fastapi_app.config import EMBED_MODEL_NAME
 
 class EmbeddingsModel:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name: str = EMBED_MODEL_NAME, device: Optional[str] = None):
+        self.model_name = model_name
+        self.model = registry.get(model_name, device)
 
     def encode(self, texts: list[str]) -> list[list[float]]:
-        return self.model.encode(texts, batch_size=128, show_progress_bar=True ,convert_to_numpy=True).tolist()
\ No newline at end of file
+        return self.model.encode(texts, batch_size=128, show_progress_bar=True ,convert_to_numpy=True).tolist()
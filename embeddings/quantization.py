@@ -0,0 +1,27 @@
+import numpy as np
+
+INT8_SCALE = 127
+
+
+def quantize_int8(vectors) -> np.ndarray:
+    """
+    Скалярное квантование с масштабом на вектор: max|x| -> 127.
+    Косинус инвариантен к масштабу, поэтому сравнивать такие векторы можно через cosineDistance.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scale = INT8_SCALE / np.maximum(np.abs(vectors).max(axis=1, keepdims=True), 1e-12)
+    return np.clip(np.rint(vectors * scale), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+
+def quantize_binary(vectors) -> np.ndarray:
+    """
+    Знаковые биты, упакованные в слова UInt64: элемент i*64 + j — бит (63 - j) слова i.
+    Та же раскладка, что у DEFAULT-выражения колонки vector_bin в db/clickhouse_init.py.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    n, dim = vectors.shape
+    words = (dim + 63) // 64
+    bits = np.zeros((n, words * 64), dtype=np.uint64)
+    bits[:, :dim] = vectors > 0
+    weights = np.left_shift(np.uint64(1), np.arange(63, -1, -1, dtype=np.uint64))
+    return (bits.reshape(n, words, 64) * weights).sum(axis=2, dtype=np.uint64)
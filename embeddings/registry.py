@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi_app.config import MODEL_REGISTRY_SIZE
+from fastapi_app.metrics.metrics import MODEL_LOAD_SECONDS, MODEL_REGISTRY_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+def default_device() -> str:
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+class ModelRegistry:
+    """
+    Процессный реестр моделей эмбеддингов.
+    Модель загружается один раз на пару (имя, устройство) и хранится в LRU ограниченного размера.
+    """
+
+    def __init__(self, max_size: int = MODEL_REGISTRY_SIZE):
+        self.max_size = max(1, max_size)
+        self._models: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_name: str, device: Optional[str] = None):
+        device = device or default_device()
+        key = (model_name, device)
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                MODEL_REGISTRY_TOTAL.labels(result='hit').inc()
+                return model
+
+            MODEL_REGISTRY_TOTAL.labels(result='miss').inc()
+            # загрузка под локом: параллельные запросы ждут одну загрузку, а не грузят модель N раз
+            model = self._load(model_name, device)
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                evicted, _ = self._models.popitem(last=False)
+                logger.info("[REGISTRY] Модель %s вытеснена из реестра", evicted)
+            return model
+
+    def _load(self, model_name: str, device: str):
+        from sentence_transformers import SentenceTransformer
+
+        start = time.perf_counter()
+        model = SentenceTransformer(model_name, device=device)
+        model.eval()
+        elapsed = time.perf_counter() - start
+
+        MODEL_LOAD_SECONDS.labels(model=model_name).observe(elapsed)
+        logger.info("[REGISTRY] Модель %s загружена на %s за %.2f с", model_name, device, elapsed)
+        return model
+
+    def warmup(self, model_names: list[str], device: Optional[str] = None):
+        for name in model_names:
+            self.get(name, device)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+registry = ModelRegistry()
@@ -1,18 +1,178 @@
-import clickhouse_connect
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from embeddings.content_cache import content_hash, embedding_cache
 from embeddings.embeddings import EmbeddingsModel
+from embeddings.quantization import quantize_binary, quantize_int8
+from fastapi_app import config
+from fastapi_app.db import get_client
+
+logger = logging.getLogger(__name__)
+
+_insert_listeners = []
+
+EMBEDDING_COLUMNS = ["id", "text", "metadata", "vector", "vector_i8", "vector_bin", "content_hash"]
+
+
+@dataclass
+class LoadStats:
+    """Сколько работы сэкономили дедупликация и кэш эмбеддингов за загрузку."""
+    chunks: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    cache_hits: int = 0
+    model_seconds: float = 0.0
+    encoded: int = 0
+    skipped_bytes: int = 0
+    dim: int = 0
+
+    def merge(self, other: "LoadStats") -> "LoadStats":
+        for name in ("chunks", "inserted", "duplicates", "cache_hits", "model_seconds", "encoded", "skipped_bytes"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.dim = self.dim or other.dim
+        return self
+
+    def to_dict(self) -> dict:
+        per_text = self.model_seconds / self.encoded if self.encoded else 0.0
+        dim = self.dim or 384
+        # Float32 + Int8 + биты на вектор, плюс текст
+        row_vector_bytes = dim * 4 + dim + (dim + 63) // 64 * 8
+        return {
+            "chunks": self.chunks,
+            "inserted": self.inserted,
+            "duplicates_skipped": self.duplicates,
+            "cache_hits": self.cache_hits,
+            "model_seconds": round(self.model_seconds, 3),
+            "model_seconds_saved": round(per_text * (self.duplicates + self.cache_hits), 3),
+            "storage_bytes_saved": self.skipped_bytes + self.duplicates * row_vector_bytes,
+        }
+
+
+@dataclass
+class EmbedBatch:
+    ids: list[str] = field(default_factory=list)
+    texts: list[str] = field(default_factory=list)
+    metas: list[dict] = field(default_factory=list)
+    hashes: list[str] = field(default_factory=list)
+    vectors: list[list[float]] = field(default_factory=list)
+    kept: list[int] = field(default_factory=list) # индексы входных текстов, попавших в батч
+    stats: LoadStats = field(default_factory=LoadStats)
 
 def get_clickhouse_client():
-    return clickhouse_connect.get_client(
-        host='clickhouse',
-        port=8123,
-        username='default',
-        password='default_pass'
+    return get_client()
+
+def add_insert_listener(listener):
+    """listener(ids: list[str], vectors: list[list[float]]) вызывается после каждой успешной вставки."""
+    _insert_listeners.append(listener)
+
+def notify_inserted(ids: list[str], vectors: list[list[float]]):
+    for listener in _insert_listeners:
+        try:
+            listener(ids, vectors)
+        except Exception as e:
+            logger.error(f"[EMBED] Ошибка обработчика вставки {listener}: {e}", exc_info=True)
+
+def has_insert_listeners() -> bool:
+    return bool(_insert_listeners)
+
+def notify_ids_inserted(client, ids: list[str], batch_size: int = 10000):
+    """
+    Вставки из другого процесса (пул ETL) не видны обработчикам этого процесса:
+    перечитываем векторы вставленных строк по id из ClickHouse и уведомляем о них.
+    """
+    if not _insert_listeners:
+        return
+    for start in range(0, len(ids), batch_size):
+        result = client.query(
+            "SELECT toString(id), vector FROM embeddings WHERE id IN {ids:Array(UUID)}",
+            parameters={"ids": ids[start:start + batch_size]},
+        )
+        rows = result.result_rows
+        if rows:
+            notify_inserted([r[0] for r in rows], [r[1] for r in rows])
+
+def delete_sources(client, sources: list[str]):
+    """Удаляет строки исходных файлов (lightweight DELETE: строки сразу перестают быть видны запросам)."""
+    if sources:
+        client.command(
+            "DELETE FROM embeddings WHERE source_file IN {sources:Array(String)}",
+            parameters={"sources": sources},
+        )
+
+def existing_hashes(client, hashes: list[str], sources: list[str]) -> set[tuple[str, str]]:
+    """Пары (source_file, content_hash), уже загруженные для этих файлов."""
+    if not hashes:
+        return set()
+    result = client.query(
+        "SELECT DISTINCT source_file, content_hash FROM embeddings "
+        "WHERE content_hash IN {hashes:Array(String)} AND source_file IN {sources:Array(String)}",
+        parameters={"hashes": hashes, "sources": sources},
     )
+    return {(row[0], row[1]) for row in result.result_rows}
+
+def embed_new(client, model: EmbeddingsModel, texts: list[str], metas: list[dict]) -> EmbedBatch:
+    """
+    Эмбеддинги только для новых чанков: повторы внутри батча и уже загруженные content_hash пропускаются,
+    известные тексты берутся из локального кэша вместо прохода модели.
+
+    Повтором считается тот же content_hash в том же source_file: каждый документ владеет своими строками,
+    и delete_sources при замене или удалении одного документа не забирает общий чанк у другого.
+    source_file стабилен между загрузками (etl.run_etl.source_id), так что повторный ingest того же документа
+    ничего не вставляет.
+    Вектор общего чанка при этом берётся из кэша эмбеддингов (EMBED_CACHE_ENABLED), модель его не пересчитывает.
+    """
+    batch = EmbedBatch(stats=LoadStats(chunks=len(texts)))
+    hashes = [content_hash(t, model.model_name) for t in texts]
+    keys = [(str(m.get("source_file") or ""), h) for m, h in zip(metas, hashes)]
+    known = set()
+    if config.DEDUP_ENABLED:
+        known = existing_hashes(client, list(set(hashes)), list({source for source, _ in keys}))
+
+    seen = set()
+    for i, (h, key) in enumerate(zip(hashes, keys)):
+        if config.DEDUP_ENABLED and (key in known or key in seen):
+            batch.stats.duplicates += 1
+            batch.stats.skipped_bytes += len(texts[i].encode("utf-8"))
+            continue
+        seen.add(key)
+        batch.kept.append(i)
+        batch.texts.append(texts[i])
+        batch.metas.append(metas[i])
+        batch.hashes.append(h)
+
+    if batch.texts:
+        if embedding_cache is not None:
+            batch.vectors, hits, seconds = embedding_cache.encode(model, batch.texts, batch.hashes)
+        else:
+            start = time.perf_counter()
+            batch.vectors, hits = model.encode(batch.texts), 0
+            seconds = time.perf_counter() - start
+        batch.stats.cache_hits = hits
+        batch.stats.encoded = len(batch.texts) - hits
+        batch.stats.model_seconds = seconds
+        batch.stats.dim = len(batch.vectors[0])
+
+    batch.ids = [str(uuid.uuid4()) for _ in batch.texts]
+    batch.stats.inserted = len(batch.texts)
+    return batch
+
+def make_rows(batch: EmbedBatch) -> list[tuple]:
+    """Строки для EMBEDDING_COLUMNS: квантованные копии считаются здесь же, одним проходом по батчу."""
+    if not batch.vectors:
+        return []
+    vectors_i8 = quantize_int8(batch.vectors).tolist()
+    vectors_bin = quantize_binary(batch.vectors).tolist()
+    return list(zip(batch.ids, batch.texts, batch.metas, batch.vectors, vectors_i8, vectors_bin, batch.hashes))
 
-def store_embeddings(client, model: EmbeddingsModel, texts: list[str], meta: dict):
-    vectors = model.encode(texts)
-    rows = [
-        (ch, meta, vec) for ch, vec in zip(texts, vectors)
-    ]
+def insert_batch(client, batch: EmbedBatch):
+    if not batch.ids:
+        return
+    client.insert("embeddings", make_rows(batch), column_names=EMBEDDING_COLUMNS)
+    notify_inserted(batch.ids, batch.vectors)
 
-    client.insert("embeddings", rows, column_names=["text", "metadata", "vector"])
\ No newline at end of file
+def store_embeddings(client, model: EmbeddingsModel, texts: list[str], meta: dict) -> LoadStats:
+    batch = embed_new(client, model, texts, [meta] * len(texts))
+    insert_batch(client, batch)
+    return batch.stats
@@ -0,0 +1,69 @@
+"""
+Микробенчмарк чанкинга: прежняя реализация на конкатенации строк против текущей.
+
+    python -m etl.bench_chunking --records 200000 --record-len 80
+    python -m etl.bench_chunking --tokens
+"""
+import argparse
+import random
+import string
+import time
+
+from etl.chunking import CHUNK_SIZE, OVERLAP, chunk_text, records_to_chunks, record_to_str
+
+
+def legacy_records_to_chunks(records):
+    buffer = ""
+    for rec in records:
+        buffer += record_to_str(rec)
+
+        while len(buffer) >= CHUNK_SIZE:
+            yield buffer[:CHUNK_SIZE]
+            buffer = buffer[CHUNK_SIZE - OVERLAP:]
+    if buffer.strip():
+        yield buffer
+
+
+def make_records(n: int, record_len: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + "     "
+    return [
+        {"id": i, "value": "".join(rng.choice(alphabet) for _ in range(record_len))}
+        for i in range(n)
+    ]
+
+
+def timed(fn, *args) -> tuple[float, list]:
+    start = time.perf_counter()
+    out = list(fn(*args))
+    return time.perf_counter() - start, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк чанкинга")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--record-len", type=int, default=80)
+    parser.add_argument("--tokens", action="store_true", help="замерить также режим tokens")
+    args = parser.parse_args()
+
+    records = make_records(args.records, args.record_len)
+    # одна большая запись — худший случай для buffer += ...
+    huge = [{"blob": "".join(r["value"] for r in records)}]
+
+    for name, data in (("many small records", records), ("one huge record", huge)):
+        legacy_time, legacy = timed(legacy_records_to_chunks, data)
+        new_time, new = timed(records_to_chunks, data, "chars")
+        assert legacy == new, "вывод records_to_chunks разошёлся с прежней реализацией"
+        print(f"{name}: chunks={len(new)} legacy={legacy_time:.3f}s new={new_time:.3f}s "
+              f"speedup={legacy_time / max(new_time, 1e-9):.1f}x")
+
+    if args.tokens:
+        text = huge[0]["blob"]
+        chars_time, chars = timed(chunk_text, text, "chars")
+        tokens_time, tokens = timed(chunk_text, text, "tokens")
+        print(f"chunk_text: chars={chars_time:.3f}s ({len(chars)} chunks) "
+              f"tokens={tokens_time:.3f}s ({len(tokens)} chunks)")
+
+
+if __name__ == "__main__":
+    main()
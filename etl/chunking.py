@@ -1,46 +1,207 @@
 import json
+from bisect import bisect_right
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
 from etl.preprocess import clean_text
+from fastapi_app.config import CHUNK_MODE, CHUNK_TOKENIZER, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
 #import aiofiles
 
 CHUNK_SIZE = 3000
 OVERLAP = 300
 
-def chunk_text(text: str) -> list[str]:
+# сколько символов набирать перед токенизацией в режиме tokens
+TOKEN_WINDOW_CHARS = 64 * CHUNK_SIZE
+# запас токенов до конца окна: последнее слово окна может быть разрезано и токенизируется заново со следующим окном
+TOKEN_TAIL_RESERVE = 16
+
+def iter_text_chunks(text: str) -> Iterator[str]:
     text = text.strip()
-    chunks, start = [], 0
+    start = 0
 
     while start < len(text):
         end = start + CHUNK_SIZE
-        chunks.append(text[start:end])
+        yield text[start:end]
         if end >= len(text): break
         start = end - OVERLAP
-    return chunks
 
-def records_to_chunks(records):
-    buffer = ""
+def iter_text_chunk_spans(pieces: Iterable[str]) -> Iterator[tuple[str, int, int]]:
+    """
+    Те же окна, что iter_text_chunks по склейке pieces, но без сборки всего текста в памяти.
+    Вместе с чанком отдаются его глобальные смещения [start, end) в склеенном тексте.
+    """
+    step = CHUNK_SIZE - OVERLAP
+    parts, pending, base, emitted_end = [], 0, 0, 0
+    for piece in pieces:
+        parts.append(piece)
+        pending += len(piece)
+
+        if pending >= CHUNK_SIZE:
+            buffer = "".join(parts)
+            start = 0
+            while len(buffer) - start >= CHUNK_SIZE:
+                yield buffer[start:start + CHUNK_SIZE], base + start, base + start + CHUNK_SIZE
+                emitted_end = base + start + CHUNK_SIZE
+                start += step
+            tail = buffer[start:]
+            parts, pending, base = [tail], len(tail), base + start
+
+    buffer = "".join(parts)
+    if base + len(buffer) > emitted_end and buffer.strip():
+        yield buffer, base, base + len(buffer)
+
+def chunk_text(text: str, mode: str = CHUNK_MODE) -> list[str]:
+    if mode == "tokens":
+        return list(iter_token_chunks([text.strip()]))
+    return list(iter_text_chunks(text))
+
+def record_to_str(rec: dict) -> str:
+    rec_str = "; ".join(f"{k}: {v}" for k, v in rec.items())
+    return clean_text(rec_str) + "\n"
+
+def records_to_chunks(records, mode: str = CHUNK_MODE):
+    """
+    Скользящее окно CHUNK_SIZE с перекрытием OVERLAP по склеенным записям.
+    Записи копятся списком и склеиваются один раз на окно, поэтому каждый символ копируется O(1) раз.
+    """
+    if mode == "tokens":
+        yield from iter_token_chunks(record_to_str(rec) for rec in records)
+        return
+
+    step = CHUNK_SIZE - OVERLAP
+    parts, pending = [], 0
     for rec in records:
-        rec_str = "; ".join(f"{k}: {v}" for k, v in rec.items())
-        rec_str = clean_text(rec_str) + "\n"
+        rec_str = record_to_str(rec)
+        parts.append(rec_str)
+        pending += len(rec_str)
 
-        buffer += rec_str
+        if pending >= CHUNK_SIZE:
+            buffer = "".join(parts)
+            start = 0
+            while len(buffer) - start >= CHUNK_SIZE:
+                yield buffer[start:start + CHUNK_SIZE]
+                start += step
+            tail = buffer[start:]
+            parts, pending = [tail], len(tail)
 
-        while len(buffer) >= CHUNK_SIZE:
-            yield buffer[:CHUNK_SIZE]
-            buffer = buffer[CHUNK_SIZE - OVERLAP:]
+    buffer = "".join(parts)
     if buffer.strip():
         yield buffer
 
-def save_chunks(chunks: list[str], out_path: Path, meta: dict):
+@lru_cache(maxsize=4)
+def get_token_encoder(name: str = CHUNK_TOKENIZER) -> Callable[[str], list[tuple[int, int]]]:
+    """Функция text -> [(start, end)] символьных границ токенов: tiktoken:<encoding> или HF-токенайзер."""
+    if name.startswith("tiktoken"):
+        import tiktoken
+        encoding = tiktoken.get_encoding(name.partition(":")[2] or "cl100k_base")
+
+        def encode(text: str) -> list[tuple[int, int]]:
+            tokens = encoding.encode(text, disallowed_special=())
+            _, starts = encoding.decode_with_offsets(tokens)
+            return list(zip(starts, starts[1:] + [len(text)]))
+        return encode
+
+    from tokenizers import Tokenizer
+    tokenizer = Tokenizer.from_pretrained(name)
+
+    def encode(text: str) -> list[tuple[int, int]]:
+        return tokenizer.encode(text, add_special_tokens=False).offsets
+    return encode
+
+def _emit_token_chunks(text: str, spans: list[tuple[int, int]], max_tokens: int, overlap: int, final: bool):
+    """Символьные границы окон и смещение, с которого начинается не разрезанный ещё хвост."""
+    windows, start = [], 0
+    step = max(1, max_tokens - overlap)
+    limit = len(spans) if final else len(spans) - TOKEN_TAIL_RESERVE
+
+    while start < len(spans) and (final or start + max_tokens <= limit):
+        end = min(start + max_tokens, len(spans))
+        windows.append((spans[start][0], spans[end - 1][1]))
+        if end == len(spans):
+            return windows, len(text)
+        start += step
+
+    tail_start = spans[start][0] if start < len(spans) else len(text)
+    return windows, tail_start
+
+def iter_token_chunk_spans(pieces: Iterable[str], max_tokens: int = CHUNK_MAX_TOKENS,
+                           overlap: int = CHUNK_OVERLAP_TOKENS,
+                           tokenizer: str = CHUNK_TOKENIZER) -> Iterator[tuple[str, int, int]]:
+    """iter_token_chunks вместе с глобальными смещениями [start, end) чанка в склейке pieces."""
+    encode = get_token_encoder(tokenizer)
+    parts, pending, base = [], 0, 0
+
+    for piece in pieces:
+        parts.append(piece)
+        pending += len(piece)
+        if pending >= TOKEN_WINDOW_CHARS:
+            text = "".join(parts)
+            windows, tail_start = _emit_token_chunks(text, encode(text), max_tokens, overlap, final=False)
+            for start, end in windows:
+                yield text[start:end], base + start, base + end
+            parts, pending, base = [text[tail_start:]], len(text) - tail_start, base + tail_start
+
+    text = "".join(parts)
+    if text.strip():
+        windows, _ = _emit_token_chunks(text, encode(text), max_tokens, overlap, final=True)
+        for start, end in windows:
+            yield text[start:end], base + start, base + end
+
+def iter_token_chunks(pieces: Iterable[str], max_tokens: int = CHUNK_MAX_TOKENS,
+                      overlap: int = CHUNK_OVERLAP_TOKENS, tokenizer: str = CHUNK_TOKENIZER) -> Iterator[str]:
+    """
+    Чанки не длиннее max_tokens токенов модели, с перекрытием overlap токенов.
+    Текст режется по символьным границам токенов, так что чанк — точный срез исходного текста и ничего не обрезается моделью.
+    Токенизация идёт окнами по TOKEN_WINDOW_CHARS: хвост окна переносится в следующее.
+    """
+    for chunk, _, _ in iter_token_chunk_spans(pieces, max_tokens, overlap, tokenizer):
+        yield chunk
+
+def iter_page_chunks(pages: Iterable[tuple[int, str]], mode: str = CHUNK_MODE) -> Iterator[tuple[str, dict]]:
+    """
+    Чанкинг потока страниц (номер, текст) в порядке следования.
+    Результат совпадает с chunk_text(clean_text(весь текст)), но к чанку добавляются page_start/page_end.
+    """
+    starts, numbers = [], []
+
+    def pieces():
+        offset = 0
+        for page_no, raw in pages:
+            text = clean_text(raw)
+            if not text:
+                continue
+            if offset:
+                # clean_text схлопнул бы перевод строки между страницами в один пробел
+                text = " " + text
+            starts.append(offset + (1 if offset else 0))
+            numbers.append(page_no)
+            offset += len(text)
+            yield text
+
+    spans = iter_token_chunk_spans(pieces()) if mode == "tokens" else iter_text_chunk_spans(pieces())
+    for chunk, start, end in spans:
+        page_start = numbers[max(0, bisect_right(starts, start) - 1)]
+        page_end = numbers[max(0, bisect_right(starts, end - 1) - 1)]
+        yield chunk, {"page_start": page_start, "page_end": page_end}
+
+def save_chunks(chunks: Iterable[Union[str, tuple[str, dict]]], out_path: Path, meta: dict) -> int:
+    """
+    Пишет чанки в JSONL по мере поступления; chunks может быть генератором.
+    Элемент — текст или (текст, доп. метаданные чанка), например номера страниц PDF.
+    """
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
     with out_path.open("w", encoding="utf-8") as f:
         for i, ch in enumerate(chunks):
-            rec = {**meta, "chunk_index": i, "text": ch}
+            text, extra = ch if isinstance(ch, tuple) else (ch, {})
+            rec = {**meta, **extra, "chunk_index": i, "text": text}
             f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            count += 1
+    return count
 
 '''async def save_chunks_async(chunks: list[str], out_path: Path, meta: dict):
     out_path.parent.mkdir(parents=True, exist_ok=True)
     async with aiofiles.open(out_path, "w", encoding="utf-8") as f:
         for i, ch in enumerate(chunks):
             rec = {**meta, "chunk_index": i, "text": ch}
-            await f.write(json.dumps(rec, ensure_ascii=False) + "\n")'''
\ No newline at end of file
+            await f.write(json.dumps(rec, ensure_ascii=False) + "\n")'''
@@ -1,12 +1,15 @@
 from pathlib import Path
+from typing import Iterator
 import pandas as pd
+import pyarrow.parquet as pq
 from bs4 import BeautifulSoup
-import fitz, pdfplumber
 import trafilatura
 
 import csv
 from io import StringIO
 
+from etl.pdf_extract import iter_pdf_pages
+
 def extract_csv(path: Path) -> list[dict]:
     df = pd.read_csv(path)
     return df.to_dict(orient="records")
@@ -15,6 +18,11 @@ def extract_csv_content(content) -> list[dict]:
     reader = csv.DictReader(StringIO(content))
     return list(reader)
 
+def iter_csv(path: Path) -> Iterator[dict]:
+    """Построчное чтение CSV: в памяти только текущая запись."""
+    with path.open("r", encoding="utf-8", newline="") as f:
+        yield from csv.DictReader(f)
+
 def extract_html(path: Path) -> str:
     raw = path.read_text(encoding="utf-8", errors="ignore")
     try:
@@ -29,10 +37,8 @@ def extract_parquet(path: Path) -> list[dict]:
     df = pd.read_parquet(path)
     return df.to_dict(orient="records")
 
-def extract_pdf(path: Path) -> str:
-    try:
-        doc = fitz.open(path.as_posix())
-        return "\n".join([p.get_text("text") for p in doc])
-    except Exception:
-        with pdfplumber.open(path.as_posix()) as pdf:
-            return "\n".join([p.extract_text() or "" for p in pdf.pages])
\ No newline at end of file
+def iter_parquet(path: Path, batch_size: int) -> Iterator[dict]:
+    """Чтение Parquet батчами pyarrow: в памяти не больше batch_size строк."""
+    parquet_file = pq.ParquetFile(path.as_posix())
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
@@ -0,0 +1,339 @@
+import asyncio
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+from embeddings.service import has_insert_listeners, notify_ids_inserted
+from etl.run_etl import SUPPORTED_SUFFIXES, process_file
+from fastapi_app import config
+from fastapi_app.db import get_client
+from fastapi_app.errors.exceptions import JobQueueFullError, ValidationError
+
+logger = logging.getLogger(__name__)
+
+TERMINAL = ("done", "failed")
+CLAIMABLE = ("queued", "retrying")
+# повтор не поможет: формат не поддерживается, файл битый или уже удалён
+NON_RETRYABLE = (ValueError, FileNotFoundError)
+
+
+@dataclass
+class Job:
+    id: str
+    path: str
+    format: str
+    status: str = "queued" # queued | running | retrying | done | failed
+    stage: str = ""
+    chunks: int = 0
+    attempts: int = 0
+    output: Optional[str] = None
+    error: Optional[str] = None
+    stats: Optional[str] = None
+    owner: Optional[str] = None # аренда процесса API, который выполняет задачу (WorkerLease)
+    created: float = 0.0
+    updated: float = 0.0
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["stats"] = json.loads(self.stats) if self.stats else None
+        return data
+
+
+class JobStore:
+    """Журнал задач в SQLite: переживает рестарт, и в него же пишут прогресс процессы пула."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL DEFAULT '',
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    output TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "stats" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN stats TEXT")
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.path.as_posix(), timeout=10)
+
+    def create(self, path: Path) -> Job:
+        now = time.time()
+        job = Job(
+            id=str(uuid.uuid4()),
+            path=str(path),
+            format=path.suffix.lower().lstrip("."),
+            created=now,
+            updated=now,
+        )
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, path, format, status, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.path, job.format, job.status, job.created, job.updated),
+            )
+        return job
+
+    def update(self, job_id: str, **fields):
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**dict(row)) if row else None
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 100) -> list[Job]:
+        sql, params = "SELECT * FROM jobs", ()
+        if status:
+            sql, params = sql + " WHERE status = ?", (status,)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(sql + " ORDER BY created DESC LIMIT ?", (*params, limit)).fetchall()
+        return [Job(**dict(r)) for r in rows]
+
+    def unfinished(self) -> list[Job]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status NOT IN (?, ?) ORDER BY created", TERMINAL
+            ).fetchall()
+        return [Job(**dict(r)) for r in rows]
+
+    def claim(self, job_id: str, owner: str) -> Optional[Job]:
+        """
+        Атомарно переводит задачу в running за owner. None — задачу уже взял другой процесс API
+        (одна и та же восстановленная задача стоит в очередях всех воркеров) или она завершена.
+        """
+        with self._connect() as conn:
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1, error = NULL, updated = ? "
+                "WHERE id = ? AND status IN (?, ?)",
+                (owner, time.time(), job_id, *CLAIMABLE),
+            ).rowcount
+        return self.get(job_id) if claimed else None
+
+    def release_orphans(self, is_alive) -> int:
+        """running-задачи, чей владелец умер (is_alive(owner) == False), возвращаются в queued."""
+        released = 0
+        for job in self.unfinished():
+            if job.status == "running" and not is_alive(job.owner):
+                with self._connect() as conn:
+                    released += conn.execute(
+                        "UPDATE jobs SET status = 'queued', updated = ? WHERE id = ? AND status = 'running' AND owner IS ?",
+                        (time.time(), job.id, job.owner),
+                    ).rowcount
+        return released
+
+
+def run_job(job_id: str, path: str, db_path: str,
+            mode: str = config.ETL_INGEST_MODE) -> tuple[Optional[str], list[str]]:
+    """
+    Точка входа в процессе пула: ETL файла с записью прогресса в журнал задач.
+    mode=pipeline — сразу эмбеддинги и вставка в ClickHouse, статистика стадий пишется в stats.
+    Возвращает (output, id строк, вставленных этой задачей).
+    """
+    store = JobStore(Path(db_path))
+
+    def progress(stage: str, chunks: int):
+        store.update(job_id, stage=stage, chunks=chunks)
+
+    if mode == "pipeline":
+        from etl.pipeline import ingest_file
+        stats = ingest_file(Path(path), progress=progress)
+        store.update(job_id, stats=json.dumps(stats.to_dict()))
+        return Path(path).stem, stats.ids
+    return process_file(Path(path), progress=progress), []
+
+
+class WorkerLease:
+    """
+    Аренда процесса API: файл <token>.lock под flock на всё время жизни процесса. Если файл удаётся
+    заблокировать со стороны — владелец умер (flock снимается ядром), его running-задачи можно забирать.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self.token = uuid.uuid4().hex
+        self._file = (directory / f"{self.token}.lock").open("w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def is_alive(self, token: Optional[str]) -> bool:
+        if not token:
+            return False
+        if token == self.token:
+            return True
+        path = self.directory / f"{token}.lock"
+        if not path.exists():
+            return False
+        with path.open("a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        path.unlink(missing_ok=True)
+        return False
+
+    def close(self):
+        self._file.close()
+        (self.directory / f"{self.token}.lock").unlink(missing_ok=True)
+
+
+class JobManager:
+    """
+    Очередь ETL-задач в процессе API.
+    Извлечение и чанкинг идут в отдельном пуле процессов, поэтому не конкурируют с обслуживанием запросов за GIL.
+    У каждого формата своя очередь и столько обработчиков, сколько задач формата можно выполнять одновременно:
+    занятый pdf не задерживает html за собой. Размер очереди (backpressure) проверяет только submit();
+    восстановленные после рестарта и повторные задачи встают в очередь без ограничения.
+
+    Журнал общий для всех воркеров uvicorn: задачу выполняет тот, кто атомарно её захватил (JobStore.claim),
+    а при старте в очередь возвращаются только задачи умерших процессов (WorkerLease).
+    """
+
+    def __init__(self, store: JobStore, workers: int = config.ETL_WORKERS,
+                 queue_size: int = config.ETL_QUEUE_SIZE, max_retries: int = config.ETL_MAX_RETRIES):
+        self.store = store
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self._queues: dict[str, asyncio.Queue] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._runners: list[asyncio.Task] = []
+        self._waiters: dict[str, asyncio.Future] = {}
+        self._lease: Optional[WorkerLease] = None
+
+    def _enqueue(self, job_id: str, fmt: str):
+        queue = self._queues.get(fmt)
+        if queue is None:
+            queue = self._queues[fmt] = asyncio.Queue()
+            limit = config.ETL_FORMAT_LIMITS.get(fmt, self.workers)
+            self._runners += [asyncio.create_task(self._runner(queue)) for _ in range(limit)]
+        queue.put_nowait(job_id)
+
+    async def start(self):
+        # spawn: процессы пула не наследуют потоки и состояние uvicorn-воркера
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self._lease = WorkerLease(self.store.path.parent / "workers")
+        # задачи умерших процессов возвращаются в очередь — все, даже сверх queue_size;
+        # running-задачи живых воркеров не трогаем, а queued разберут через claim
+        self.store.release_orphans(self._lease.is_alive)
+        recovered = [job for job in self.store.unfinished() if job.status in CLAIMABLE]
+        for job in recovered:
+            self._enqueue(job.id, job.format)
+        logger.info(f"[JOBS] Очередь ETL запущена: {self.workers} процессов, восстановлено задач: {len(recovered)}")
+
+    async def stop(self):
+        for task in self._runners:
+            task.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self._runners = []
+        self._queues = {}
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._lease:
+            self._lease.close()
+            self._lease = None
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def submit(self, path: Path) -> Job:
+        if self._pool is None:
+            raise RuntimeError("JobManager не запущен")
+        suffix = path.suffix.lower().lstrip(".")
+        if suffix not in SUPPORTED_SUFFIXES:
+            raise ValidationError(f"Unsupported file type: {suffix or path.name}")
+        if self.depth >= self.queue_size:
+            raise JobQueueFullError(f"ETL queue is full ({self.queue_size} jobs)")
+        job = self.store.create(path)
+        self._enqueue(job.id, job.format)
+        logger.info(f"[JOBS] Задача {job.id} поставлена в очередь: {path}")
+        return job
+
+    async def wait(self, job_id: str) -> Job:
+        job = self.store.get(job_id)
+        if job is None or job.status in TERMINAL:
+            return job
+        future = self._waiters.setdefault(job_id, asyncio.get_running_loop().create_future())
+        return await asyncio.shield(future)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.store.get(job_id)
+
+    async def _runner(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await queue.get()
+            try:
+                job = self.store.claim(job_id, self._lease.token)
+                if job is None:
+                    continue
+                await self._run(loop, job)
+            finally:
+                queue.task_done()
+
+    async def _run(self, loop, job: Job):
+        attempts = job.attempts
+        try:
+            output, inserted = await loop.run_in_executor(
+                self._pool, run_job, job.id, job.path, self.store.path.as_posix()
+            )
+        except Exception as e:
+            logger.error(f"[JOBS] Задача {job.id} упала (попытка {attempts}): {e}", exc_info=True)
+            if attempts <= self.max_retries and not isinstance(e, NON_RETRYABLE):
+                self.store.update(job.id, status="retrying", error=str(e))
+                # повтор с экспоненциальной паузой, не занимая слот формата
+                loop.call_later(2 ** attempts, self._enqueue, job.id, job.format)
+                return
+            self._finish(job, "failed", error=str(e))
+            return
+        self._finish(job, "done", output=output)
+        if inserted and has_insert_listeners():
+            try:
+                await asyncio.to_thread(notify_ids_inserted, get_client(), inserted)
+            except Exception as e:
+                logger.error(f"[JOBS] Не удалось уведомить о строках {job.path}: {e}", exc_info=True)
+
+    def _finish(self, job: Job, status: str, output: Optional[str] = None, error: Optional[str] = None):
+        self.store.update(job.id, status=status, stage=status, output=output, error=error)
+        path = Path(job.path)
+        if path.exists():
+            os.remove(path)
+            logger.info(f"[ETL] Исходный файл удалён: {path}")
+        logger.info(f"[JOBS] Задача {job.id}: {status}")
+
+        future = self._waiters.pop(job.id, None)
+        if future is not None and not future.done():
+            future.set_result(self.store.get(job.id))
+
+
+job_manager = JobManager(JobStore(config.JOBS_DB_PATH))
@@ -1,10 +1,11 @@
 import json
 import logging
 from pathlib import Path
-import clickhouse_connect
 
 from embeddings.embeddings import EmbeddingsModel
+from embeddings.service import LoadStats, embed_new, insert_batch
 from fastapi_app.config import PROCESSED_DIR
+from fastapi_app.db import get_client
 
 import sys
 
@@ -15,12 +16,7 @@ logging.basicConfig(
 )
 
 def get_clickhouse_connect():
-    return clickhouse_connect.get_client(
-        host="clickhouse",
-        port=8123,
-        username="default",
-        password="default_pass"
-    )
+    return get_client()
 
 def load_jsonl(path: Path):
     records = []
@@ -29,21 +25,18 @@ def load_jsonl(path: Path):
         for line in f:
             rec = json.loads(line)
             if 'text' in rec:
-                records.append({"text": rec["text"], "metadata": rec.get("metadata", {})})
+                # save_chunks пишет метаданные плоско рядом с text (id, source_file, format, chunk_index)
+                metadata = rec.get("metadata") or {k: v for k, v in rec.items() if k != "text"}
+                records.append({"text": rec["text"], "metadata": metadata})
     return records
 
-def insert_embeddings(client, model, records: list[dict]):
+def insert_embeddings(client, model, records: list[dict]) -> LoadStats:
     texts = [r['text'] for r in records]
     metadata = [r['metadata'] for r in records]
 
-    vectors = model.encode(texts)
-    rows = [(t, m, v) for t, m, v in zip(texts, metadata, vectors)]
-
-    client.insert(
-        'embeddings',
-        rows,
-        column_names=['text', 'metadata', 'vector']
-    )
+    batch = embed_new(client, model, texts, metadata)
+    insert_batch(client, batch)
+    return batch.stats
 
 def run_load(processed_dir: Path = PROCESSED_DIR):
     client = get_clickhouse_connect()
@@ -57,8 +50,8 @@ def run_load(processed_dir: Path = PROCESSED_DIR):
             logger.warning(f"[LOAD] {jsonl_file} пустой, пропускаем")
             continue
 
-        insert_embeddings(client, model, records)
-        logger.info(f"[LOAD] {jsonl_file} → загружено {len(records)} записей")
+        stats = insert_embeddings(client, model, records)
+        logger.info(f"[LOAD] {jsonl_file} → загружено {stats.inserted} из {len(records)} записей: {stats.to_dict()}")
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -76,7 +69,7 @@ if __name__ == "__main__":
         if not records:
             logger.warning(f"[LOAD] {path} пустой, пропускаем")
         else:
-            insert_embeddings(client, model, records)
-            logger.info(f"[LOAD] {path} → загружено {len(records)} записей")
+            stats = insert_embeddings(client, model, records)
+            logger.info(f"[LOAD] {path} → загружено {stats.inserted} из {len(records)} записей: {stats.to_dict()}")
     else:
         run_load()
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""
+Постраничное извлечение PDF. Модуль отдельный и лёгкий по импортам:
+его заново импортирует каждый процесс пула при запуске через spawn.
+"""
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import fitz, pdfplumber
+
+from fastapi_app.config import PDF_WORKERS, PDF_PAGES_PER_TASK, PDF_PARALLEL_MIN_PAGES
+
+def pdf_page_count(path: Path) -> int:
+    try:
+        with fitz.open(path.as_posix()) as doc:
+            return doc.page_count
+    except Exception:
+        with pdfplumber.open(path.as_posix()) as pdf:
+            return len(pdf.pages)
+
+def extract_pdf_pages(path: Path, start: int, stop: int) -> list[str]:
+    """Текст страниц [start, stop); если PyMuPDF не справился, этот диапазон читается pdfplumber."""
+    try:
+        with fitz.open(path.as_posix()) as doc:
+            return [doc[i].get_text("text") for i in range(start, stop)]
+    except Exception:
+        with pdfplumber.open(path.as_posix()) as pdf:
+            return [pdf.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def iter_pdf_pages(path: Path, workers: int = PDF_WORKERS,
+                   pages_per_task: int = PDF_PAGES_PER_TASK) -> Iterator[tuple[int, str]]:
+    """
+    Страницы PDF как (номер с 1, текст) в порядке следования.
+    Диапазоны по pages_per_task страниц извлекаются в пуле процессов; вперёд читается не больше workers * 2 диапазонов,
+    так что в памяти держится ограниченное число страниц.
+    """
+    total = pdf_page_count(path)
+    ranges = [(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)]
+
+    # запуск пула стоит секунды: короткие документы быстрее прочитать в текущем процессе
+    workers = min(workers, len(ranges))
+    if workers <= 1 or total < PDF_PARALLEL_MIN_PAGES:
+        for start, stop in ranges:
+            yield from enumerate(extract_pdf_pages(path, start, stop), start=start + 1)
+        return
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        queued = iter(ranges)
+        pending = deque()
+        for start, stop in queued:
+            pending.append((start, pool.submit(extract_pdf_pages, path, start, stop)))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            start, future = pending.popleft()
+            pages = future.result()
+            following = next(queued, None)
+            if following:
+                pending.append((following[0], pool.submit(extract_pdf_pages, path, *following)))
+            yield from enumerate(pages, start=start + 1)
@@ -0,0 +1,233 @@
+"""
+Потоковый ingest одного файла: extract/chunk -> embed -> insert.
+Стадии — отдельные потоки, связанные ограниченными очередями: пока модель считает батч,
+следующий уже извлекается, а предыдущий уходит в ClickHouse. torch и сетевой I/O отпускают GIL.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from embeddings.embeddings import EmbeddingsModel
+from embeddings.service import EMBEDDING_COLUMNS, EmbedBatch, LoadStats, embed_new, make_rows, notify_inserted
+from etl.run_etl import file_meta, iter_chunk_records
+from fastapi_app import config
+from fastapi_app.db import get_client
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    items: int = 0
+    batches: int = 0
+    busy_seconds: float = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "items": self.items,
+            "batches": self.batches,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_sec": round(self.items / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+        }
+
+
+@dataclass
+class PipelineStats:
+    chunk: StageStats = field(default_factory=StageStats)
+    embed: StageStats = field(default_factory=StageStats)
+    insert: StageStats = field(default_factory=StageStats)
+    dedup: LoadStats = field(default_factory=LoadStats)
+    wall_seconds: float = 0.0
+    ids: list[str] = field(default_factory=list) # id вставленных строк; в to_dict не входят
+
+    def to_dict(self) -> dict:
+        return {
+            "chunk": self.chunk.to_dict(),
+            "embed": self.embed.to_dict(),
+            "insert": self.insert.to_dict(),
+            "dedup": self.dedup.to_dict(),
+            "wall_seconds": round(self.wall_seconds, 3),
+        }
+
+
+class _Stop(Exception):
+    pass
+
+
+class IngestPipeline:
+    def __init__(self, model: Optional[EmbeddingsModel] = None, client=None,
+                 chunk_batch: int = config.PIPELINE_CHUNK_BATCH,
+                 embed_batch: int = config.PIPELINE_EMBED_BATCH,
+                 insert_batch: int = config.PIPELINE_INSERT_BATCH,
+                 queue_size: int = config.PIPELINE_QUEUE_SIZE):
+        self.model = model or EmbeddingsModel()
+        self.client = client or get_client()
+        self.chunk_batch = chunk_batch
+        self.embed_batch = embed_batch
+        self.insert_batch = insert_batch
+        self.queue_size = queue_size
+
+    def run(self, records: Iterable[dict], spill_path: Optional[Path] = None,
+            progress: Optional[Callable[[str, int], None]] = None) -> PipelineStats:
+        """records: поток {"text": ..., "metadata": {...}}; spill_path — куда дополнительно писать JSONL."""
+        stats = PipelineStats()
+        to_embed: queue.Queue = queue.Queue(self.queue_size)
+        to_insert: queue.Queue = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors: list[BaseException] = []
+
+        def put(q: queue.Queue, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            raise _Stop()
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            raise _Stop()
+
+        def stage(fn):
+            def wrapper():
+                try:
+                    fn()
+                except _Stop:
+                    pass
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+            return wrapper
+
+        @stage
+        def chunk_stage():
+            spill = spill_path.open("w", encoding="utf-8") if spill_path else None
+            try:
+                batch, started = [], time.perf_counter()
+                for rec in records:
+                    if spill:
+                        spill.write(json.dumps({**rec["metadata"], "text": rec["text"]}, ensure_ascii=False) + "\n")
+                    batch.append(rec)
+                    if len(batch) >= self.chunk_batch:
+                        stats.chunk.busy_seconds += time.perf_counter() - started
+                        stats.chunk.items += len(batch)
+                        stats.chunk.batches += 1
+                        put(to_embed, batch)
+                        if progress:
+                            progress("chunking", stats.chunk.items)
+                        batch, started = [], time.perf_counter()
+                stats.chunk.busy_seconds += time.perf_counter() - started
+                if batch:
+                    stats.chunk.items += len(batch)
+                    stats.chunk.batches += 1
+                    put(to_embed, batch)
+                put(to_embed, _DONE)
+            finally:
+                if spill:
+                    spill.close()
+
+        @stage
+        def embed_stage():
+            pending = []
+
+            def flush():
+                start = time.perf_counter()
+                batch = embed_new(self.client, self.model, [r["text"] for r in pending], [r["metadata"] for r in pending])
+                stats.embed.busy_seconds += time.perf_counter() - start
+                stats.embed.items += len(pending)
+                stats.embed.batches += 1
+                stats.dedup.merge(batch.stats)
+                if batch.ids:
+                    put(to_insert, batch)
+                if progress:
+                    progress("embedding", stats.embed.items)
+                pending.clear()
+
+            while True:
+                batch = get(to_embed)
+                if batch is _DONE:
+                    break
+                pending.extend(batch)
+                if len(pending) >= self.embed_batch:
+                    flush()
+            if pending:
+                flush()
+            put(to_insert, _DONE)
+
+        @stage
+        def insert_stage():
+            rows, ids, vectors = [], [], []
+
+            def flush():
+                start = time.perf_counter()
+                self.client.insert("embeddings", rows, column_names=EMBEDDING_COLUMNS)
+                stats.insert.busy_seconds += time.perf_counter() - start
+                stats.insert.items += len(rows)
+                stats.insert.batches += 1
+                stats.ids.extend(ids)
+                notify_inserted(list(ids), list(vectors))
+                if progress:
+                    progress("inserting", stats.insert.items)
+                rows.clear(); ids.clear(); vectors.clear()
+
+            while True:
+                item = get(to_insert)
+                if item is _DONE:
+                    break
+                batch: EmbedBatch = item
+                rows.extend(make_rows(batch))
+                ids.extend(batch.ids)
+                vectors.extend(batch.vectors)
+                if len(rows) >= self.insert_batch:
+                    flush()
+            if rows:
+                flush()
+
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=fn, name=f"ingest-{name}", daemon=True)
+            for name, fn in (("chunk", chunk_stage), ("embed", embed_stage), ("insert", insert_stage))
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats.wall_seconds = time.perf_counter() - started
+
+        if errors:
+            raise errors[0]
+        return stats
+
+
+def file_records(filepath: Path, streaming: bool = config.ETL_STREAMING):
+    meta = file_meta(filepath)
+    for i, (text, extra) in enumerate(iter_chunk_records(filepath, streaming)):
+        yield {"text": text, "metadata": {**meta, **extra, "chunk_index": i}}
+
+
+def ingest_file(filepath: Path, spill: bool = config.PIPELINE_SPILL_JSONL,
+                progress: Optional[Callable[[str, int], None]] = None,
+                pipeline: Optional[IngestPipeline] = None) -> PipelineStats:
+    """Полный ingest файла в ClickHouse; возвращает пропускную способность по стадиям и id вставленных строк."""
+    meta = file_meta(filepath)
+    spill_path = None
+    if spill:
+        spill_path = config.PROCESSED_DIR / meta["format"] / f"{filepath.stem}.jsonl"
+        spill_path.parent.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"[INGEST] Запуск конвейера для {filepath}")
+    stats = (pipeline or IngestPipeline()).run(file_records(filepath), spill_path, progress)
+    logger.info(f"[INGEST] {filepath}: {stats.to_dict()}")
+    return stats
@@ -2,125 +2,120 @@ import os
 import asyncio
 import logging
 from pathlib import Path
-import aiofiles
+from typing import Callable, Iterable, Iterator, Optional
 
-from etl.ingest import extract_html, extract_pdf, extract_csv_content, extract_parquet
+from etl.ingest import extract_html, extract_csv_content, extract_parquet, iter_csv, iter_parquet, iter_pdf_pages
 from etl.preprocess import clean_text
-from etl.chunking import records_to_chunks, chunk_text, save_chunks
-from fastapi_app.config import PROCESSED_DIR
+from etl.chunking import records_to_chunks, chunk_text, iter_page_chunks, save_chunks
+from fastapi_app.config import PROCESSED_DIR, RAW_DIR, UPLOAD_RAW_DIR, ETL_STREAMING, ETL_BATCH_SIZE
+from fastapi_app.uploads import original_filename
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-async def run_etl(filepath: Path):
+PROGRESS_EVERY = 100
+SUPPORTED_SUFFIXES = ("htm", "html", "pdf", "csv", "parquet")
+
+def with_progress(chunks: Iterable, progress: Optional[Callable[[str, int], None]]) -> Iterator:
+    if progress is None:
+        yield from chunks
+        return
+    count = 0
+    for count, ch in enumerate(chunks, start=1):
+        if count % PROGRESS_EVERY == 0:
+            progress("chunking", count)
+        yield ch
+    progress("chunking", count)
+
+def source_id(filepath: Path) -> str:
+    """
+    Стабильный source_file документа: путь относительно RAW_DIR (pdf/report.pdf), для загрузок через API —
+    uploads/ и путь относительно UPLOAD_RAW_DIR без префикса загрузки (uploads/pdf/report.pdf), у остальных
+    файлов — абсолютный путь. Повторная загрузка того же документа получает тот же source_file, поэтому
+    дедупликация и удаление строк по source_file работают между загрузками; строки загрузок через API
+    не пересекаются с файлами, которые ведёт etl.sync.
+    """
+    path = filepath.resolve()
+    path = path.with_name(original_filename(path))
+    for root, prefix in ((RAW_DIR, ""), (UPLOAD_RAW_DIR, "uploads/")):
+        try:
+            return prefix + path.relative_to(root.resolve()).as_posix()
+        except ValueError:
+            continue
+    return str(path)
+
+def file_meta(filepath: Path) -> dict:
     suffix = filepath.suffix.lower().lstrip('.')
-    stem = filepath.stem
-
-    logger.info(f"[ETL] Запуск обработки файла: {filepath} (тип: {suffix})")
-
-    try:
-        loop = asyncio.get_event_loop()
-
-        if suffix in ["htm", "html"]:
-            try:
-                text = await loop.run_in_executor(None, extract_html, filepath)
-                logger.info(f"[ETL] Extract html завершён, длина текста: {len(text)}")
-
-                text = clean_text(text)
-                logger.info(f"[ETL] Текст после clean_text длиной {len(text)} символов")
-
-                chunks = chunk_text(text)
-                logger.info(f"[ETL] chunk_text вернул {len(chunks)} чанков")
-
-                save_chunks(
-                    chunks,
-                    PROCESSED_DIR / "html" / f"{stem}.jsonl",
-                    {"id": stem, "source_file": str(filepath), "format": "html"}
-                )
-
-                logger.info(f"[ETL] HTML обработан")
-                return stem
-
-            except Exception as e:
-                logger.error(f"[ETL] Ошибка при обработке html: {e}", exc_info=True)
-                return None
-
-        elif suffix == "pdf":
-            try:
-                text = await loop.run_in_executor(None, extract_pdf, filepath)
-                logger.info(f"[ETL] Extract pdf завершён, длина текста: {len(text)}")
-
-                text = clean_text(text)
-                logger.info(f"[ETL] Текст после clean_text длиной {len(text)} символов")
+    if suffix not in SUPPORTED_SUFFIXES:
+        raise ValueError(f"Unsupported file type: {suffix}")
+    fmt = "html" if suffix == "htm" else suffix
+    return {"id": filepath.stem, "source_file": source_id(filepath), "filename": original_filename(filepath), "format": fmt}
+
+def iter_chunk_records(filepath: Path, streaming: bool = ETL_STREAMING) -> Iterator[tuple[str, dict]]:
+    """
+    Извлечение и чанкинг файла: (текст чанка, доп. метаданные чанка).
+    PDF извлекается постранично в пуле процессов, и у его чанков есть page_start/page_end;
+    для CSV/Parquet в потоковом режиме чанки отдаются лениво.
+    """
+    suffix = filepath.suffix.lower().lstrip('.')
+    fmt = file_meta(filepath)["format"]
 
-                chunks = chunk_text(text)
-                logger.info(f"[ETL] chunk_text вернул {len(chunks)} чанков")
+    if fmt == "pdf":
+        yield from iter_page_chunks(iter_pdf_pages(filepath))
 
-                save_chunks(
-                    chunks,
-                    PROCESSED_DIR / "pdf" / f"{stem}.jsonl",
-                    {"id": stem, "source_file": str(filepath), "format": "pdf"}
-                )
+    elif fmt == "html":
+        text = extract_html(filepath)
+        logger.info(f"[ETL] Extract {fmt} завершён, длина текста: {len(text)}")
 
-                logger.info(f"[ETL] PDF обработан")
-                return stem
+        text = clean_text(text)
+        logger.info(f"[ETL] Текст после clean_text длиной {len(text)} символов")
 
-            except Exception as e:
-                logger.error(f"[ETL] Ошибка при обработке pdf: {e}", exc_info=True)
-                return None
+        chunks = chunk_text(text)
+        logger.info(f"[ETL] chunk_text вернул {len(chunks)} чанков")
+        for ch in chunks:
+            yield ch, {}
 
+    else:
+        if suffix in ["csv", "parquet"] and streaming:
+            records = iter_csv(filepath) if suffix == "csv" else iter_parquet(filepath, ETL_BATCH_SIZE)
         elif suffix == "csv":
-            try:
-                async with aiofiles.open(filepath, 'r', encoding='utf-8') as f:
-                    csv_content = await f.read()
-
-                records = await loop.run_in_executor(None, extract_csv_content, csv_content)
-                logger.info(f"[ETL] Extract csv завершён, количество записей: {len(records)}")
-
-                chunks = list(records_to_chunks(records))
-                logger.info(f"[ETL] Потоковый чанкинг вернул {len(chunks)} чанков")
-
-                save_chunks(
-                    chunks,
-                    PROCESSED_DIR / "csv" / f"{stem}.jsonl",
-                    {"id": stem, "source_file": str(filepath), "format": "csv"}
-                )
-
-                logger.info(f"[ETL] CSV обработан")
-                return stem
-
-            except Exception as e:
-                logger.error(f"[ETL] Ошибка при обработке csv: {e}", exc_info=True)
-                return None
-
-        elif suffix == "parquet":
-            try:
-                records = await loop.run_in_executor(None, extract_parquet, filepath)
-
-                if not records:
-                    logger.warning(f"[ETL] extract_parquet вернул пустой результат для {filepath}")
-                    return None
-
-                logger.info(f"[ETL] Extract parquet завершён, количество записей: {len(records)}")
-
-                chunks = list(records_to_chunks(records))
-                logger.info(f"[ETL] Потоковый чанкинг вернул {len(chunks)} чанков")
-
-                save_chunks(
-                    chunks,
-                    PROCESSED_DIR / "parquet" / f"{stem}.jsonl",
-                    {"id": stem, "source_file": str(filepath), "format": "parquet"}
-                )
-
-                logger.info(f"[ETL] Parquet обработан")
-                return stem
+            with filepath.open('r', encoding='utf-8') as f:
+                records = extract_csv_content(f.read())
+            logger.info(f"[ETL] Extract csv завершён, количество записей: {len(records)}")
+        else:
+            records = extract_parquet(filepath)
+            logger.info(f"[ETL] Extract parquet завершён, количество записей: {len(records)}")
+        for ch in records_to_chunks(records):
+            yield ch, {}
+
+def process_file(filepath: Path, streaming: bool = ETL_STREAMING,
+                 progress: Optional[Callable[[str, int], None]] = None) -> Optional[str]:
+    """
+    Синхронный ETL одного файла: extract -> clean -> chunk -> JSONL.
+    Возвращает stem или None для пустого файла; ошибки пробрасывает (решение о повторе принимает вызывающий).
+    progress(stage, chunks) вызывается по ходу обработки.
+    """
+    meta = file_meta(filepath)
+    out_path = PROCESSED_DIR / meta["format"] / f"{filepath.stem}.jsonl"
+
+    logger.info(f"[ETL] Запуск обработки файла: {filepath} (формат: {meta['format']})")
+    if progress:
+        progress("extracting", 0)
+
+    n_chunks = save_chunks(with_progress(iter_chunk_records(filepath, streaming), progress), out_path, meta)
+
+    if not n_chunks and meta["format"] == "parquet":
+        logger.warning(f"[ETL] parquet {filepath} не содержит записей")
+        out_path.unlink(missing_ok=True)
+        return None
 
-            except Exception as e:
-                logger.error(f"[ETL] Ошибка при обработке parquet: {e}", exc_info=True)
-                return None
+    logger.info(f"[ETL] {meta['format'].upper()} обработан, чанков: {n_chunks}")
+    return filepath.stem
 
-        else:
-            raise ValueError(f"Unsupported file type: {suffix}")
+async def run_etl(filepath: Path, streaming: bool = ETL_STREAMING):
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, process_file, filepath, streaming)
 
     except Exception as e:
         logger.error(f"[ETL] Ошибка при обработке {filepath}: {e}", exc_info=True)
@@ -129,4 +124,4 @@ async def run_etl(filepath: Path):
     finally:
         if filepath.exists():
             os.remove(filepath)
-            logger.info(f"[ETL] Исходный файл удалён: {filepath}")
\ No newline at end of file
+            logger.info(f"[ETL] Исходный файл удалён: {filepath}")
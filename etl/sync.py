@@ -0,0 +1,245 @@
+"""
+Инкрементальная офлайн-синхронизация RAW_DIR/PROCESSED_DIR с ClickHouse.
+
+    python -m etl.sync [--workers N] [--dry-run] [--no-processed]
+
+Манифест (SQLite) хранит размер, mtime и sha256 каждого файла. Обрабатываются только новые и изменённые файлы:
+их прежние строки удаляются по source_file (etl.run_etl.source_id — путь относительно RAW_DIR),
+затем файл проходит extract -> chunk -> embed -> insert.
+Строки удалённых файлов удаляются. Исходные файлы не трогаются.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from embeddings.service import delete_sources
+from etl.run_etl import SUPPORTED_SUFFIXES, source_id
+from fastapi_app import config
+from fastapi_app.db import get_client
+from fastapi_app.uploads import UPLOAD_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    kind: str # raw | jsonl
+    size: int
+    mtime: float
+    sha256: str
+    sources: str # JSON-список source_file, чьи строки дал этот файл
+    chunks: int
+    synced: float
+
+    @property
+    def source_list(self) -> list[str]:
+        return json.loads(self.sources)
+
+
+class SyncManifest:
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    sources TEXT NOT NULL,
+                    chunks INTEGER NOT NULL DEFAULT 0,
+                    synced REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path.as_posix(), timeout=10)
+
+    def entries(self) -> dict[str, ManifestEntry]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM files").fetchall()
+        return {r["path"]: ManifestEntry(**dict(r)) for r in rows}
+
+    def upsert(self, entry: ManifestEntry):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, kind, size, mtime, sha256, sources, chunks, synced) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.path, entry.kind, entry.size, entry.mtime, entry.sha256, entry.sources, entry.chunks, entry.synced),
+            )
+
+    def touch(self, path: str, size: int, mtime: float):
+        with self._connect() as conn:
+            conn.execute("UPDATE files SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path))
+
+    def remove(self, paths: list[str]):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(raw_dir: Path, processed_dir: Optional[Path]) -> list[tuple[str, Path]]:
+    """
+    Файлы, которые ведёт sync. Загрузки через API (<uuid hex>_<имя>) пропускаются, даже если оказались в raw_dir:
+    их удаляет ETL-задача, и sync иначе удалил бы их строки как строки удалённого файла.
+    """
+    files = [
+        ("raw", p) for p in sorted(raw_dir.rglob("*"))
+        if p.is_file() and p.suffix.lower().lstrip(".") in SUPPORTED_SUFFIXES and not UPLOAD_PREFIX.match(p.name)
+    ]
+    if processed_dir is not None and processed_dir.exists():
+        files += [("jsonl", p) for p in sorted(processed_dir.rglob("*.jsonl"))]
+    return files
+
+
+def sync_file(kind: str, path: str, old_sources: list[str], raw_sources: set[str]) -> tuple[list[str], dict]:
+    """
+    Точка входа в процессе пула: заменяет строки одного файла. Возвращает (source_file-ы, статистику).
+    JSONL-записи исходников, которые сами лежат в RAW_DIR, пропускаются — их строки ведёт raw-файл.
+    """
+    client = get_client()
+    if kind == "raw":
+        from etl.pipeline import ingest_file
+        source = source_id(Path(path))
+        delete_sources(client, sorted(set(old_sources) | {source}))
+        return [source], ingest_file(Path(path), spill=False).to_dict()
+
+    from embeddings.embeddings import EmbeddingsModel
+    from etl.load import insert_embeddings, load_jsonl
+    records = [
+        r for r in load_jsonl(Path(path))
+        if r["metadata"].get("source_file", path) not in raw_sources
+    ]
+    sources = sorted({r["metadata"].get("source_file", path) for r in records})
+    delete_sources(client, sorted(set(old_sources) | set(sources)))
+    if not records:
+        return sources, {"chunks": 0}
+    return sources, insert_embeddings(client, EmbeddingsModel(), records).to_dict()
+
+
+def sync(raw_dir: Path = config.RAW_DIR, processed_dir: Optional[Path] = config.PROCESSED_DIR,
+         workers: int = config.ETL_WORKERS, manifest: Optional[SyncManifest] = None,
+         dry_run: bool = False) -> dict:
+    started = time.perf_counter()
+    manifest = manifest or SyncManifest(config.SYNC_MANIFEST_PATH)
+    known = manifest.entries()
+    files = scan(raw_dir, processed_dir)
+    raw_sources = {source_id(p) for kind, p in files if kind == "raw"}
+
+    # дешёвая проверка по size+mtime, хэш считается только для подозрительных файлов
+    suspects, unchanged = [], 0
+    for kind, path in files:
+        stat = path.stat()
+        entry = known.pop(str(path), None)
+        if entry and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+            unchanged += 1
+            continue
+        suspects.append((kind, path, stat, entry))
+
+    with ThreadPoolExecutor(8) as pool:
+        hashes = list(pool.map(lambda item: file_hash(item[1]), suspects))
+
+    todo = []
+    for (kind, path, stat, entry), digest in zip(suspects, hashes):
+        if entry and entry.sha256 == digest:
+            # файл переписан без изменений (touch, копирование) — обновляем только mtime
+            if not dry_run:
+                manifest.touch(str(path), stat.st_size, stat.st_mtime)
+            unchanged += 1
+            continue
+        todo.append((kind, path, stat, digest, entry))
+
+    deleted = list(known.values())
+    summary = {
+        "scanned": len(files),
+        "unchanged": unchanged,
+        "new": sum(1 for *_, entry in todo if entry is None),
+        "changed": sum(1 for *_, entry in todo if entry is not None),
+        "deleted": len(deleted),
+        "synced": 0,
+        "failed": 0,
+        "chunks": 0,
+    }
+    logger.info(f"[SYNC] {summary}")
+    if dry_run:
+        summary["files"] = [str(path) for _, path, *_ in todo]
+        return summary
+
+    if deleted:
+        delete_sources(get_client(), sorted({s for e in deleted for s in e.source_list}))
+        manifest.remove([e.path for e in deleted])
+
+    if todo:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {
+                pool.submit(sync_file, kind, str(path), entry.source_list if entry else [], raw_sources):
+                    (kind, path, stat, digest)
+                for kind, path, stat, digest, entry in todo
+            }
+            for future in as_completed(futures):
+                kind, path, stat, digest = futures[future]
+                try:
+                    sources, stats = future.result()
+                except Exception as e:
+                    # в манифест не пишем: файл попадёт в следующую синхронизацию
+                    logger.error(f"[SYNC] {path}: {e}", exc_info=True)
+                    summary["failed"] += 1
+                    continue
+                chunks = stats.get("chunks", stats.get("chunk", {}).get("items", 0))
+                manifest.upsert(ManifestEntry(
+                    path=str(path), kind=kind, size=stat.st_size, mtime=stat.st_mtime, sha256=digest,
+                    sources=json.dumps(sources), chunks=chunks, synced=time.time(),
+                ))
+                summary["synced"] += 1
+                summary["chunks"] += chunks
+                logger.info(f"[SYNC] {path}: {chunks} чанков, {stats}")
+
+    summary["seconds"] = round(time.perf_counter() - started, 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальная загрузка RAW_DIR/PROCESSED_DIR в ClickHouse")
+    parser.add_argument("--raw-dir", type=Path, default=config.RAW_DIR)
+    parser.add_argument("--processed-dir", type=Path, default=config.PROCESSED_DIR)
+    parser.add_argument("--no-processed", action="store_true", help="не синхронизировать готовые JSONL")
+    parser.add_argument("--workers", type=int, default=config.ETL_WORKERS)
+    parser.add_argument("--manifest", type=Path, default=config.SYNC_MANIFEST_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="только показать, что изменилось")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    summary = sync(
+        args.raw_dir,
+        None if args.no_processed else args.processed_dir,
+        args.workers,
+        SyncManifest(args.manifest),
+        args.dry_run,
+    )
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+import hashlib
+import json
+import logging
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from fastapi_app import config
+
+logger = logging.getLogger(__name__)
+
+ID_DTYPE = "S36"
+
+# отпечаток набора id: XOR первых 8 байт MD5 каждого id (little-endian), то же считает ids_fingerprint.
+# count() совпадает и после удаления+вставки того же числа строк (etl.sync), набор id — нет
+TABLE_FINGERPRINT_SQL = "SELECT count(), groupBitXor(reinterpretAsUInt64(MD5(toString(id)))) FROM embeddings"
+
+
+def ids_fingerprint(ids: np.ndarray) -> int:
+    fingerprint = 0
+    for i in ids:
+        fingerprint ^= int.from_bytes(hashlib.md5(bytes(i)).digest()[:8], "little")
+    return fingerprint
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _kmeans(x: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """Сферический k-means по выборке (косинусная близость на нормированных векторах)."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(x), nlist * 256)
+    sample = np.asarray(x[np.sort(rng.choice(len(x), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    if len(centroids) == 1:
+        return np.zeros(len(x), dtype=np.int32)
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), batch_size):
+        block = np.asarray(x[start:start + batch_size], dtype=np.float32)
+        out[start:start + batch_size] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """
+    Инвертированный индекс (IVF) поверх NumPy.
+    Базовая часть лежит на диске списками подряд (CSR) и открывается через mmap;
+    новые строки копятся в дельте в памяти и вливаются в базу при save().
+    Удалённые id помечаются в памяти, не попадают в выдачу и выбрасываются при save().
+    nlist=1 — точный (flat) поиск.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray,
+                 offsets: np.ndarray, nprobe: int = config.ANN_NPROBE):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self._delta_vectors: list[np.ndarray] = []
+        self._delta_ids: list[np.ndarray] = []
+        self._delta_assign: list[np.ndarray] = []
+        self._delta_cache = None
+        self._deleted = np.zeros(0, dtype=ID_DTYPE) # копия при записи: поиск читает без блокировки
+        self._lock = threading.Lock()
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.ids) + self.delta_size
+
+    @property
+    def delta_size(self) -> int:
+        return sum(len(i) for i in self._delta_ids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, ids: np.ndarray, nlist: int = 0, nprobe: int = config.ANN_NPROBE):
+        vectors = _normalize(vectors)
+        ids = np.asarray(ids, dtype=ID_DTYPE)
+        if nlist <= 0:
+            nlist = max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, max(1, len(vectors)))
+
+        if nlist == 1:
+            centroids = _normalize(vectors.mean(axis=0, keepdims=True)) if len(vectors) else np.zeros((1, vectors.shape[1]), np.float32)
+        else:
+            centroids = _kmeans(vectors, nlist)
+
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        return cls(centroids, vectors[order], ids[order], offsets, nprobe)
+
+    def add(self, ids: list[str], vectors) -> None:
+        if not len(ids):
+            return
+        vectors = _normalize(vectors)
+        assign = _assign(vectors, self.centroids)
+        with self._lock:
+            self._delta_vectors.append(vectors)
+            self._delta_ids.append(np.asarray(ids, dtype=ID_DTYPE))
+            self._delta_assign.append(assign)
+            self._delta_cache = None
+
+    def remove(self, ids: list[str]) -> None:
+        if not len(ids):
+            return
+        with self._lock:
+            self._deleted = np.union1d(self._deleted, np.asarray(ids, dtype=ID_DTYPE))
+
+    def _alive(self, ids: np.ndarray, deleted: np.ndarray) -> np.ndarray:
+        return ~np.isin(ids, deleted)
+
+    def _delta(self):
+        with self._lock:
+            if self._delta_cache is None and self._delta_ids:
+                self._delta_cache = (
+                    np.concatenate(self._delta_vectors),
+                    np.concatenate(self._delta_ids),
+                    np.concatenate(self._delta_assign),
+                )
+            return self._delta_cache
+
+    def _probe(self, query: np.ndarray) -> np.ndarray:
+        if self.nlist == 1:
+            return np.zeros(1, dtype=np.int64)
+        nprobe = min(self.nprobe, self.nlist)
+        sims = self.centroids @ query
+        return np.argpartition(-sims, nprobe - 1)[:nprobe]
+
+    def search(self, query_vector, top_k: int = 5) -> list[tuple[str, float]]:
+        """Возвращает [(id, cosine_distance)] по возрастанию расстояния."""
+        query = _normalize(query_vector).reshape(-1)
+        probe = self._probe(query)
+        deleted = self._deleted
+
+        scores, ids = [], []
+        for lst in probe:
+            start, end = self.offsets[lst], self.offsets[lst + 1]
+            if end > start:
+                scores.append(np.asarray(self.vectors[start:end]) @ query)
+                ids.append(self.ids[start:end])
+
+        delta = self._delta()
+        if delta is not None:
+            d_vectors, d_ids, d_assign = delta
+            mask = np.isin(d_assign, probe)
+            if mask.any():
+                scores.append(d_vectors[mask] @ query)
+                ids.append(d_ids[mask])
+
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        ids = np.concatenate(ids)
+        if len(deleted):
+            alive = self._alive(ids, deleted)
+            scores, ids = scores[alive], ids[alive]
+            if not len(scores):
+                return []
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i].decode(), float(1.0 - scores[i])) for i in top]
+
+    def search_many(self, query_vectors, top_k: int = 5, block_size: int = 65536) -> list[list[tuple[str, float]]]:
+        """
+        search для пачки запросов за один проход: каждый список читается один раз и умножается
+        сразу на все запросы, которые его пробируют; строки идут блоками, чтобы матрица оценок была ограничена.
+        """
+        queries = _normalize(np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1))
+        if self.nlist == 1:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+        else:
+            nprobe = min(self.nprobe, self.nlist)
+            probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        found_scores = [[] for _ in queries]
+        found_ids = [[] for _ in queries]
+        deleted = self._deleted
+
+        def collect(vectors: np.ndarray, ids: np.ndarray, members: np.ndarray):
+            if len(deleted):
+                alive = self._alive(ids, deleted)
+                vectors, ids = vectors[alive], ids[alive]
+                if not len(ids):
+                    return
+            scores = vectors @ queries[members].T # (строки, запросы)
+            k = min(top_k, len(vectors))
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            for column, q in enumerate(members):
+                rows = top[:, column]
+                found_scores[q].append(scores[rows, column])
+                found_ids[q].append(ids[rows])
+
+        for lst in np.unique(probes):
+            members = np.nonzero((probes == lst).any(axis=1))[0]
+            start, end = int(self.offsets[lst]), int(self.offsets[lst + 1])
+            for block in range(start, end, block_size):
+                stop = min(block + block_size, end)
+                collect(np.asarray(self.vectors[block:stop]), self.ids[block:stop], members)
+
+        delta = self._delta()
+        if delta is not None:
+            d_vectors, d_ids, d_assign = delta
+            for q in range(len(queries)):
+                mask = np.isin(d_assign, probes[q])
+                if mask.any():
+                    collect(d_vectors[mask], d_ids[mask], np.array([q]))
+
+        results = []
+        for scores, ids in zip(found_scores, found_ids):
+            if not scores:
+                results.append([])
+                continue
+            scores = np.concatenate(scores)
+            ids = np.concatenate(ids)
+            k = min(top_k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results.append([(ids[i].decode(), float(1.0 - scores[i])) for i in top])
+        return results
+
+    def materialize(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """База + дельта без удалённых строк: (vectors, ids, номера списков)."""
+        with self._lock:
+            delta_vectors, delta_ids, delta_assign = list(self._delta_vectors), list(self._delta_ids), list(self._delta_assign)
+            deleted = self._deleted
+        base_assign = np.repeat(np.arange(self.nlist, dtype=np.int32), np.diff(self.offsets))
+        vectors = np.concatenate([np.asarray(self.vectors), *delta_vectors])
+        ids = np.concatenate([np.asarray(self.ids), *delta_ids])
+        assign = np.concatenate([base_assign, *delta_assign])
+        if len(deleted):
+            alive = self._alive(ids, deleted)
+            vectors, ids, assign = vectors[alive], ids[alive], assign[alive]
+        return vectors, ids, assign
+
+    def save(self, path: Path, backend: str = "ivf") -> "IVFIndex":
+        """
+        Вливает дельту в базу, атомарно пишет каталог и возвращает индекс, открытый через mmap.
+        Вызывающий не должен добавлять и удалять строки во время save (ANNManager держит свою блокировку).
+        """
+        vectors, ids, assign = self.materialize()
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=self.nlist))
+
+        tmp = path.with_name(path.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        np.save(tmp / "centroids.npy", self.centroids)
+        np.save(tmp / "vectors.npy", vectors[order])
+        np.save(tmp / "ids.npy", ids[order])
+        np.save(tmp / "offsets.npy", offsets)
+        (tmp / "meta.json").write_text(json.dumps({
+            "backend": backend, "size": int(len(ids)), "fingerprint": ids_fingerprint(ids),
+            "nlist": self.nlist, "dim": self.dim,
+        }))
+
+        old = path.with_name(path.name + ".old")
+        shutil.rmtree(old, ignore_errors=True)
+        if path.exists():
+            path.rename(old)
+        tmp.rename(path)
+        shutil.rmtree(old, ignore_errors=True)
+
+        return IVFIndex.load(path, self.nprobe)
+
+    @classmethod
+    def load(cls, path: Path, nprobe: int = config.ANN_NPROBE) -> "IVFIndex":
+        return cls(
+            np.load(path / "centroids.npy"),
+            np.load(path / "vectors.npy", mmap_mode="r"),
+            np.load(path / "ids.npy", mmap_mode="r"),
+            np.load(path / "offsets.npy"),
+            nprobe,
+        )
+
+
+def fetch_table_vectors(client, batch_size: int = 50000) -> tuple[np.ndarray, np.ndarray]:
+    vectors, ids = [], []
+    with client.query_row_block_stream(
+        "SELECT toString(id), vector FROM embeddings",
+        settings={"max_block_size": batch_size},
+    ) as stream:
+        for block in stream:
+            ids.extend(row[0] for row in block)
+            vectors.append(np.asarray([row[1] for row in block], dtype=np.float32))
+    if not vectors:
+        return np.zeros((0, 0), np.float32), np.zeros(0, ID_DTYPE)
+    return np.concatenate(vectors), np.asarray(ids, dtype=ID_DTYPE)
+
+
+class ANNManager:
+    """
+    Держит текущий индекс процесса, собирает/загружает его и принимает инкрементальные вставки.
+    Вставки приходят из потоков батчера и вставки, поэтому замена индекса, счётчик и save идут под self._lock;
+    поиск читает self.index без блокировки.
+    """
+
+    def __init__(self, backend: str = config.ANN_BACKEND, path: Path = config.ANN_INDEX_DIR):
+        self.backend = backend
+        self.path = path
+        self.index: Optional[IVFIndex] = None
+        self._since_save = 0
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend in ("flat", "ivf")
+
+    def target_nlist(self, size: int) -> int:
+        """
+        Число списков для size векторов. Пока строк меньше ANN_TRAIN_MIN, центроиды по ним не обучаем —
+        индекс остаётся точным (nlist=1) и переобучается в save(), когда данных станет достаточно.
+        """
+        if self.backend == "flat" or size < config.ANN_TRAIN_MIN:
+            return 1
+        return config.ANN_NLIST or max(1, int(np.sqrt(size)))
+
+    def init(self, client) -> None:
+        if not self.enabled:
+            return
+        table_size, fingerprint = client.query(TABLE_FINGERPRINT_SQL).result_rows[0]
+        if (self.path / "meta.json").exists():
+            meta = json.loads((self.path / "meta.json").read_text())
+            # сверяем и число строк, и набор id: после удаления+вставки count() может не измениться
+            if (meta.get("backend") == self.backend and meta["size"] == int(table_size)
+                    and meta.get("fingerprint") == int(fingerprint)):
+                with self._lock:
+                    self.index = IVFIndex.load(self.path)
+                logger.info(f"[ANN] Индекс загружен из {self.path}: {meta['size']} векторов")
+                return
+            logger.info(f"[ANN] Индекс устарел (строк {meta['size']} -> {table_size} или изменился набор id), пересобираем")
+        self.rebuild(client)
+
+    def rebuild(self, client) -> None:
+        vectors, ids = fetch_table_vectors(client)
+        if not len(ids):
+            logger.info("[ANN] Таблица embeddings пуста, индекс будет собран при первых вставках")
+            return
+        index = IVFIndex.build(vectors, ids, nlist=self.target_nlist(len(ids)))
+        with self._lock:
+            self.index = index.save(self.path, self.backend)
+            self._since_save = 0
+        logger.info(f"[ANN] Индекс {self.backend} собран: {len(ids)} векторов, nlist={self.index.nlist}")
+
+    def on_inserted(self, ids: list[str], vectors) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.index is None:
+                vectors = np.asarray(vectors, dtype=np.float32)
+                self.index = IVFIndex.build(vectors, ids, nlist=self.target_nlist(len(ids)))
+            else:
+                self.index.add(ids, vectors)
+            self._since_save += len(ids)
+            if self._since_save >= config.ANN_SAVE_EVERY:
+                self.save()
+
+    def remove(self, ids: list[str]) -> None:
+        """Убирает из выдачи id, которых уже нет в ClickHouse (удалены etl.sync или другим процессом)."""
+        with self._lock:
+            if self.index is not None:
+                self.index.remove(ids)
+                logger.info(f"[ANN] Удалено из индекса: {len(ids)}")
+
+    def save(self) -> None:
+        with self._lock:
+            if self.index is None:
+                return
+            target = self.target_nlist(len(self.index))
+            if self.index.nlist * 2 <= target:
+                # центроиды обучены на слишком малой выборке — переобучаем по всем строкам индекса
+                vectors, ids, _ = self.index.materialize()
+                self.index = IVFIndex.build(vectors, ids, nlist=target).save(self.path, self.backend)
+                logger.info(f"[ANN] Индекс переобучен: {len(ids)} векторов, nlist={self.index.nlist}")
+            else:
+                self.index = self.index.save(self.path, self.backend)
+            self._since_save = 0
+
+    def search(self, query_vector, top_k: int) -> Optional[list[tuple[str, float]]]:
+        index = self.index
+        if index is None:
+            return None
+        return index.search(query_vector, top_k)
+
+    def search_many(self, query_vectors, top_k: int) -> Optional[list[list[tuple[str, float]]]]:
+        index = self.index
+        if index is None:
+            return None
+        return index.search_many(query_vectors, top_k)
+
+
+ann_manager = ANNManager()
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from fastapi_app import config
+from fastapi_app.db import get_async_client
+from fastapi_app.metrics.metrics import ANSWER_CACHE_TOTAL, ANSWER_CACHE_SAVED_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# отметка изменений таблицы: (видимые строки, строки активных кусков). Вставка увеличивает обе, DELETE —
+# первую, а фоновые слияния не меняют ни одну (кроме слияния, физически вычищающего удалённые строки)
+TABLE_WATERMARK_SQL = """
+    SELECT
+        (SELECT count() FROM embeddings),
+        (SELECT sum(rows) FROM system.parts WHERE database = currentDatabase() AND table = 'embeddings' AND active)
+"""
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    return vector / (np.linalg.norm(vector) + 1e-12)
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    vector: np.ndarray
+    top_k: int
+    filters: tuple # retrieval.filters_key
+    answer: str
+    sources: list[str]
+    worst_distance: float # расстояние до самого дальнего из найденных чанков
+    seconds: float # сколько стоили поиск и генерация
+    created: float
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов RAG по близости эмбеддингов запросов: вопрос с косинусным сходством >= threshold
+    к уже отвеченному получает готовый ответ без поиска и генерации. LRU + TTL в памяти процесса.
+
+    Запись сбрасывается, когда новый чанк ближе к её запросу, чем худший из найденных источников, —
+    такой чанк вошёл бы в top_k и поменял бы контекст ответа. Эти вставки видны только внутри процесса;
+    изменения из etl.load/etl.sync, других воркеров и удаления строк ловит watch_table_changes: если отметка
+    таблицы сдвинулась больше, чем на вставки, уже разобранные on_inserted, кэш сбрасывается целиком.
+    """
+
+    def __init__(self, max_size: int, ttl: float, threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._items: OrderedDict[int, CachedAnswer] = OrderedDict()
+        self._next_key = 0
+        self._matrix: Optional[np.ndarray] = None # векторы запросов в порядке self._items, пересобираются лениво
+        self._keys: list[int] = []
+        self._watermark: Optional[tuple] = None
+        self._own_inserted = 0 # строк, пришедших через on_inserted с прошлой сверки отметки
+        self._lock = threading.Lock()
+
+    def _evict(self, key: int, event: str):
+        del self._items[key]
+        self._matrix = None
+        ANSWER_CACHE_TOTAL.labels(event=event).inc()
+
+    def _vectors(self) -> np.ndarray:
+        if self._matrix is None:
+            self._keys = list(self._items)
+            self._matrix = np.stack([self._items[k].vector for k in self._keys])
+        return self._matrix
+
+    def get(self, query_vector, top_k: int, filters: tuple = ()) -> Optional[CachedAnswer]:
+        vector = _normalize(query_vector)
+        with self._lock:
+            if not self._items:
+                ANSWER_CACHE_TOTAL.labels(event='miss').inc()
+                return None
+            similarities = self._vectors() @ vector
+            now = time.time()
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                key = self._keys[i]
+                item = self._items[key]
+                if now - item.created > self.ttl:
+                    self._evict(key, 'eviction')
+                    break # ключи матрицы устарели; остальные кандидаты проверит следующий запрос
+                if item.top_k != top_k or item.filters != filters:
+                    continue
+                self._items.move_to_end(key)
+                ANSWER_CACHE_TOTAL.labels(event='hit').inc()
+                ANSWER_CACHE_SAVED_SECONDS.inc(item.seconds)
+                return item
+        ANSWER_CACHE_TOTAL.labels(event='miss').inc()
+        return None
+
+    def set(self, query: str, query_vector, top_k: int, filters: tuple, answer: str, retrieved: list, seconds: float):
+        item = CachedAnswer(
+            query=query,
+            vector=_normalize(query_vector),
+            top_k=top_k,
+            filters=filters,
+            answer=answer,
+            sources=[str(r["id"]) for r in retrieved],
+            worst_distance=max((float(r["distance"]) for r in retrieved), default=float("inf")),
+            seconds=seconds,
+            created=time.time(),
+        )
+        with self._lock:
+            self._items[self._next_key] = item
+            self._next_key += 1
+            self._matrix = None
+            while len(self._items) > self.max_size:
+                self._evict(next(iter(self._items)), 'eviction')
+
+    def on_inserted(self, ids: list[str], vectors) -> None:
+        """Обработчик add_insert_listener: сбрасывает ответы, чей top_k изменился бы после вставки."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(vectors):
+            return
+        vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+        with self._lock:
+            self._own_inserted += len(vectors)
+            if not self._items:
+                return
+            nearest = 1.0 - (self._vectors() @ vectors.T).max(axis=1)
+            stale = [key for key, distance in zip(self._keys, nearest) if distance < self._items[key].worst_distance]
+            for key in stale:
+                self._evict(key, 'invalidation')
+
+    def on_table_changed(self, watermark: tuple) -> None:
+        """
+        Сбрасывает весь кэш, если отметка (count(), строки кусков) изменилась не только на вставки,
+        уже обработанные on_inserted: значит, строки вставил или удалил другой процесс.
+        """
+        watermark = tuple(int(value or 0) for value in watermark)
+        with self._lock:
+            own, self._own_inserted = self._own_inserted, 0
+            expected = self._watermark and tuple(value + own for value in self._watermark)
+            changed = expected is not None and watermark != expected
+            self._watermark = watermark
+            if changed:
+                for key in list(self._items):
+                    self._evict(key, 'invalidation')
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+async def watch_table_changes(cache: SemanticAnswerCache, interval: float = config.ANSWER_CACHE_WATCH_INTERVAL):
+    """Фоновая задача lifespan: раз в interval секунд сверяет отметку изменений embeddings."""
+    while True:
+        try:
+            client = await get_async_client()
+            result = await client.query(TABLE_WATERMARK_SQL)
+            cache.on_table_changed(tuple(result.result_rows[0]))
+        except Exception as e:
+            logger.warning(f"[ANSWER_CACHE] Не удалось проверить изменения таблицы: {e}")
+        await asyncio.sleep(interval)
+
+
+def create_answer_cache() -> Optional[SemanticAnswerCache]:
+    if not config.ANSWER_CACHE_ENABLED:
+        return None
+    return SemanticAnswerCache(config.ANSWER_CACHE_SIZE, config.ANSWER_CACHE_TTL, config.ANSWER_CACHE_THRESHOLD)
+
+
+answer_cache = create_answer_cache()
@@ -2,12 +2,14 @@ from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import Dict, List
 
-from embeddings.service import get_clickhouse_client, store_embeddings
+from embeddings.batcher import EmbeddingBatcher
+from embeddings.service import get_clickhouse_client
 from embeddings.embeddings import EmbeddingsModel
 
 router = APIRouter()
 model = EmbeddingsModel()
 client = get_clickhouse_client()
+batcher = EmbeddingBatcher(model, client)
 
 class EmbedRequest(BaseModel):
     text: List[str]
@@ -15,5 +17,5 @@ class EmbedRequest(BaseModel):
 
 @router.post("/embed")
 async def embed(request: EmbedRequest):
-    store_embeddings(client, model, request.text, request.metadata)
-    return {'status': 'ok', 'inserted': len(request.text)}
\ No newline at end of file
+    inserted = await batcher.submit(request.text, request.metadata)
+    return {'status': 'ok', 'inserted': inserted}
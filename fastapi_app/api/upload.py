@@ -1,58 +1,108 @@
-from fastapi import APIRouter, UploadFile, Form, BackgroundTasks
-from pathlib import Path
-import shutil
 import asyncio
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from pathlib import Path
+from typing import Optional
 
-from etl.run_etl import run_etl
-from fastapi_app import config
+from etl.jobs import job_manager
+from fastapi_app.errors.exceptions import JobQueueFullError, ValidationError
+from fastapi_app.uploads import UploadSession, raw_upload_path
 
-def start_etl_sync(filepath: Path):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_etl(filepath))
-    loop.close()
 router = APIRouter()
+
+def get_session(file_id: str) -> UploadSession:
+    try:
+        return UploadSession(file_id)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/init_upload")
+async def init_upload(
+        file_id: str = Form(...),
+        total_size: Optional[int] = Form(None),
+        chunk_size: Optional[int] = Form(None),
+        filename: Optional[str] = Form(None)
+):
+    session = get_session(file_id)
+    try:
+        session = await asyncio.to_thread(session.init, chunk_size, total_size, filename)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.status()
+
 @router.post("/upload_chunk")
 async def upload_chunk(
         file_id: str = Form(...),
         chunk_index: int = Form(...),
-        chunk: UploadFile = None
+        checksum: Optional[str] = Form(None),
+        chunk: UploadFile = File(...)
 ):
-    file_dir = config.UPLOAD_TMP_DIR/file_id
-    file_dir.mkdir(parents=True, exist_ok=True)
+    session = get_session(file_id)
+    # старый клиент не вызывает init_upload: сессия открывается неявно с размером части по умолчанию
+    if not session.exists:
+        await asyncio.to_thread(session.init)
+    else:
+        session.load()
 
-    chunk_path = file_dir/f"{chunk_index}.part"
+    try:
+        writer = session.open_chunk(chunk_index)
+        try:
+            while content := await chunk.read(1024 * 1024):
+                await asyncio.to_thread(writer.write, content)
+        finally:
+            writer.close()
+        marker = writer.commit(checksum)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    with open(chunk_path, "wb") as f:
-        while content := await chunk.read(1024 * 1024):
-            f.write(content)
+    return {"status": "ok", "chunk_index": chunk_index, **marker}
 
-    return {"status": "ok", "chunk_index": chunk_index}
+@router.get("/upload_status/{file_id}")
+async def upload_status(file_id: str):
+    session = get_session(file_id)
+    if not session.exists:
+        raise HTTPException(status_code=404, detail=f"Upload {file_id} not found")
+    return session.load().status()
 
 @router.post("/merge_file")
 async def merge_file(
-    background_tasks: BackgroundTasks,
     file_id: str = Form(...),
-    total_chunks: int = Form(...),
-    filename: str = Form(...)
-
+    filename: str = Form(...),
+    total_chunks: Optional[int] = Form(None)
 ):
-    file_dir = config.UPLOAD_TMP_DIR / file_id
-    suffix = Path(filename).suffix.lower().lstrip(".")
+    session = get_session(file_id)
+    if not session.exists:
+        raise HTTPException(status_code=404, detail=f"Upload {file_id} not found")
+    session.load()
+    total_chunks = total_chunks or session.total_chunks()
+    if total_chunks is None:
+        raise HTTPException(status_code=400, detail="total_chunks is required when total_size is unknown")
 
-    final_dir = config.RAW_DIR / suffix
-    final_dir.mkdir(parents=True, exist_ok=True)
+    filename = Path(filename).name
+    final_path = raw_upload_path(filename)
 
-    final_path = final_dir / filename
+    try:
+        await asyncio.to_thread(session.finalize, final_path, total_chunks)
+    except ValidationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-    with open(final_path, "wb") as outfile:
-        for i in range(total_chunks):
-            chunk_path = file_dir/f"{i}.part"
-            with open(chunk_path, "rb") as f:
-                shutil.copyfileobj(f, outfile)
+    try:
+        job = job_manager.submit(final_path)
+    except JobQueueFullError as e:
+        final_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=429, detail=str(e))
+    except ValidationError as e:
+        final_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=str(e))
 
-    background_tasks.add_task(start_etl_sync, final_path)
+    return {"status": "accepted", "file": filename, "job_id": job.id, "message": "ETL поставлен в очередь"}
 
-    shutil.rmtree(file_dir, ignore_errors=True)
+@router.get("/jobs")
+async def list_jobs(status: Optional[str] = None, limit: int = 100):
+    return {"queue_depth": job_manager.depth, "jobs": [j.to_dict() for j in job_manager.store.list_jobs(status, limit)]}
 
-    return {"status": "accepted", "file": filename, "message": "ETL запущен в фоне"}
\ No newline at end of file
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
\ No newline at end of file
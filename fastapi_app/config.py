@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -5,4 +6,113 @@ BASE_DIR = Path(__file__).resolve().parent.parent.parent
 RAW_DIR = BASE_DIR / "data" / "raw"
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 
-UPLOAD_TMP_DIR = BASE_DIR / "data" / "uploads" / "tmp"
\ No newline at end of file
+UPLOAD_TMP_DIR = BASE_DIR / "data" / "uploads" / "tmp"
+# файлы, загруженные через API, до конца ETL-задачи; вне RAW_DIR, чтобы etl.sync их не видел
+UPLOAD_RAW_DIR = BASE_DIR / "data" / "uploads" / "raw"
+
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+MODEL_REGISTRY_SIZE = int(os.getenv("MODEL_REGISTRY_SIZE", "2"))
+WARMUP_MODELS = [m.strip() for m in os.getenv("WARMUP_MODELS", EMBED_MODEL_NAME).split(",") if m.strip()]
+
+QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory") # memory | disk | off
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_PATH = Path(os.getenv("QUERY_CACHE_PATH", str(BASE_DIR / "data" / "cache" / "query_embeddings.sqlite")))
+
+# Семантический кэш ответов RAG: порог косинусного сходства запросов, размер, время жизни (секунды)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# как часто сверять число строк embeddings с вставками этого процесса (ловит CLI, другие воркеры, удаления), секунды
+ANSWER_CACHE_WATCH_INTERVAL = float(os.getenv("ANSWER_CACHE_WATCH_INTERVAL", "5"))
+
+ANN_BACKEND = os.getenv("ANN_BACKEND", "off") # off | flat | ivf
+ANN_INDEX_DIR = Path(os.getenv("ANN_INDEX_DIR", str(BASE_DIR / "data" / "ann_index")))
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0")) # 0 = sqrt(N)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+ANN_SAVE_EVERY = int(os.getenv("ANN_SAVE_EVERY", "10000"))
+ANN_TRAIN_MIN = int(os.getenv("ANN_TRAIN_MIN", "10000")) # меньше строк — точный поиск без обучения центроидов
+
+CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "clickhouse")
+CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "8123"))
+CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "default")
+CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "default_pass")
+CLICKHOUSE_DATABASE = os.getenv("CLICKHOUSE_DATABASE", "default")
+CLICKHOUSE_POOL_SIZE = int(os.getenv("CLICKHOUSE_POOL_SIZE", "16"))
+CLICKHOUSE_CONNECT_TIMEOUT = int(os.getenv("CLICKHOUSE_CONNECT_TIMEOUT", "10"))
+CLICKHOUSE_QUERY_TIMEOUT = int(os.getenv("CLICKHOUSE_QUERY_TIMEOUT", "300"))
+
+SEARCH_MODE = os.getenv("SEARCH_MODE", "exact") # exact | int8 | binary | hybrid
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "100")) # для hybrid — лексических кандидатов под cosine
+HYBRID_MAX_TERMS = int(os.getenv("HYBRID_MAX_TERMS", "16")) # токенов запроса в лексическом отборе
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+ETL_STREAMING = os.getenv("ETL_STREAMING", "1") == "1"
+ETL_BATCH_SIZE = int(os.getenv("ETL_BATCH_SIZE", "10000")) # строк на батч при потоковом чтении
+
+CHUNK_MODE = os.getenv("CHUNK_MODE", "chars") # chars | tokens
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", EMBED_MODEL_NAME) # имя HF-токенайзера или tiktoken:<encoding>
+# all-MiniLM-L6-v2 в sentence-transformers обрезает вход на 256 токенах (включая [CLS]/[SEP])
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "254"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", str(BASE_DIR / "data" / "jobs" / "jobs.sqlite")))
+SYNC_MANIFEST_PATH = Path(os.getenv("SYNC_MANIFEST_PATH", str(BASE_DIR / "data" / "jobs" / "sync_manifest.sqlite")))
+ETL_WORKERS = int(os.getenv("ETL_WORKERS", "2")) # процессы пула извлечения и чанкинга
+ETL_QUEUE_SIZE = int(os.getenv("ETL_QUEUE_SIZE", "100")) # сверх этого новые задачи получают 429
+ETL_MAX_RETRIES = int(os.getenv("ETL_MAX_RETRIES", "2"))
+# одновременных задач на формат, например "pdf=1,html=2"; по умолчанию ETL_WORKERS
+ETL_FORMAT_LIMITS = {
+    k.strip(): int(v) for k, v in
+    (item.split("=") for item in os.getenv("ETL_FORMAT_LIMITS", "pdf=1").split(",") if "=" in item)
+}
+
+ETL_INGEST_MODE = os.getenv("ETL_INGEST_MODE", "jsonl") # jsonl | pipeline (extract -> chunk -> embed -> insert)
+PIPELINE_SPILL_JSONL = os.getenv("PIPELINE_SPILL_JSONL", "0") == "1"
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8")) # батчей между стадиями
+PIPELINE_CHUNK_BATCH = int(os.getenv("PIPELINE_CHUNK_BATCH", "64"))
+PIPELINE_EMBED_BATCH = int(os.getenv("PIPELINE_EMBED_BATCH", "256"))
+PIPELINE_INSERT_BATCH = int(os.getenv("PIPELINE_INSERT_BATCH", "2000"))
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "256")) # текстов в одном проходе модели /api/embed
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "10"))
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", str(BASE_DIR / "data" / "cache" / "chunk_embeddings.sqlite")))
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1" # не вставлять чанки, чей content_hash уже есть в таблице для того же source_file
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(5 * 1024 * 1024))) # если клиент не открыл сессию через init_upload
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "4")) # файлов одного запроса /load_documents одновременно
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1)))) # процессов на извлечение одного PDF
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "50"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "200"))
+
+# LLM: по умолчанию HF Inference API; LLM_BASE_URL — OpenAI-совместимый сервер (TGI, vLLM, локальная заглушка fastapi_app.llm_stub)
+LLM_MODEL = os.getenv("LLM_MODEL", "mistralai/Mistral-7B-Instruct-v0.2")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "512"))
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.7"))
+# шлюз LLM: одновременных обращений к upstream; breaker открывается после LLM_BREAKER_FAILURES ошибок подряд
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30")) # секунд до пробного запроса
+
+# Асинхронный RAG: потоки под инференс эмбеддингов запросов и таймауты стадий (секунды)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+RAG_EMBED_TIMEOUT = float(os.getenv("RAG_EMBED_TIMEOUT", "10"))
+RAG_SEARCH_TIMEOUT = float(os.getenv("RAG_SEARCH_TIMEOUT", "10"))
+RAG_LLM_TIMEOUT = float(os.getenv("RAG_LLM_TIMEOUT", "120"))
+
+# контекст промпта RAG: бюджет в токенах CONTEXT_TOKENIZER (tiktoken:<encoding> или имя HF-токенайзера LLM),
+# доля шинглов предложения, уже бывших в контексте, при которой оно считается повтором
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1024"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "tiktoken:cl100k_base")
+CONTEXT_TOKENIZER_RETRY = float(os.getenv("CONTEXT_TOKENIZER_RETRY", "300")) # секунд до новой попытки загрузить токенайзер
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+CONTEXT_MIN_FRAGMENT_TOKENS = int(os.getenv("CONTEXT_MIN_FRAGMENT_TOKENS", "32")) # короче обрезанный хвост не добавляется
+
+# /rag/query_batch: максимум запросов в одном теле и одновременных генераций LLM
+RAG_BATCH_MAX = int(os.getenv("RAG_BATCH_MAX", "256"))
+RAG_BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))
@@ -0,0 +1,160 @@
+"""
+Сборка контекста для промпта RAG в бюджете токенов.
+
+Соседние чанки одного документа перекрываются на OVERLAP символов (etl.chunking), поэтому найденные фрагменты
+часто повторяют друг друга. Фрагменты режутся на предложения и строки; предложение, чьи словесные шинглы уже
+почти целиком есть в предыдущих фрагментах, отбрасывается. Внутри одного фрагмента ничего не вырезается, а
+короткие предложения (поля CSV/Parquet вида "city: Paris") не сравниваются вовсе. Уникальный текст укладывается
+в порядке релевантности с исходными переводами строк, пока не кончится бюджет; токены считает
+CONTEXT_TOKENIZER (tiktoken:<encoding> или HF-токенайзер модели).
+"""
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+from etl.chunking import get_token_encoder
+from fastapi_app.config import (
+    CONTEXT_TOKEN_BUDGET, CONTEXT_TOKENIZER, CONTEXT_TOKENIZER_RETRY, CONTEXT_DUPLICATE_THRESHOLD,
+    CONTEXT_MIN_FRAGMENT_TOKENS,
+)
+from fastapi_app.metrics.metrics import CONTEXT_TOKENS, CONTEXT_DUPLICATE_TOKENS, CONTEXT_TOKENIZER_FALLBACK
+
+logger = logging.getLogger(__name__)
+
+# разделитель попадает в результат split: переводы строк между записями сохраняются при сборке
+SENTENCE_END = re.compile(r"((?<=[.!?…])\s+|\s*\n\s*)")
+WORD = re.compile(r"\w+")
+SHINGLE_WORDS = 3
+MIN_DUPLICATE_SHINGLES = 3 # предложения короче (меньше 5 слов) повтором не считаются
+
+
+@dataclass
+class ContextPart:
+    index: int # номер фрагмента в промпте
+    id: str
+    text: str
+    tokens: int
+
+
+@dataclass
+class Context:
+    parts: list[ContextPart] = field(default_factory=list)
+    tokens: int = 0
+    duplicate_tokens: int = 0 # сэкономлено на повторах между фрагментами
+    truncated: bool = False # последний фрагмент обрезан по бюджету
+
+    @property
+    def text(self) -> str:
+        return "\n".join(f"{part.index}. {part.text}" for part in self.parts)
+
+
+# грубое приближение BPE: слово или отдельный знак — один токен
+APPROX_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def approximate_encode(text: str) -> list[tuple[int, int]]:
+    return [m.span() for m in APPROX_TOKEN.finditer(text)]
+
+
+# токенайзер -> время неудачной загрузки; успешные загрузки кэширует сам get_token_encoder
+_failed_loads: dict[str, float] = {}
+
+
+def token_encoder(name: str, retry_after: float = CONTEXT_TOKENIZER_RETRY) -> Callable[[str], list[tuple[int, int]]]:
+    """
+    get_token_encoder, но без падения запроса: если токенайзер не загрузился (нет сети до его файлов),
+    считаем приближённо и пробуем загрузить его снова не раньше чем через retry_after секунд.
+    Пока действует приближение, rag_context_tokenizer_fallback{tokenizer=name} = 1.
+    """
+    failed_at = _failed_loads.get(name)
+    if failed_at is not None and time.monotonic() - failed_at < retry_after:
+        return approximate_encode
+    try:
+        encode = get_token_encoder(name)
+    except Exception as e:
+        _failed_loads[name] = time.monotonic()
+        CONTEXT_TOKENIZER_FALLBACK.labels(tokenizer=name).set(1)
+        logger.warning("[CONTEXT] токенайзер %s недоступен (%s), токены считаются приближённо", name, e)
+        return approximate_encode
+    if _failed_loads.pop(name, None) is not None:
+        logger.info("[CONTEXT] токенайзер %s загружен, приближённый подсчёт токенов отключён", name)
+    CONTEXT_TOKENIZER_FALLBACK.labels(tokenizer=name).set(0)
+    return encode
+
+
+def split_sentences(text: str) -> list[tuple[str, str]]:
+    """(предложение, разделитель после него): перевод строки сохраняется, остальные пробелы сжимаются до одного."""
+    parts = SENTENCE_END.split(text)
+    result = []
+    for sentence, separator in zip(parts[::2], parts[1::2] + [""]):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        newlines = separator.count("\n")
+        result.append((sentence, "\n" * newlines if newlines else " "))
+    return result
+
+
+def shingles(sentence: str) -> set:
+    words = WORD.findall(sentence.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def is_duplicate(sentence_shingles: set, seen: set, threshold: float) -> bool:
+    if len(sentence_shingles) < MIN_DUPLICATE_SHINGLES:
+        return False
+    return len(sentence_shingles & seen) / len(sentence_shingles) >= threshold
+
+
+def build_context(results: list, token_budget: int = CONTEXT_TOKEN_BUDGET, tokenizer: str = CONTEXT_TOKENIZER,
+                  threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> Context:
+    """
+    results — найденные документы по убыванию релевантности (dict с 'text' и 'id').
+    Возвращает Context с уникальными кусками фрагментов, суммарно не длиннее token_budget токенов.
+    """
+    encode = token_encoder(tokenizer)
+    context = Context()
+    seen: set = set() # шинглы предыдущих фрагментов; с ними сравниваются предложения следующих
+    remaining = token_budget
+
+    for item in results:
+        kept = []
+        item_shingles: set = set()
+        for sentence, separator in split_sentences(item["text"]):
+            sentence_shingles = shingles(sentence)
+            if is_duplicate(sentence_shingles, seen, threshold):
+                context.duplicate_tokens += len(encode(sentence))
+                continue
+            item_shingles |= sentence_shingles
+            kept.append(sentence + separator)
+        seen |= item_shingles
+        if not kept:
+            continue
+
+        index = len(context.parts) + 1
+        # номер фрагмента и перевод строки тоже занимают токены
+        overhead = len(encode(f"{index}. \n"))
+        text = "".join(kept).rstrip()
+        spans = encode(text)
+        if len(spans) + overhead > remaining:
+            available = remaining - overhead
+            if available < CONTEXT_MIN_FRAGMENT_TOKENS:
+                context.truncated = True
+                break
+            text = text[:spans[available - 1][1]]
+            spans = spans[:available]
+            context.truncated = True
+
+        context.parts.append(ContextPart(index=index, id=str(item.get("id", "")), text=text, tokens=len(spans)))
+        context.tokens += len(spans) + overhead
+        remaining -= len(spans) + overhead
+        if context.truncated:
+            break
+
+    CONTEXT_TOKENS.observe(context.tokens)
+    CONTEXT_DUPLICATE_TOKENS.inc(context.duplicate_tokens)
+    return context
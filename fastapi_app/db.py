@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+import clickhouse_connect
+from clickhouse_connect.driver import httputil
+
+from fastapi_app import config
+
+_pool_manager = None
+_client = None
+_async_client = None
+_lock = threading.Lock()
+_async_lock = asyncio.Lock()
+
+
+def get_pool_manager():
+    """Общий пул HTTP-соединений с keep-alive: соединения переиспользуются между запросами и потоками."""
+    global _pool_manager
+    with _lock:
+        if _pool_manager is None:
+            _pool_manager = httputil.get_pool_manager(
+                maxsize=config.CLICKHOUSE_POOL_SIZE,
+                num_pools=2,
+                block=False,
+            )
+        return _pool_manager
+
+
+def _client_kwargs(**overrides) -> dict:
+    kwargs = dict(
+        host=config.CLICKHOUSE_HOST,
+        port=config.CLICKHOUSE_PORT,
+        username=config.CLICKHOUSE_USER,
+        password=config.CLICKHOUSE_PASSWORD,
+        database=config.CLICKHOUSE_DATABASE,
+        connect_timeout=config.CLICKHOUSE_CONNECT_TIMEOUT,
+        send_receive_timeout=config.CLICKHOUSE_QUERY_TIMEOUT,
+        # без сессии один клиент можно безопасно использовать из нескольких потоков
+        autogenerate_session_id=False,
+        pool_mgr=get_pool_manager(),
+    )
+    kwargs.update(overrides)
+    return kwargs
+
+
+def create_client(**overrides):
+    """Новый клиент поверх общего пула (например, с другим host для запуска с хоста)."""
+    return clickhouse_connect.get_client(**_client_kwargs(**overrides))
+
+
+def get_client():
+    """Процессный синглтон синхронного клиента."""
+    global _client
+    if _client is None:
+        client = create_client()
+        with _lock:
+            if _client is None:
+                _client = client
+    return _client
+
+
+async def get_async_client():
+    """Процессный синглтон асинхронного клиента."""
+    global _async_client
+    async with _async_lock:
+        if _async_client is None:
+            _async_client = await clickhouse_connect.get_async_client(
+                executor_threads=config.CLICKHOUSE_POOL_SIZE,
+                **_client_kwargs(),
+            )
+    return _async_client
@@ -6,6 +6,22 @@ class LLMError(Exception):
     """Ошибка при обращении к LLM (API HuggingFace, OpenAI и т.п.)"""
     pass
 
+class LLMUnavailableError(LLMError):
+    """Circuit breaker LLM открыт: upstream деградировал, запрос отклонён без обращения к нему"""
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM upstream unavailable, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
 class DBError(Exception):
     """Ошибка при обращении к базе данных"""
-    pass
\ No newline at end of file
+    pass
+class JobQueueFullError(Exception):
+    """Очередь ETL-задач заполнена, клиенту стоит повторить позже"""
+    pass
+
+class StageTimeoutError(Exception):
+    """Стадия RAG-пайплайна (embed | search | llm) не уложилась в свой таймаут"""
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} stage timed out after {timeout}s")
+        self.stage = stage
+        self.timeout = timeout
@@ -0,0 +1,183 @@
+"""
+Шлюз перед LLM: склейка одинаковых запросов в полёте (single-flight), ограничение одновременных
+обращений к upstream с метрикой очереди, таймаут и circuit breaker.
+
+Проверка локально: uvicorn fastapi_app.llm_stub:app --port 8081 (STUB_FAIL_RATE — доля ответов 503),
+LLM_BASE_URL=http://localhost:8081 uvicorn fastapi_app.main:app.
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable
+
+from fastapi_app import config
+from fastapi_app.errors.exceptions import LLMError, LLMUnavailableError, StageTimeoutError
+from fastapi_app.metrics.metrics import (
+    LLM_GATEWAY_TOTAL, LLM_GATEWAY_QUEUE_DEPTH, LLM_GATEWAY_IN_FLIGHT, LLM_CIRCUIT_STATE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Одинаковые ключи в полёте ждут один общий вызов.
+    Отмена одного ожидающего (клиент отключился) не трогает остальных; вызов отменяется, когда ушли все.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, tuple[asyncio.Task, list[int]]] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable]):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.create_task(factory())
+            call = self._calls[key] = (task, [0])
+            task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        else:
+            LLM_GATEWAY_TOTAL.labels(result='coalesced', flight=self.name).inc()
+        task, waiters = call
+        waiters[0] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and waiters[0] == 1:
+                task.cancel()
+            raise
+        finally:
+            waiters[0] -= 1
+
+
+class CircuitBreaker:
+    """
+    closed -> open после failure_threshold ошибок подряд; в open вызовы сразу получают LLMUnavailableError.
+    Через reset_timeout один пробный вызов (half-open): успех закрывает цепь, ошибка снова открывает.
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe = False
+        LLM_CIRCUIT_STATE.set(self.state)
+
+    def _set_state(self, state: int):
+        if state != self.state:
+            logger.warning("[LLM] circuit breaker: %s -> %s", self.state, state)
+        self.state = state
+        LLM_CIRCUIT_STATE.set(state)
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise LLMUnavailableError(self.retry_after())
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe:
+                raise LLMUnavailableError(self.retry_after())
+            self._probe = True
+
+    def record_success(self):
+        self._probe = False
+        self.failures = 0
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self._probe = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def release(self):
+        """Вызов отменён без результата: пробный слот half-open освобождается."""
+        self._probe = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+class LLMGateway:
+    def __init__(self, concurrency: int, timeout: float, breaker: CircuitBreaker):
+        self.timeout = timeout
+        self.breaker = breaker
+        self.flight = SingleFlight("llm")
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @asynccontextmanager
+    async def slot(self, deadline: float):
+        """
+        Место под один вызов upstream: проверка breaker, ожидание в очереди семафора до deadline (loop.time()).
+        Ошибки и таймауты внутри блока считаются отказами upstream; ожидание в очереди — нет.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            self.breaker.before_call()
+        except LLMUnavailableError:
+            LLM_GATEWAY_TOTAL.labels(result='rejected', flight=self.flight.name).inc()
+            raise
+        LLM_GATEWAY_QUEUE_DEPTH.inc()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.breaker.release()
+            LLM_GATEWAY_TOTAL.labels(result='queue_timeout', flight=self.flight.name).inc()
+            raise StageTimeoutError("llm", self.timeout)
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            LLM_GATEWAY_QUEUE_DEPTH.dec()
+
+        if self.breaker.state == CircuitBreaker.OPEN:
+            # цепь открылась, пока вызов стоял в очереди
+            self._semaphore.release()
+            LLM_GATEWAY_TOTAL.labels(result='rejected', flight=self.flight.name).inc()
+            raise LLMUnavailableError(self.breaker.retry_after())
+
+        LLM_GATEWAY_IN_FLIGHT.inc()
+        try:
+            yield
+        except (StageTimeoutError, LLMError):
+            self.breaker.record_failure()
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.breaker.record_failure()
+            LLM_GATEWAY_TOTAL.labels(result='error', flight=self.flight.name).inc()
+            raise LLMError(str(e)) from e
+        else:
+            self.breaker.record_success()
+        finally:
+            self._semaphore.release()
+            LLM_GATEWAY_IN_FLIGHT.dec()
+
+    async def _call(self, upstream: Callable[[], Awaitable[str]]) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        async with self.slot(deadline):
+            try:
+                result = await asyncio.wait_for(upstream(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                LLM_GATEWAY_TOTAL.labels(result='timeout', flight=self.flight.name).inc()
+                raise StageTimeoutError("llm", self.timeout)
+        LLM_GATEWAY_TOTAL.labels(result='success', flight=self.flight.name).inc()
+        return result
+
+    async def generate(self, key: Hashable, upstream: Callable[[], Awaitable[str]]) -> str:
+        """upstream() — один вызов LLM; одинаковые key в полёте делят его результат."""
+        return await self.flight.run(key, lambda: self._call(upstream))
+
+
+llm_gateway = LLMGateway(
+    config.LLM_CONCURRENCY,
+    config.RAG_LLM_TIMEOUT,
+    CircuitBreaker(config.LLM_BREAKER_FAILURES, config.LLM_BREAKER_RESET),
+)
@@ -0,0 +1,72 @@
+"""
+Заглушка OpenAI-совместимого LLM-сервера для локальной проверки стриминга и нагрузочных тестов без HF API.
+
+    uvicorn fastapi_app.llm_stub:app --port 8081
+    LLM_BASE_URL=http://localhost:8081 uvicorn fastapi_app.main:app
+
+STUB_TTFT_MS — задержка до первого токена, STUB_TOKEN_MS — между токенами, STUB_TOKENS — длина ответа,
+STUB_FAIL_RATE — доля запросов, на которые заглушка отвечает 503 (проверка circuit breaker в llm_gateway).
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+STUB_TTFT_MS = float(os.getenv("STUB_TTFT_MS", "300"))
+STUB_TOKEN_MS = float(os.getenv("STUB_TOKEN_MS", "20"))
+STUB_TOKENS = int(os.getenv("STUB_TOKENS", "64"))
+STUB_FAIL_RATE = float(os.getenv("STUB_FAIL_RATE", "0"))
+
+app = FastAPI(title="LLM stub")
+
+
+def stub_tokens(prompt: str, limit: int) -> list[str]:
+    words = (prompt.split() or ["stub"]) * (limit // max(1, len(prompt.split())) + 1)
+    return [f"{w} " for w in words[:limit]]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < STUB_FAIL_RATE:
+        await asyncio.sleep(STUB_TTFT_MS / 1000)
+        return JSONResponse(status_code=503, content={"error": "stub overloaded"})
+    prompt = body["messages"][-1]["content"]
+    tokens = stub_tokens(prompt, min(STUB_TOKENS, body.get("max_tokens") or STUB_TOKENS))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model") or "stub"
+
+    if not body.get("stream"):
+        await asyncio.sleep((STUB_TTFT_MS + STUB_TOKEN_MS * len(tokens)) / 1000)
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens),
+                      "total_tokens": len(prompt.split()) + len(tokens)},
+        }
+
+    async def events():
+        await asyncio.sleep(STUB_TTFT_MS / 1000)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(STUB_TOKEN_MS / 1000)
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        final = {
+            "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
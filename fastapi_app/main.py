@@ -1,54 +1,114 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from pathlib import Path
+import asyncio
 import logging
 import aiofiles
 
-from etl.run_etl import run_etl
-from fastapi_app.config import RAW_DIR
+from etl.jobs import job_manager
+from embeddings.registry import registry
+from embeddings.service import add_insert_listener
+from fastapi_app.db import get_client
+from fastapi_app.ann_index import ann_manager
+from fastapi_app.answer_cache import answer_cache, watch_table_changes
+from fastapi_app.config import WARMUP_MODELS, LOAD_CONCURRENCY
+from fastapi_app.errors.exceptions import JobQueueFullError, ValidationError
 from fastapi_app.api.upload import router as upload_router
 from fastapi_app.rag_router import router as rag_router
+from fastapi_app.uploads import raw_upload_path
 from fastapi_app.metrics.router import router as metrics_router
 from fastapi_app.api import embeddings
 
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+UPLOAD_PIECE = 1024 * 1024
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
 )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # прогрев моделей до приёма первого запроса
+    await asyncio.to_thread(registry.warmup, WARMUP_MODELS)
+    if ann_manager.enabled:
+        await asyncio.to_thread(ann_manager.init, get_client())
+        add_insert_listener(ann_manager.on_inserted)
+    watcher = None
+    if answer_cache is not None:
+        add_insert_listener(answer_cache.on_inserted)
+        watcher = asyncio.create_task(watch_table_changes(answer_cache))
+    await job_manager.start()
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    await embeddings.batcher.stop()
+    await job_manager.stop()
+    if ann_manager.enabled:
+        await asyncio.to_thread(ann_manager.save)
+
 app = FastAPI(
     title = "AI Knowledge Base API",
     description="Минимальный сервис для старта проекта",
     version="0.1.0",
+    lifespan=lifespan,
 )
 app.include_router(upload_router, prefix="/files")
 app.include_router(embeddings.router, prefix="/api", tags=["embeddings"])
 app.include_router(rag_router, prefix='/rag', tags=['RAG'])
 app.include_router(metrics_router)
 
-@app.post("/load_documents")
-async def load_documents(files: list[UploadFile] = File(...)):
-    results = []
-
-    for file in files:
-        if file.size and file.size > 50 * 1024 * 1024:
-            raise HTTPException(status_code=403, detail=f"Файл {file.filename} слишком большой. Используйте /files/upload-chunk")
-
-        suffix = Path(file.filename).suffix.lower().lstrip(".")
+async def save_upload(file: UploadFile) -> Path:
+    """
+    Пишет загрузку на диск кусками по UPLOAD_PIECE байт, не держа файл в памяти целиком.
+    Путь уникален для каждой загрузки; исходное имя остаётся в метаданных чанков (filename).
+    """
+    raw_path = raw_upload_path(file.filename)
+    raw_path.parent.mkdir(parents=True, exist_ok=True)
 
-        raw_dir = RAW_DIR / suffix
-        raw_dir.mkdir(parents=True, exist_ok=True)
-        raw_path = raw_dir / file.filename
-
-        async with aiofiles.open(raw_path, "wb") as buffer:
-            content = await file.read()
+    written = 0
+    async with aiofiles.open(raw_path, "wb") as buffer:
+        while content := await file.read(UPLOAD_PIECE):
+            written += len(content)
+            if written > MAX_DOCUMENT_SIZE:
+                break
             await buffer.write(content)
+    if written > MAX_DOCUMENT_SIZE:
+        raw_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=403, detail=f"Файл {file.filename} слишком большой. Используйте /files/upload_chunk")
+    return raw_path
 
-        out = await run_etl(raw_path)
-
-        if raw_path.exists():
-            raw_path.unlink()
+@app.post("/load_documents")
+async def load_documents(files: list[UploadFile] = File(...), wait: bool = True):
+    """
+    Файлы запроса сохраняются и ставятся в очередь ETL параллельно (не больше LOAD_CONCURRENCY одновременно).
+    wait=false — ответ сразу с job_id, статус смотреть в /files/jobs/{job_id}.
+    """
+    for file in files:
+        if file.size and file.size > MAX_DOCUMENT_SIZE:
+            raise HTTPException(status_code=403, detail=f"Файл {file.filename} слишком большой. Используйте /files/upload_chunk")
 
-        results.append({"file": file.filename, "format": suffix, "output": out})
+    semaphore = asyncio.Semaphore(LOAD_CONCURRENCY)
 
-    return {"status": "ok", "processed": results}
+    async def process(file: UploadFile) -> dict:
+        suffix = Path(file.filename).suffix.lower().lstrip(".")
+        async with semaphore:
+            raw_path = await save_upload(file)
+            try:
+                job = job_manager.submit(raw_path)
+            except JobQueueFullError as e:
+                raw_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=429, detail=str(e))
+            except ValidationError as e:
+                raw_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=400, detail=str(e))
+            if wait:
+                job = await job_manager.wait(job.id)
+        return {"file": file.filename, "format": suffix, "job_id": job.id, "status": job.status,
+                "output": job.output, "error": job.error}
 
+    results = await asyncio.gather(*(process(f) for f in files))
 
+    if not wait:
+        return {"status": "accepted", "jobs": results}
+    return {"status": "ok", "processed": results}
@@ -1,4 +1,4 @@
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 REQUESTS_TOTAL = Counter(
     'requests_total',
@@ -15,5 +15,96 @@ LATENCY_SECONDS = Histogram(
 ERRORS_TOTAL = Counter(
     'errors_total',
     'Total number of errors',
-    ['type'] # validation | llm_error | db_error | internal
-)
\ No newline at end of file
+    ['type'] # validation | llm_error | llm_unavailable | db_error | timeout | cancelled | internal
+)
+
+MODEL_LOAD_SECONDS = Histogram(
+    'model_load_seconds',
+    'Time spent loading embedding models into the registry',
+    ['model']
+)
+
+MODEL_REGISTRY_TOTAL = Counter(
+    'model_registry_total',
+    'Model registry lookups',
+    ['result'] # hit | miss
+)
+
+QUERY_CACHE_TOTAL = Counter(
+    'query_embedding_cache_total',
+    'Query embedding cache events',
+    ['event'] # hit | miss | eviction
+)
+
+ANSWER_CACHE_TOTAL = Counter(
+    'rag_answer_cache_total',
+    'Semantic RAG answer cache events',
+    ['event'] # hit | miss | eviction | invalidation
+)
+
+ANSWER_CACHE_SAVED_SECONDS = Counter(
+    'rag_answer_cache_saved_seconds_total',
+    'Retrieval and generation time avoided by answer cache hits'
+)
+
+EMBED_BATCH_SIZE = Histogram(
+    'embed_batch_size',
+    'Texts per micro-batch in the /api/embed scheduler',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+
+EMBED_QUEUE_WAIT_SECONDS = Histogram(
+    'embed_queue_wait_seconds',
+    'Time a /api/embed request waits before its batch starts'
+)
+
+LLM_TTFT_SECONDS = Histogram(
+    'llm_time_to_first_token_seconds',
+    'Time from request start to the first streamed LLM token',
+    ['endpoint']
+)
+
+LLM_TOKENS_PER_SECOND = Histogram(
+    'llm_tokens_per_second',
+    'Streamed LLM generation speed after the first token',
+    ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+)
+
+CONTEXT_TOKENS = Histogram(
+    'rag_context_tokens',
+    'Tokens of retrieved context packed into a RAG prompt',
+    buckets=(64, 128, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+)
+
+CONTEXT_DUPLICATE_TOKENS = Counter(
+    'rag_context_duplicate_tokens_total',
+    'Tokens of overlapping or near-duplicate retrieved text left out of RAG prompts'
+)
+
+CONTEXT_TOKENIZER_FALLBACK = Gauge(
+    'rag_context_tokenizer_fallback',
+    'Context tokenizer failed to load and tokens are approximated: 1 yes, 0 no',
+    ['tokenizer']
+)
+
+LLM_GATEWAY_TOTAL = Counter(
+    'llm_gateway_total',
+    'LLM gateway call outcomes',
+    ['result', 'flight'] # success | coalesced | timeout | queue_timeout | error | rejected; flight: llm | rag
+)
+
+LLM_GATEWAY_QUEUE_DEPTH = Gauge(
+    'llm_gateway_queue_depth',
+    'LLM calls waiting for a concurrency slot'
+)
+
+LLM_GATEWAY_IN_FLIGHT = Gauge(
+    'llm_gateway_in_flight',
+    'LLM calls currently sent upstream'
+)
+
+LLM_CIRCUIT_STATE = Gauge(
+    'llm_circuit_state',
+    'LLM circuit breaker state: 0 closed, 1 half-open, 2 open'
+)
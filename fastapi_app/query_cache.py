@@ -0,0 +1,135 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from fastapi_app import config
+from fastapi_app.metrics.metrics import QUERY_CACHE_TOTAL
+
+
+def normalize_query(text: str) -> str:
+    """Приводит запрос к канонической форме: регистр, юникод, пробелы, хвостовая пунктуация."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?!.…")
+
+
+def cache_key(text: str, model_name: str) -> str:
+    raw = f"{model_name}\x00{normalize_query(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryQueryCache:
+    """LRU + TTL в памяти процесса."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            created, vector = item
+            if time.time() - created > self.ttl:
+                del self._items[key]
+                QUERY_CACHE_TOTAL.labels(event='eviction').inc()
+                return None
+            self._items.move_to_end(key)
+            return vector
+
+    def set(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._items[key] = (time.time(), vector)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                QUERY_CACHE_TOTAL.labels(event='eviction').inc()
+
+
+class DiskQueryCache:
+    """
+    LRU + TTL в локальном SQLite-файле.
+    Файл общий для всех uvicorn-воркеров на хосте, поэтому прогретый кэш переживает рестарт и делится между процессами.
+    """
+
+    def __init__(self, path: Path, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=5)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS query_cache (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    dtype TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS query_cache_accessed ON query_cache(accessed)")
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, dtype, created FROM query_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            blob, dtype, created = row
+            if now - created > self.ttl:
+                self._conn.execute("DELETE FROM query_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                QUERY_CACHE_TOTAL.labels(event='eviction').inc()
+                return None
+            self._conn.execute("UPDATE query_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return np.frombuffer(blob, dtype=dtype).copy()
+
+    def set(self, key: str, vector: np.ndarray):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_cache (key, vector, dtype, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, vector.tobytes(), vector.dtype.str, now, now),
+            )
+            cur = self._conn.execute(
+                """
+                DELETE FROM query_cache WHERE key IN (
+                    SELECT key FROM query_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                ) OR created < ?
+                """,
+                (self.max_size, now - self.ttl),
+            )
+            self._conn.commit()
+        if cur.rowcount > 0:
+            QUERY_CACHE_TOTAL.labels(event='eviction').inc(cur.rowcount)
+
+
+def create_query_cache():
+    backend = config.QUERY_CACHE_BACKEND
+    if backend == "off":
+        return None
+    if backend == "disk":
+        return DiskQueryCache(config.QUERY_CACHE_PATH, config.QUERY_CACHE_SIZE, config.QUERY_CACHE_TTL)
+    if backend == "memory":
+        return MemoryQueryCache(config.QUERY_CACHE_SIZE, config.QUERY_CACHE_TTL)
+    raise ValueError(f"Unknown QUERY_CACHE_BACKEND: {backend}")
+
+
+query_cache = create_query_cache()
@@ -1,12 +1,26 @@
-from typing import List, Union, Optional
+from typing import AsyncIterator, List, Union, Optional
+import asyncio
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import logging
-import clickhouse_connect
 import numpy as np
 import torch
-from transformers import AutoModel, AutoTokenizer
-from huggingface_hub import InferenceClient
+from huggingface_hub import AsyncInferenceClient
+
+from embeddings.registry import registry
+from fastapi_app.config import (
+    EMBED_MODEL_NAME, CONTEXT_TOKEN_BUDGET, LLM_MODEL, LLM_BASE_URL, LLM_MAX_TOKENS, LLM_TEMPERATURE,
+    INFERENCE_WORKERS, RAG_EMBED_TIMEOUT, RAG_SEARCH_TIMEOUT, RAG_LLM_TIMEOUT,
+)
+from fastapi_app.answer_cache import answer_cache
+from fastapi_app.context_builder import build_context
+from fastapi_app.errors.exceptions import StageTimeoutError
+from fastapi_app.llm_gateway import SingleFlight, llm_gateway
+from fastapi_app.metrics.metrics import QUERY_CACHE_TOTAL
+from fastapi_app.query_cache import query_cache, cache_key
+from fastapi_app.retrieval import filters_key, search_in_clickhouse_async, search_many_async
 
 load_dotenv()
 
@@ -14,11 +28,21 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 HF_TOKEN = os.getenv('HF_TOKEN')
-if HF_TOKEN is None:
+if HF_TOKEN is None and LLM_BASE_URL is None:
     raise ValueError("HF_TOKEN is not set. Add it to your .env file")
 
-model_name = "mistralai/Mistral-7B-Instruct-v0.2"
-client = InferenceClient(model=model_name, token=HF_TOKEN)
+model_name = LLM_MODEL
+if LLM_BASE_URL:
+    async_client = AsyncInferenceClient(base_url=LLM_BASE_URL, token=HF_TOKEN)
+else:
+    async_client = AsyncInferenceClient(model=model_name, token=HF_TOKEN)
+
+# инференс эмбеддингов запросов: ограниченное число потоков, чтобы torch не занимал все ядра под нагрузкой
+inference_executor = ThreadPoolExecutor(INFERENCE_WORKERS, thread_name_prefix="query-embed")
+
+rag_flight = SingleFlight("rag")
+
+SYSTEM_PROMPT = "You are a helpful assistant for answering questions based on retrieved documents."
 
 def get_query_embedding(
         texts: Union[str, List[str]],
@@ -34,12 +58,11 @@ def get_query_embedding(
     if isinstance(texts, str):
         texts = [texts]
 
-    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
-
-    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-    model = AutoModel.from_pretrained(model_name_or_path)
-    model.to(device)
-    model.eval()
+    # токенайзер и трансформер берём из общего реестра — тот же экземпляр, что у EmbeddingsModel
+    st_model = registry.get(model_name_or_path or EMBED_MODEL_NAME, device)
+    device = st_model.device
+    tokenizer = st_model.tokenizer
+    model = st_model[0].auto_model
 
     enc = tokenizer(texts, padding=True, truncation=True, max_length=max_length, return_tensors="pt")
     input_ids = enc['input_ids'].to(device)
@@ -67,46 +90,56 @@ def get_query_embedding(
 
     return emb[0] if len(emb) == 1 else emb
 
-def search_in_clickhouse(query_vector: np.ndarray, top_k: int = 5):
-    client = clickhouse_connect.get_client(
-        host="clickhouse", port=8123, username="default", password="default_pass"
-    )
+def embed_query(query: str, model_name: str = EMBED_MODEL_NAME) -> np.ndarray:
+    """
+    Эмбеддинг одиночного запроса через кэш (нормализованный текст + имя модели).
+    """
+    if query_cache is None:
+        return get_query_embedding(query, model_name_or_path=model_name)
+
+    key = cache_key(query, model_name)
+    vector = query_cache.get(key)
+    if vector is not None:
+        QUERY_CACHE_TOTAL.labels(event='hit').inc()
+        return vector
 
-    vector_str = '[' + ','.join(map(str, query_vector.tolist())) + ']'
-    sql = f'''
-        SELECT
-            id, text, cosineDistance(vector, {vector_str}) AS distance
-        FROM
-            embeddings
-        ORDER BY distance ASC
-        LIMIT {top_k}
-    '''
-    result = client.query(sql)
-    rows = result.result_rows
-    columns = result.column_names
-
-    return [dict(zip(columns, row)) for row in rows]
-
-def build_prompt(query: str, results: list, max_context_len: int = 1000) -> str:
+    QUERY_CACHE_TOTAL.labels(event='miss').inc()
+    vector = get_query_embedding(query, model_name_or_path=model_name)
+    query_cache.set(key, vector)
+    return vector
+
+def embed_queries(queries: List[str], model_name: str = EMBED_MODEL_NAME) -> np.ndarray:
+    """
+    Эмбеддинги пачки запросов: попадания берутся из кэша, промахи считаются одним прямым проходом модели.
+    Возвращает np.ndarray (len(queries), dim).
+    """
+    vectors: list = [None] * len(queries)
+    keys = [cache_key(q, model_name) for q in queries]
+    if query_cache is not None:
+        for i, key in enumerate(keys):
+            vectors[i] = query_cache.get(key)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if query_cache is not None:
+        QUERY_CACHE_TOTAL.labels(event='hit').inc(len(queries) - len(missing))
+        QUERY_CACHE_TOTAL.labels(event='miss').inc(len(missing))
+
+    if missing:
+        computed = np.atleast_2d(get_query_embedding([queries[i] for i in missing], model_name_or_path=model_name))
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+            if query_cache is not None:
+                query_cache.set(keys[i], vector)
+    return np.stack(vectors).astype(np.float32, copy=False)
+
+def build_prompt(query: str, results: list, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
     """
        Формирует prompt для LLM в стиле RAG:
        - query: запрос пользователя
        - results: список документов из ClickHouse (top-k), где в каждом dict есть ключ 'text'
-       - max_context_len: ограничение длины контекста (символы)
+       - token_budget: ограничение контекста в токенах; повторы между фрагментами вырезаются (см. context_builder)
     """
 
-    context_parts = []
-    total_len = 0
-    for idx, item in enumerate(results, start=1):
-        fragment = item['text']
-        fragment = fragment[:300]
-        if total_len + len(fragment) > max_context_len:
-            break
-
-        context_parts.append(f'{idx}. {fragment}')
-        total_len += len(fragment)
-
-    context = "\n".join(context_parts)
+    context = build_context(results, token_budget).text
 
     prompt = f"""Используй приведённый контекст, чтобы ответить на вопрос.
         Контекст:
@@ -116,35 +149,128 @@ def build_prompt(query: str, results: list, max_context_len: int = 1000) -> str:
         Ответ (будь максимально точным, опирайся только на контекст):"""
     return prompt
 
-def generate_answer(prompt: str) -> str:
+def chat_messages(prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+def cached_answer(query_vec: np.ndarray, top_k: int, filters: Optional[dict] = None) -> Optional[dict]:
+    if answer_cache is None:
+        return None
+    item = answer_cache.get(query_vec, top_k, filters_key(filters))
+    if item is None:
+        return None
+    return {"answer": item.answer, "sources": list(item.sources)}
+
+def cache_answer(query: str, query_vec: np.ndarray, top_k: int, filters: Optional[dict], answer: str, retrieved: list,
+                 seconds: float):
+    # ошибки генерации сюда не доходят (generate_answer_async их пробрасывает), кэшируются только ответы
+    if answer_cache is not None:
+        answer_cache.set(query, query_vec, top_k, filters_key(filters), answer, retrieved, seconds)
+
+async def with_timeout(stage: str, awaitable, timeout: float):
     try:
-        response = client.chat_completion(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant for answering questions based on retrieved documents."},
-                {"role": "user", "content": prompt},
-            ],
-            max_tokens=512,
-            temperature=0.7
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise StageTimeoutError(stage, timeout)
+
+async def embed_query_async(query: str, model_name: str = EMBED_MODEL_NAME) -> np.ndarray:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, embed_query, query, model_name)
+
+async def embed_queries_async(queries: List[str], model_name: str = EMBED_MODEL_NAME) -> np.ndarray:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, embed_queries, queries, model_name)
+
+async def build_prompt_async(query: str, results: list) -> str:
+    """build_prompt в пуле потоков: токенизация и дедупликация контекста не блокируют event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, build_prompt, query, results)
+
+async def retrieve_many_async(queries: List[str], embed_model: str = EMBED_MODEL_NAME, top_k: int = 5,
+                              filters: Optional[dict] = None) -> list[list]:
+    """Поиск для пачки запросов: один проход модели и один запрос к ClickHouse (или один проход ANN)."""
+    vectors = await with_timeout("embed", embed_queries_async(queries, embed_model), RAG_EMBED_TIMEOUT)
+    return await with_timeout("search", search_many_async(vectors, top_k=top_k, filters=filters), RAG_SEARCH_TIMEOUT)
+
+async def retrieve_async(query: str, embed_model: str = EMBED_MODEL_NAME, top_k: int = 5,
+                         filters: Optional[dict] = None) -> list:
+    query_vec = await with_timeout("embed", embed_query_async(query, embed_model), RAG_EMBED_TIMEOUT)
+    return await with_timeout("search", search_in_clickhouse_async(query_vec, top_k=top_k, filters=filters, query_text=query),
+                              RAG_SEARCH_TIMEOUT)
+
+async def generate_answer_async(prompt: str) -> str:
+    """
+    Генерация через llm_gateway: одинаковые промпты в полёте делят один вызов, число обращений к upstream
+    ограничено LLM_CONCURRENCY. Таймаут — StageTimeoutError, ошибка upstream — LLMError,
+    открытый circuit breaker — LLMUnavailableError без обращения к upstream.
+    """
+    async def upstream() -> str:
+        response = await async_client.chat_completion(
+            messages=chat_messages(prompt),
+            max_tokens=LLM_MAX_TOKENS,
+            temperature=LLM_TEMPERATURE
         )
         return response.choices[0].message["content"]
-    except Exception as e:
-        return f"Error during generation: {e}"
 
-def rag_pipeline(query: str, embed_model: str = "sentence-transformers/all-MiniLM-L6-v2", top_k: int = 5) -> dict:
+    return await llm_gateway.generate((model_name, LLM_MAX_TOKENS, LLM_TEMPERATURE, prompt), upstream)
+
+async def stream_answer_async(prompt: str) -> AsyncIterator[str]:
+    """
+    Ответ LLM по кускам текста по мере генерации (stream=True) через слот llm_gateway;
+    RAG_LLM_TIMEOUT ограничивает очередь и генерацию, ошибки пробрасываются вызывающему.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RAG_LLM_TIMEOUT
+    async with llm_gateway.slot(deadline):
+        stream = await with_timeout("llm", async_client.chat_completion(
+            messages=chat_messages(prompt),
+            max_tokens=LLM_MAX_TOKENS,
+            temperature=LLM_TEMPERATURE,
+            stream=True,
+        ), max(0.0, deadline - loop.time()))
+        iterator = stream.__aiter__()
+        while True:
+            try:
+                chunk = await with_timeout("llm", iterator.__anext__(), max(0.0, deadline - loop.time()))
+            except StopAsyncIteration:
+                return
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+async def rag_pipeline_async(query: str, embed_model: str = EMBED_MODEL_NAME, top_k: int = 5,
+                             filters: Optional[dict] = None) -> dict:
     """
-        Полный RAG-пайплайн:
-        1. Получает эмбеддинг запроса
-        2. Делает поиск в ClickHouse
-        3. Формирует промпт
-        4. Генерирует ответ через LLM
-        Возвращает dict: {"answer": str, "sources": list}
+    Полный RAG-пайплайн: эмбеддинг запроса, поиск, промпт, генерация; возвращает {"answer": str, "sources": list}.
+    filters ({"source_file": ..., "format": ...}) ограничивают поиск подмножеством документов.
+    Event loop не блокируется: эмбеддинг в inference_executor, поиск через асинхронный клиент ClickHouse,
+    сборка промпта в пуле потоков, генерация через llm_gateway. У каждой стадии свой таймаут (StageTimeoutError);
+    отмена задачи (клиент отключился) прерывает ожидание текущей стадии.
+    Одинаковые (после normalize_query) запросы в полёте проходят пайплайн один раз.
     """
-    query_vec = get_query_embedding(query, model_name_or_path=embed_model)
-    retrieved = search_in_clickhouse(query_vec, top_k=top_k)
+    return await rag_flight.run(
+        (cache_key(query, embed_model), top_k, filters_key(filters)),
+        lambda: _rag_pipeline_async(query, embed_model, top_k, filters),
+    )
+
+async def _rag_pipeline_async(query: str, embed_model: str, top_k: int, filters: Optional[dict]) -> dict:
+    query_vec = await with_timeout("embed", embed_query_async(query, embed_model), RAG_EMBED_TIMEOUT)
+    cached = cached_answer(query_vec, top_k, filters)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    retrieved = await with_timeout("search", search_in_clickhouse_async(query_vec, top_k=top_k, filters=filters, query_text=query),
+                                   RAG_SEARCH_TIMEOUT)
     if not retrieved:
         return {"answer": "Sorry, I didn't find relevant documents.", "sources": []}
-    prompt = build_prompt(query, retrieved)
-    answer = generate_answer(prompt)
+    prompt = await build_prompt_async(query, retrieved)
+    answer = await generate_answer_async(prompt)
     sources = [str(r["id"]) for r in retrieved]
+    cache_answer(query, query_vec, top_k, filters, answer, retrieved, time.perf_counter() - started)
 
-    return {"answer": answer, "sources": sources}
\ No newline at end of file
+    return {"answer": answer, "sources": sources}
@@ -1,22 +1,40 @@
+import asyncio
+import json
 import logging
 import uuid
 import time
 
-from fastapi import APIRouter
-from pydantic import BaseModel
-from typing import List, Literal, Optional
-from starlette.responses import JSONResponse
+from fastapi import APIRouter, Request
+from pydantic import BaseModel, ConfigDict
+from typing import List, Literal, Optional, Union
+from starlette.responses import JSONResponse, StreamingResponse
 
-from fastapi_app.metrics.metrics import REQUESTS_TOTAL, LATENCY_SECONDS, ERRORS_TOTAL
-from fastapi_app.errors.exceptions import ValidationError, LLMError, DBError
-from fastapi_app.rag_pipeline import rag_pipeline
+from fastapi_app.metrics.metrics import (
+    REQUESTS_TOTAL, LATENCY_SECONDS, ERRORS_TOTAL, LLM_TTFT_SECONDS, LLM_TOKENS_PER_SECOND,
+)
+from fastapi_app.errors.exceptions import ValidationError, LLMError, LLMUnavailableError, DBError, StageTimeoutError
+from fastapi_app.config import RAG_BATCH_MAX, RAG_BATCH_CONCURRENCY
+from fastapi_app.rag_pipeline import (
+    rag_pipeline_async, retrieve_async, retrieve_many_async, build_prompt_async, generate_answer_async, stream_answer_async,
+)
 
 logger = logging.getLogger('rag_router')
 
 router = APIRouter()
 
+class MetadataFilters(BaseModel):
+    """Поиск только по документам с подходящими source_file / format (значение или список значений)."""
+    model_config = ConfigDict(extra='forbid')
+
+    source_file: Optional[Union[str, List[str]]] = None
+    format: Optional[Union[str, List[str]]] = None
+
+    def to_dict(self) -> Optional[dict]:
+        return self.model_dump(exclude_none=True) or None
+
 class QueryRequest(BaseModel):
     query: str
+    filters: Optional[MetadataFilters] = None
 
 class QueryResponse(BaseModel):
     answer: str
@@ -29,9 +47,47 @@ class ErrorResponse(BaseModel):
     message: str
     latency: Optional[float] = None
 
+class QueryBatchRequest(BaseModel):
+    queries: List[str]
+    top_k: int = 5
+    generate: bool = True
+    filters: Optional[MetadataFilters] = None
+
+class QueryBatchItem(BaseModel):
+    query: str
+    answer: Optional[str] = None
+    sources: List[str] = []
+    error: Optional[str] = None
+
+class QueryBatchResponse(BaseModel):
+    results: List[QueryBatchItem]
+    latency: float
+    queries_per_sec: float
+    status: Literal['success']
+
+class ClientDisconnected(Exception):
+    pass
+
+async def run_until_disconnected(http_request: Request, coro, poll_interval: float = 0.2):
+    """Выполняет coro, отменяя его, если клиент закрыл соединение: незачем держать LLM и ClickHouse ради ушедшего клиента."""
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
 @router.post('/query', response_model=QueryResponse,
-             responses={400: {'model': ErrorResponse}, 500: {'model': ErrorResponse}})
-async def rag_query(request: QueryRequest):
+             responses={400: {'model': ErrorResponse}, 500: {'model': ErrorResponse},
+                        503: {'model': ErrorResponse}, 504: {'model': ErrorResponse}})
+async def rag_query(request: QueryRequest, http_request: Request):
     request_id = str(uuid.uuid4())
     start = time.perf_counter()
 
@@ -46,7 +102,8 @@ async def rag_query(request: QueryRequest):
         elif query_text.lower().startswith("llm_error"):
             raise LLMError("LLM request failed")
 
-        result = rag_pipeline(query_text)
+        filters = request.filters.to_dict() if request.filters else None
+        result = await run_until_disconnected(http_request, rag_pipeline_async(query_text, filters=filters))
         latency = round(time.perf_counter() - start, 3)
 
         logger.info("[%s] query='%s' latency=%.3f", request_id, query_text[:80], latency)
@@ -66,6 +123,27 @@ async def rag_query(request: QueryRequest):
         REQUESTS_TOTAL.labels(status='error').inc()
         return JSONResponse(status_code=400, content={"status": "error", "message": str(e), "latency": latency})
 
+    except StageTimeoutError as e:
+        latency = round(time.perf_counter() - start, 3)
+        ERRORS_TOTAL.labels(type='timeout').inc()
+        REQUESTS_TOTAL.labels(status='error').inc()
+        logger.warning("[%s] %s", request_id, str(e))
+        return JSONResponse(status_code=504, content={"status": "error", "message": f"{e.stage} timeout", "latency": latency})
+
+    except ClientDisconnected:
+        latency = round(time.perf_counter() - start, 3)
+        ERRORS_TOTAL.labels(type='cancelled').inc()
+        REQUESTS_TOTAL.labels(status='error').inc()
+        logger.info("[%s] client disconnected after %.3fs, pipeline cancelled", request_id, latency)
+        return JSONResponse(status_code=499, content={"status": "error", "message": "Client disconnected", "latency": latency})
+
+    except LLMUnavailableError as e:
+        latency = round(time.perf_counter() - start, 3)
+        ERRORS_TOTAL.labels(type='llm_unavailable').inc()
+        REQUESTS_TOTAL.labels(status='error').inc()
+        return JSONResponse(status_code=503, headers={"Retry-After": str(max(1, round(e.retry_after)))},
+                            content={"status": "error", "message": "LLM unavailable", "latency": latency})
+
     except LLMError as e:
         latency = round(time.perf_counter() - start, 3)
         ERRORS_TOTAL.labels(type='llm_error').inc()
@@ -83,4 +161,176 @@ async def rag_query(request: QueryRequest):
         ERRORS_TOTAL.labels(type="internal").inc()
         REQUESTS_TOTAL.labels(status="error").inc()
         logger.exception("[%s] internal error: %s", request_id, str(e))
-        return JSONResponse(status_code=500, content={"status": "error", "message": "Internal server error", "latency": latency})
\ No newline at end of file
+        return JSONResponse(status_code=500, content={"status": "error", "message": "Internal server error", "latency": latency})
+
+async def answer_batch(queries: List[str], top_k: int, generate: bool,
+                       filters: Optional[dict] = None) -> List[QueryBatchItem]:
+    """
+    Пачка запросов: один проход модели эмбеддингов, один поиск на все запросы,
+    затем генерация с не более чем RAG_BATCH_CONCURRENCY одновременными обращениями к LLM.
+    Ошибка генерации одного запроса попадает в его error и не валит остальные.
+    """
+    retrieved = await retrieve_many_async(queries, top_k=top_k, filters=filters)
+    semaphore = asyncio.Semaphore(RAG_BATCH_CONCURRENCY)
+
+    async def answer_one(query: str, found: list) -> QueryBatchItem:
+        item = QueryBatchItem(query=query, sources=[str(r["id"]) for r in found])
+        if not generate:
+            return item
+        if not found:
+            item.answer = "Sorry, I didn't find relevant documents."
+            return item
+        async with semaphore:
+            try:
+                item.answer = await generate_answer_async(await build_prompt_async(query, found))
+            except StageTimeoutError as e:
+                ERRORS_TOTAL.labels(type='timeout').inc()
+                item.error = f"{e.stage} timeout"
+            except LLMUnavailableError:
+                ERRORS_TOTAL.labels(type='llm_unavailable').inc()
+                item.error = "LLM unavailable"
+            except LLMError:
+                ERRORS_TOTAL.labels(type='llm_error').inc()
+                item.error = "LLM error"
+        return item
+
+    return list(await asyncio.gather(*(answer_one(q, found) for q, found in zip(queries, retrieved))))
+
+@router.post('/query_batch', response_model=QueryBatchResponse,
+             responses={400: {'model': ErrorResponse}, 500: {'model': ErrorResponse}, 504: {'model': ErrorResponse}})
+async def rag_query_batch(request: QueryBatchRequest, http_request: Request):
+    """
+    Пакетный вариант /query для оценки и фоновых задач: результаты в порядке запросов.
+    generate=false — только поиск, без обращения к LLM.
+    """
+    request_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    queries = [q.strip() for q in request.queries]
+
+    def error(status_code: int, message: str, error_type: str):
+        ERRORS_TOTAL.labels(type=error_type).inc()
+        REQUESTS_TOTAL.labels(status='error').inc()
+        latency = round(time.perf_counter() - start, 3)
+        return JSONResponse(status_code=status_code, content={"status": "error", "message": message, "latency": latency})
+
+    if not queries:
+        return error(400, "Queries cannot be empty", 'validation')
+    if len(queries) > RAG_BATCH_MAX:
+        return error(400, f"Too many queries: {len(queries)} > {RAG_BATCH_MAX}", 'validation')
+    if not all(queries):
+        return error(400, "Query cannot be empty", 'validation')
+    if request.top_k < 1:
+        return error(400, "top_k must be positive", 'validation')
+
+    try:
+        results = await run_until_disconnected(http_request, answer_batch(
+            queries, request.top_k, request.generate, request.filters.to_dict() if request.filters else None,
+        ))
+    except StageTimeoutError as e:
+        logger.warning("[%s] %s", request_id, str(e))
+        return error(504, f"{e.stage} timeout", 'timeout')
+    except ClientDisconnected:
+        logger.info("[%s] client disconnected, batch of %d cancelled", request_id, len(queries))
+        return error(499, "Client disconnected", 'cancelled')
+    except Exception as e:
+        logger.exception("[%s] batch error: %s", request_id, str(e))
+        return error(500, "Internal server error", 'internal')
+
+    elapsed = time.perf_counter() - start
+    latency = round(elapsed, 3)
+    logger.info("[%s] batch of %d queries latency=%.3f", request_id, len(queries), latency)
+    REQUESTS_TOTAL.labels(status='success').inc()
+    LATENCY_SECONDS.labels(endpoint='/query_batch').observe(latency)
+
+    return QueryBatchResponse(
+        results = results,
+        latency = latency,
+        queries_per_sec = round(len(queries) / elapsed, 2) if elapsed else 0.0,
+        status = 'success'
+    )
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post('/query_stream', responses={400: {'model': ErrorResponse}})
+async def rag_query_stream(request: QueryRequest):
+    """
+    Потоковый вариант /query (text/event-stream):
+    event: sources — id найденных документов сразу после поиска,
+    event: token — куски ответа по мере генерации,
+    event: done — итог с latency, ttft и tokens_per_sec; event: error — ошибка посреди потока.
+    """
+    request_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    query_text = request.query.strip()
+    if not query_text:
+        ERRORS_TOTAL.labels(type='validation').inc()
+        REQUESTS_TOTAL.labels(status='error').inc()
+        return JSONResponse(status_code=400, content={"status": "error", "message": "Query cannot be empty", "latency": 0.0})
+
+    async def events():
+        try:
+            retrieved = await retrieve_async(query_text, filters=request.filters.to_dict() if request.filters else None)
+        except StageTimeoutError as e:
+            ERRORS_TOTAL.labels(type='timeout').inc()
+            REQUESTS_TOTAL.labels(status='error').inc()
+            yield sse("error", {"message": f"{e.stage} timeout"})
+            return
+        except Exception as e:
+            ERRORS_TOTAL.labels(type="db_error").inc()
+            REQUESTS_TOTAL.labels(status="error").inc()
+            logger.exception("[%s] retrieval error: %s", request_id, str(e))
+            yield sse("error", {"message": "DB error"})
+            return
+
+        yield sse("sources", {"sources": [str(r["id"]) for r in retrieved]})
+        if not retrieved:
+            yield sse("token", {"text": "Sorry, I didn't find relevant documents."})
+            yield sse("done", {"latency": round(time.perf_counter() - start, 3), "tokens": 0})
+            REQUESTS_TOTAL.labels(status='success').inc()
+            return
+
+        tokens, first_token_at = 0, None
+        try:
+            # при отключении клиента StreamingResponse отменяет генератор, а с ним и запрос к LLM
+            async for text in stream_answer_async(await build_prompt_async(query_text, retrieved)):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    LLM_TTFT_SECONDS.labels(endpoint='/query_stream').observe(first_token_at - start)
+                tokens += 1
+                yield sse("token", {"text": text})
+        except StageTimeoutError as e:
+            ERRORS_TOTAL.labels(type='timeout').inc()
+            REQUESTS_TOTAL.labels(status='error').inc()
+            yield sse("error", {"message": f"{e.stage} timeout"})
+            return
+        except LLMUnavailableError as e:
+            ERRORS_TOTAL.labels(type='llm_unavailable').inc()
+            REQUESTS_TOTAL.labels(status='error').inc()
+            yield sse("error", {"message": "LLM unavailable", "retry_after": round(e.retry_after, 1)})
+            return
+        except Exception as e:
+            ERRORS_TOTAL.labels(type='llm_error').inc()
+            REQUESTS_TOTAL.labels(status='error').inc()
+            logger.exception("[%s] LLM stream error: %s", request_id, str(e))
+            yield sse("error", {"message": "LLM error"})
+            return
+
+        end = time.perf_counter()
+        latency = round(end - start, 3)
+        # куски потока TGI/OpenAI-совместимых серверов — по одному токену
+        tokens_per_sec = tokens / (end - first_token_at) if first_token_at and end > first_token_at else 0.0
+        if tokens_per_sec:
+            LLM_TOKENS_PER_SECOND.labels(endpoint='/query_stream').observe(tokens_per_sec)
+        LATENCY_SECONDS.labels(endpoint='/query_stream').observe(latency)
+        REQUESTS_TOTAL.labels(status='success').inc()
+        logger.info("[%s] stream query='%s' latency=%.3f tokens=%d", request_id, query_text[:80], latency, tokens)
+        yield sse("done", {
+            "latency": latency,
+            "ttft": round(first_token_at - start, 3) if first_token_at else None,
+            "tokens": tokens,
+            "tokens_per_sec": round(tokens_per_sec, 1),
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
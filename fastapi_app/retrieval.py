@@ -0,0 +1,336 @@
+import asyncio
+import re
+from typing import Generator, Optional
+
+import numpy as np
+
+from embeddings.quantization import quantize_binary, quantize_int8
+from fastapi_app.ann_index import ann_manager
+from fastapi_app.config import SEARCH_MODE, RERANK_CANDIDATES, HYBRID_MAX_TERMS, HYBRID_RRF_K
+from fastapi_app.db import get_client, get_async_client
+
+ANN_TEXTS_SQL = "SELECT id, text FROM embeddings WHERE id IN {ids:Array(UUID)}"
+
+# повторов поиска по индексу, если часть найденных id уже удалена из ClickHouse
+ANN_STALE_RETRIES = 3
+
+def ann_texts(result) -> dict:
+    return {str(row[0]): row[1] for row in result.result_rows}
+
+def ann_results(hits: list, texts: dict) -> list:
+    return [
+        {"id": i, "text": texts[i], "distance": d}
+        for i, d in hits if i in texts
+    ]
+
+def drop_stale(hits: list, texts: dict) -> bool:
+    """
+    id из индекса, которых нет в ClickHouse (строки удалены etl.sync или другим процессом), убираются из индекса.
+    True — что-то убрали, поиск стоит повторить, чтобы вернуть полный top_k.
+    """
+    stale = [i for i, _ in hits if i not in texts]
+    if stale:
+        ann_manager.remove(stale)
+    return bool(stale)
+
+def search_ann(client, query_vector: np.ndarray, top_k: int = 5) -> Optional[list]:
+    """
+    Поиск через in-process ANN-индекс: id берём из индекса, тексты — точечным запросом в ClickHouse.
+    Возвращает None, если индекс не собран.
+    """
+    for _ in range(ANN_STALE_RETRIES):
+        hits = ann_manager.search(query_vector, top_k)
+        if hits is None:
+            return None
+        if not hits:
+            return []
+        texts = ann_texts(client.query(ANN_TEXTS_SQL, parameters={"ids": [i for i, _ in hits]}))
+        if not drop_stale(hits, texts):
+            break
+    return ann_results(hits, texts)
+
+PREFILTER_DISTANCES = {
+    # дешёвое расстояние по квантованной колонке и тип параметра запроса
+    "int8": ("cosineDistance(vector_i8, {prefilter_vector:Array(Int8)})", quantize_int8),
+    "binary": (
+        "arraySum(arrayMap((a, b) -> bitHammingDistance(a, b), vector_bin, {prefilter_vector:Array(UInt64)}))",
+        quantize_binary,
+    ),
+}
+
+# фильтры по метаданным -> MATERIALIZED-колонки: format — ключ партиции и сортировки, source_file — второй ключ
+# сортировки и skip-индекс source_file_idx
+FILTER_COLUMNS = ("source_file", "format")
+
+def filter_clause(filters: Optional[dict]) -> tuple[str, dict]:
+    """
+    filters: {"source_file": str | list[str], "format": str | list[str]} -> (условие для WHERE, параметры).
+    Условие стоит до расчёта расстояний, поэтому ClickHouse читает только подходящие партиции и гранулы.
+    """
+    if not filters:
+        return "", {}
+    unknown = set(filters) - set(FILTER_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown metadata filters: {sorted(unknown)}")
+    conditions, parameters = [], {}
+    for column in FILTER_COLUMNS:
+        values = filters.get(column)
+        if values is None:
+            continue
+        conditions.append(f"{column} IN {{filter_{column}:Array(String)}}")
+        parameters[f"filter_{column}"] = [values] if isinstance(values, str) else list(values)
+    return " AND ".join(conditions), parameters
+
+def filters_key(filters: Optional[dict]) -> tuple:
+    """Каноническая hashable-форма filters для ключей кэша и single-flight."""
+    if not filters:
+        return ()
+    return tuple(
+        (column, tuple(sorted([v] if isinstance(v, str) else v)))
+        for column, v in sorted(filters.items()) if v is not None
+    )
+
+def search_query(query_vector: np.ndarray, top_k: int, mode: str, candidates: int,
+                 filters: Optional[dict] = None) -> tuple[str, dict]:
+    """SQL и параметры поиска для режима mode; filters сужают таблицу до расчёта расстояний."""
+    condition, filter_parameters = filter_clause(filters)
+    where = f"WHERE {condition}" if condition else ""
+    # вектор уходит типизированным параметром, а не литералом в тексте SQL
+    parameters = {"query_vector": query_vector.tolist(), "top_k": top_k, **filter_parameters}
+    if mode == "exact":
+        sql = f'''
+            SELECT
+                id, text, cosineDistance(vector, {{query_vector:Array(Float32)}}) AS distance
+            FROM
+                embeddings
+            {where}
+            ORDER BY distance ASC
+            LIMIT {{top_k:UInt32}}
+        '''
+    elif mode in PREFILTER_DISTANCES:
+        prefilter_distance, quantize = PREFILTER_DISTANCES[mode]
+        parameters["prefilter_vector"] = quantize(query_vector)[0].tolist()
+        parameters["candidates"] = max(candidates, top_k)
+        sql = f'''
+            SELECT
+                id, text, cosineDistance(vector, {{query_vector:Array(Float32)}}) AS distance
+            FROM
+                embeddings
+            WHERE id IN (
+                SELECT id FROM embeddings
+                {where}
+                ORDER BY {prefilter_distance} ASC
+                LIMIT {{candidates:UInt32}}
+            ) {f"AND {condition}" if condition else ""}
+            ORDER BY distance ASC
+            LIMIT {{top_k:UInt32}}
+        '''
+    else:
+        raise ValueError(f"Unknown search mode: {mode}")
+    return sql, parameters
+
+def rows_to_dicts(result) -> list[dict]:
+    return [dict(zip(result.column_names, row)) for row in result.result_rows]
+
+# токены как у tokenbf_v1 / hasToken: непрерывные ASCII-буквы и цифры, байты вне ASCII считаются частью токена
+LEXICAL_TOKEN = re.compile(r"[0-9a-z\u0080-\U0010ffff]+")
+
+def lexical_terms(text: str, max_terms: int = HYBRID_MAX_TERMS) -> list[str]:
+    """Уникальные токены запроса в нижнем регистре; однобуквенные не несут смысла и не фильтруют гранулы."""
+    terms = []
+    for token in LEXICAL_TOKEN.findall(text.lower()):
+        if len(token) > 1 and token not in terms:
+            terms.append(token)
+    return terms[:max_terms]
+
+def hybrid_query(query_text: str, query_vector: np.ndarray, candidates: int,
+                 filters: Optional[dict] = None) -> Optional[tuple[str, dict]]:
+    """
+    Лексический отбор кандидатов: строки, где lowerUTF8(text) содержит хотя бы один токен запроса
+    (hasToken по skip-индексу text_tokens_idx отсекает гранулы без токенов), cosine считается только по ним.
+    None, если в запросе нет пригодных токенов.
+    """
+    terms = lexical_terms(query_text)
+    if not terms:
+        return None
+    condition, parameters = filter_clause(filters)
+    matches = [f"hasToken(lowerUTF8(text), {{term_{i}:String}})" for i in range(len(terms))]
+    parameters.update({f"term_{i}": term for i, term in enumerate(terms)})
+    parameters.update({"query_vector": query_vector.tolist(), "candidates": candidates})
+    sql = f'''
+        SELECT
+            id, text,
+            cosineDistance(vector, {{query_vector:Array(Float32)}}) AS distance,
+            {" + ".join(matches)} AS lexical_hits
+        FROM
+            embeddings
+        WHERE ({" OR ".join(matches)}) {f"AND {condition}" if condition else ""}
+        ORDER BY lexical_hits DESC, distance ASC
+        LIMIT {{candidates:UInt32}}
+    '''
+    return sql, parameters
+
+def rrf_fuse(lexical: list[dict], vector: list[dict], top_k: int, k: int = HYBRID_RRF_K) -> list[dict]:
+    """
+    Reciprocal rank fusion: score = 1/(k + ранг по совпадениям токенов) + 1/(k + ранг по cosine).
+    lexical — кандидаты в лексическом порядке; vector — добор векторным поиском (у них нет лексического ранга).
+    """
+    pool = {str(r["id"]): dict(r) for r in vector}
+    pool.update({str(r["id"]): dict(r) for r in lexical})
+    scores = dict.fromkeys(pool, 0.0)
+    for rank, row in enumerate(lexical, start=1):
+        scores[str(row["id"])] += 1.0 / (k + rank)
+    for rank, row in enumerate(sorted(pool.values(), key=lambda r: r["distance"]), start=1):
+        scores[str(row["id"])] += 1.0 / (k + rank)
+    fused = sorted(pool.values(), key=lambda r: scores[str(r["id"])], reverse=True)[:top_k]
+    for row in fused:
+        row.pop("lexical_hits", None)
+        row["score"] = round(scores[str(row["id"])], 6)
+    return fused
+
+HybridPlan = Generator[tuple[str, dict], list[dict], list[dict]]
+
+def hybrid_plan(query_text: str, query_vector: np.ndarray, top_k: int, candidates: int,
+                filters: Optional[dict] = None) -> HybridPlan:
+    """
+    Шаги гибридного поиска без ввода-вывода, общие для синхронного и асинхронного клиента:
+    yield (sql, parameters) — выполнить запрос и отправить в генератор его строки (rows_to_dicts),
+    возврат — результат RRF. Выполняют run_hybrid / run_hybrid_async.
+    """
+    query = hybrid_query(query_text, query_vector, max(candidates, top_k), filters)
+    lexical = []
+    if query is not None:
+        lexical = yield query
+    vector = []
+    if len(lexical) < top_k:
+        # токены запроса почти не встречаются — добираем векторным поиском, чтобы не вернуть меньше top_k
+        vector = yield search_query(query_vector, top_k, "exact", candidates, filters)
+    return rrf_fuse(lexical, vector, top_k)
+
+def run_hybrid(client, plan: HybridPlan) -> list[dict]:
+    try:
+        sql, parameters = next(plan)
+        while True:
+            sql, parameters = plan.send(rows_to_dicts(client.query(sql, parameters=parameters)))
+    except StopIteration as done:
+        return done.value
+
+async def run_hybrid_async(client, plan: HybridPlan) -> list[dict]:
+    try:
+        sql, parameters = next(plan)
+        while True:
+            sql, parameters = plan.send(rows_to_dicts(await client.query(sql, parameters=parameters)))
+    except StopIteration as done:
+        return done.value
+
+def search_in_clickhouse(query_vector: np.ndarray, top_k: int = 5, mode: str = SEARCH_MODE,
+                         candidates: int = RERANK_CANDIDATES, filters: Optional[dict] = None,
+                         query_text: Optional[str] = None):
+    """
+    mode: exact — полный скан по vector;
+          int8 / binary — отбор candidates строк по квантованной колонке и точный cosine только по ним;
+          hybrid — отбор до candidates строк по токенам query_text и слияние рангов (RRF) с cosine.
+    filters: {"source_file": ..., "format": ...} — поиск только по подходящим строкам (см. filter_clause).
+    """
+    client = get_client()
+
+    if mode == "hybrid":
+        if query_text:
+            return run_hybrid(client, hybrid_plan(query_text, query_vector, top_k, candidates, filters))
+        mode = "exact"
+
+    # ANN-индекс, если включён, заменяет полный скан в точном режиме; метаданных в индексе нет, поэтому
+    # фильтрованные запросы идут в ClickHouse
+    if mode == "exact" and ann_manager.enabled and not filters:
+        found = search_ann(client, query_vector, top_k)
+        if found is not None:
+            return found
+
+    sql, parameters = search_query(query_vector, top_k, mode, candidates, filters)
+    return rows_to_dicts(client.query(sql, parameters=parameters))
+
+async def search_in_clickhouse_async(query_vector: np.ndarray, top_k: int = 5, mode: str = SEARCH_MODE,
+                                     candidates: int = RERANK_CANDIDATES, filters: Optional[dict] = None,
+                                     query_text: Optional[str] = None):
+    """search_in_clickhouse через асинхронный клиент: ожидание ClickHouse не держит event loop."""
+    client = await get_async_client()
+
+    if mode == "hybrid":
+        if query_text:
+            return await run_hybrid_async(client, hybrid_plan(query_text, query_vector, top_k, candidates, filters))
+        mode = "exact"
+
+    if mode == "exact" and ann_manager.enabled and not filters:
+        for _ in range(ANN_STALE_RETRIES):
+            hits = await asyncio.to_thread(ann_manager.search, query_vector, top_k)
+            if not hits:
+                break
+            texts = ann_texts(await client.query(ANN_TEXTS_SQL, parameters={"ids": [i for i, _ in hits]}))
+            if not drop_stale(hits, texts):
+                break
+        if hits is not None:
+            return ann_results(hits, texts) if hits else []
+
+    sql, parameters = search_query(query_vector, top_k, mode, candidates, filters)
+    return rows_to_dicts(await client.query(sql, parameters=parameters))
+
+# шаблон: {where} — условие filter_clause, остальные параметры — типизированные параметры ClickHouse.
+# Только (запрос, id, distance): text читается вторым запросом ANN_TEXTS_SQL по найденным id, а не join-ом,
+# у которого вся таблица с колонкой text оказалась бы левой стороной.
+BATCH_SEARCH_SQL = """
+    SELECT toUInt32(qi - 1) AS query_index, toString(hit.2) AS id, hit.1 AS distance
+    FROM (
+        SELECT
+            qi,
+            groupArraySorted({{top_k:UInt32}})(
+                (cosineDistance(vector, arrayElement({{queries:Array(Array(Float32))}}, qi)), id)
+            ) AS top
+        FROM embeddings
+        ARRAY JOIN arrayEnumerate({{queries:Array(Array(Float32))}}) AS qi
+        {where}
+        GROUP BY qi
+    )
+    ARRAY JOIN top AS hit
+    ORDER BY query_index, distance
+"""
+
+async def search_many_async(query_vectors: np.ndarray, top_k: int = 5,
+                            filters: Optional[dict] = None) -> list[list[dict]]:
+    """
+    Точный top_k для пачки запросов за один проход по ClickHouse: строки размножаются по запросам (ARRAY JOIN),
+    groupArraySorted держит k ближайших на запрос; тексты — вторым точечным запросом только для найденных id.
+    При включённом ANN и без filters — один проход search_many по индексу и один запрос за текстами.
+    """
+    client = await get_async_client()
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    results = [[] for _ in range(len(query_vectors))]
+    if not len(query_vectors):
+        return results
+
+    if ann_manager.enabled and not filters:
+        for _ in range(ANN_STALE_RETRIES):
+            hits = await asyncio.to_thread(ann_manager.search_many, query_vectors, top_k)
+            if hits is None:
+                break
+            ids = sorted({i for per_query in hits for i, _ in per_query})
+            if not ids:
+                return results
+            texts = ann_texts(await client.query(ANN_TEXTS_SQL, parameters={"ids": ids}))
+            if not drop_stale([(i, None) for i in ids], texts):
+                break
+        if hits is not None:
+            return [ann_results(per_query, texts) for per_query in hits]
+
+    condition, filter_parameters = filter_clause(filters)
+    result = await client.query(
+        BATCH_SEARCH_SQL.format(where=f"WHERE {condition}" if condition else ""),
+        parameters={"queries": query_vectors.tolist(), "top_k": top_k, **filter_parameters},
+    )
+    hits = result.result_rows
+    if not hits:
+        return results
+    texts = ann_texts(await client.query(ANN_TEXTS_SQL, parameters={"ids": sorted({row[1] for row in hits})}))
+    for query_index, hit_id, distance in hits:
+        if hit_id in texts:
+            results[query_index].append({"id": hit_id, "text": texts[hit_id], "distance": distance})
+    return results
\ No newline at end of file
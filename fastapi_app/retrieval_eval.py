@@ -0,0 +1,182 @@
+"""
+Проверка качества приближённого поиска против точного ORDER BY cosineDistance.
+
+    python -m fastapi_app.retrieval_eval --mode ann --queries 100 --top-k 10
+    python -m fastapi_app.retrieval_eval --mode binary --candidates 200
+
+Гибридный поиск сравнивается с точным по релевантности: запрос — случайный фрагмент чанка,
+релевантен сам чанк; считаются hit@k, MRR, задержка и прочитанные ClickHouse строки.
+
+    python -m fastapi_app.retrieval_eval --mode hybrid --queries 200 --query-words 8
+"""
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+from embeddings.registry import registry
+from fastapi_app.ann_index import ann_manager
+from fastapi_app.config import EMBED_MODEL_NAME
+from fastapi_app.db import get_client
+from fastapi_app.retrieval import hybrid_plan, rows_to_dicts, search_in_clickhouse, search_query
+
+logger = logging.getLogger(__name__)
+
+
+def sample_query_vectors(client, n: int) -> np.ndarray:
+    result = client.query(f"SELECT vector FROM embeddings ORDER BY rand() LIMIT {int(n)}")
+    return np.asarray([row[0] for row in result.result_rows], dtype=np.float32)
+
+
+def exact_search(client, query_vector: np.ndarray, top_k: int) -> list[str]:
+    result = client.query(
+        """
+        SELECT toString(id) FROM embeddings
+        ORDER BY cosineDistance(vector, {q:Array(Float32)}) ASC
+        LIMIT {k:UInt32}
+        """,
+        parameters={"q": query_vector.tolist(), "k": top_k},
+    )
+    return [row[0] for row in result.result_rows]
+
+
+def recall_at_k(found: list[str], expected: list[str]) -> float:
+    if not expected:
+        return 1.0
+    return len(set(found) & set(expected)) / len(expected)
+
+
+def evaluate(search_fn, client, queries: np.ndarray, top_k: int) -> dict:
+    """search_fn(query_vector, top_k) -> list[str] id; сравнивается с точным поиском в ClickHouse."""
+    recalls, latencies, exact_latencies = [], [], []
+    for q in queries:
+        start = time.perf_counter()
+        expected = exact_search(client, q, top_k)
+        exact_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        found = search_fn(q, top_k)
+        latencies.append(time.perf_counter() - start)
+
+        recalls.append(recall_at_k(found, expected))
+
+    return {
+        "queries": len(queries),
+        "top_k": top_k,
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies else 0.0,
+        "latency_p95_ms": float(np.percentile(latencies, 95) * 1000) if latencies else 0.0,
+        "exact_latency_p50_ms": float(np.percentile(exact_latencies, 50) * 1000) if exact_latencies else 0.0,
+    }
+
+
+def ann_search_ids(query_vector: np.ndarray, top_k: int) -> list[str]:
+    return [i for i, _ in ann_manager.search(query_vector, top_k) or []]
+
+
+def quantized_search_ids(mode: str, candidates: int):
+    def search(query_vector: np.ndarray, top_k: int) -> list[str]:
+        found = search_in_clickhouse(query_vector, top_k, mode=mode, candidates=candidates)
+        return [str(r["id"]) for r in found]
+    return search
+
+
+def sample_text_queries(client, n: int, words: int, seed: int = 0) -> list[tuple[str, str]]:
+    """[(id чанка, запрос)]: запрос — случайное окно из words слов текста чанка."""
+    rng = random.Random(seed)
+    result = client.query(
+        f"SELECT toString(id), text FROM embeddings WHERE length(text) > 0 ORDER BY rand({int(seed)}) LIMIT {int(n)}"
+    )
+    queries = []
+    for chunk_id, text in result.result_rows:
+        tokens = text.split()
+        start = rng.randrange(max(1, len(tokens) - words + 1))
+        queries.append((chunk_id, " ".join(tokens[start:start + words])))
+    return queries
+
+
+def read_rows(result) -> int:
+    return int(result.summary.get("read_rows", 0) or 0)
+
+
+def exact_ranked(client, query_text: str, query_vector: np.ndarray, top_k: int, candidates: int) -> tuple[list[str], int]:
+    sql, parameters = search_query(query_vector, top_k, "exact", candidates)
+    result = client.query(sql, parameters=parameters)
+    return [str(r["id"]) for r in rows_to_dicts(result)], read_rows(result)
+
+
+def hybrid_ranked(client, query_text: str, query_vector: np.ndarray, top_k: int, candidates: int) -> tuple[list[str], int]:
+    """retrieval.run_hybrid с подсчётом прочитанных строк, включая добор векторным поиском."""
+    plan, rows = hybrid_plan(query_text, query_vector, top_k, candidates), 0
+    try:
+        sql, parameters = next(plan)
+        while True:
+            result = client.query(sql, parameters=parameters)
+            rows += read_rows(result)
+            sql, parameters = plan.send(rows_to_dicts(result))
+    except StopIteration as done:
+        return [str(r["id"]) for r in done.value], rows
+
+
+def evaluate_relevance(search_fn, client, queries: list[tuple[str, str]], vectors: np.ndarray,
+                       top_k: int, candidates: int) -> dict:
+    """search_fn(client, текст, вектор, top_k, candidates) -> (id по рангу, прочитано строк)."""
+    hits, reciprocal_ranks, latencies, scanned = [], [], [], []
+    for (expected, text), vector in zip(queries, vectors):
+        start = time.perf_counter()
+        found, rows = search_fn(client, text, vector, top_k, candidates)
+        latencies.append(time.perf_counter() - start)
+        scanned.append(rows)
+        rank = found.index(expected) + 1 if expected in found else 0
+        hits.append(1.0 if rank else 0.0)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+    return {
+        "queries": len(queries),
+        "top_k": top_k,
+        "hit_at_k": float(np.mean(hits)) if hits else 0.0,
+        "mrr": float(np.mean(reciprocal_ranks)) if reciprocal_ranks else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies else 0.0,
+        "latency_p95_ms": float(np.percentile(latencies, 95) * 1000) if latencies else 0.0,
+        "read_rows_mean": float(np.mean(scanned)) if scanned else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall приближённого поиска относительно точного")
+    parser.add_argument("--mode", default="ann", choices=["ann", "int8", "binary", "hybrid"])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=100, help="размер отбора для int8/binary/hybrid")
+    parser.add_argument("--query-words", type=int, default=8, help="слов в запросе для hybrid")
+    args = parser.parse_args()
+
+    client = get_client()
+    if args.mode == "hybrid":
+        text_queries = sample_text_queries(client, args.queries, args.query_words)
+        vectors = registry.get(EMBED_MODEL_NAME).encode(
+            [text for _, text in text_queries], normalize_embeddings=True, convert_to_numpy=True,
+        )
+        for name, search_fn in (("exact", exact_ranked), ("hybrid", hybrid_ranked)):
+            report = evaluate_relevance(search_fn, client, text_queries, vectors, args.top_k, args.candidates)
+            logger.info(f"[EVAL] {name} (candidates={args.candidates}): {report}")
+        return
+
+    queries = sample_query_vectors(client, args.queries)
+
+    if args.mode == "ann":
+        ann_manager.init(client)
+        if ann_manager.index is None:
+            raise SystemExit("ANN-индекс не собран: проверь ANN_BACKEND и наличие данных в embeddings")
+        report = evaluate(ann_search_ids, client, queries, args.top_k)
+        logger.info(f"[EVAL] ann ({ann_manager.backend}): {report}")
+    else:
+        report = evaluate(quantized_search_ids(args.mode, args.candidates), client, queries, args.top_k)
+        logger.info(f"[EVAL] {args.mode} (candidates={args.candidates}): {report}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    main()
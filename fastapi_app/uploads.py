@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from fastapi_app import config
+from fastapi_app.errors.exceptions import ValidationError
+
+SESSION_FILE = "session.json"
+DATA_FILE = "data"
+CHUNKS_DIR = "chunks"
+# загрузки лежат в UPLOAD_RAW_DIR под уникальным именем <uuid hex>_<исходное имя>
+UPLOAD_PREFIX = re.compile(r"^[0-9a-f]{32}_")
+
+
+def raw_upload_path(filename: str) -> Path:
+    """
+    Путь в UPLOAD_RAW_DIR для загруженного файла. Одноимённые загрузки (в одном запросе или параллельных)
+    не пишут в один файл и не удаляют его друг у друга по завершении задачи. Каталог отделён от RAW_DIR:
+    etl.sync не должен принять временный файл за свой и потом удалить его строки как строки удалённого файла.
+    """
+    name = Path(filename).name
+    suffix = Path(name).suffix.lower().lstrip(".")
+    return config.UPLOAD_RAW_DIR / suffix / f"{uuid.uuid4().hex}_{name}"
+
+
+def original_filename(path: Path) -> str:
+    """Имя файла, с которым его загрузили (без префикса raw_upload_path)."""
+    return UPLOAD_PREFIX.sub("", path.name)
+
+
+class UploadSession:
+    """
+    Сессия chunked upload: части пишутся сразу в предвыделенный файл по смещению chunk_index * chunk_size,
+    поэтому их можно слать параллельно и в любом порядке. Для каждой принятой части рядом лежит маркер
+    с размером и sha256 — по ним видно, что уже получено, и загрузку можно продолжить после обрыва.
+    """
+
+    def __init__(self, file_id: str, root: Path = config.UPLOAD_TMP_DIR):
+        if not file_id or Path(file_id).name != file_id:
+            raise ValidationError(f"Invalid file_id: {file_id!r}")
+        self.file_id = file_id
+        self.dir = root / file_id
+        self.data_path = self.dir / DATA_FILE
+        self.chunks_dir = self.dir / CHUNKS_DIR
+        self.chunk_size = config.UPLOAD_CHUNK_SIZE
+        self.total_size: Optional[int] = None
+        self.filename: Optional[str] = None
+
+    @property
+    def exists(self) -> bool:
+        return (self.dir / SESSION_FILE).exists()
+
+    def init(self, chunk_size: Optional[int] = None, total_size: Optional[int] = None,
+             filename: Optional[str] = None) -> "UploadSession":
+        """
+        Открывает сессию (или подхватывает существующую — повторный init безопасен).
+        Продолжение с другим chunk_size отклоняется: смещения уже принятых частей считались по старому размеру.
+        """
+        if self.exists:
+            return self.load().check_chunk_size(chunk_size)
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValidationError("chunk_size must be positive")
+        self.chunk_size = chunk_size or config.UPLOAD_CHUNK_SIZE
+        self.total_size = total_size
+        self.filename = filename
+        self.chunks_dir.mkdir(parents=True, exist_ok=True)
+
+        fd = os.open(self.data_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if total_size:
+                # место резервируется сразу: запись по смещениям не фрагментирует файл
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, total_size)
+                else:
+                    os.ftruncate(fd, total_size)
+        finally:
+            os.close(fd)
+
+        # параллельные первые части: сессию создаёт тот, кто успел, остальные её читают
+        tmp = self.dir / f"{SESSION_FILE}.{uuid.uuid4().hex}"
+        tmp.write_text(json.dumps(
+            {"chunk_size": self.chunk_size, "total_size": total_size, "filename": filename}
+        ))
+        try:
+            os.link(tmp, self.dir / SESSION_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink(missing_ok=True)
+        return self.load().check_chunk_size(chunk_size)
+
+    def check_chunk_size(self, chunk_size: Optional[int]) -> "UploadSession":
+        if chunk_size is not None and chunk_size != self.chunk_size:
+            raise ValidationError(
+                f"Upload {self.file_id} was started with chunk_size {self.chunk_size}, got {chunk_size}"
+            )
+        return self
+
+    def load(self) -> "UploadSession":
+        data = json.loads((self.dir / SESSION_FILE).read_text())
+        self.chunk_size = data["chunk_size"]
+        self.total_size = data.get("total_size")
+        self.filename = data.get("filename")
+        return self
+
+    def total_chunks(self) -> Optional[int]:
+        if self.total_size is None:
+            return None
+        return max(1, -(-self.total_size // self.chunk_size))
+
+    def open_chunk(self, chunk_index: int) -> "ChunkWriter":
+        if chunk_index < 0:
+            raise ValidationError("chunk_index must be non-negative")
+        total = self.total_chunks()
+        if total is not None and chunk_index >= total:
+            raise ValidationError(f"chunk_index {chunk_index} out of range (total {total})")
+        return ChunkWriter(self, chunk_index)
+
+    def received(self) -> dict[int, dict]:
+        chunks = {}
+        if self.chunks_dir.exists():
+            for marker in self.chunks_dir.iterdir():
+                if marker.suffix == ".json":
+                    chunks[int(marker.stem)] = json.loads(marker.read_text())
+        return dict(sorted(chunks.items()))
+
+    def missing(self, total_chunks: int) -> list[int]:
+        received = self.received()
+        return [i for i in range(total_chunks) if i not in received]
+
+    def finalize(self, final_path: Path, total_chunks: int) -> int:
+        """
+        Проверяет, что пришли все части и все, кроме последней, ровно по chunk_size (короткая часть в середине
+        оставила бы дыру из нулей), обрезает файл до фактического размера и переносит его в final_path.
+        На одной файловой системе это rename без копирования данных. Возвращает размер файла.
+        """
+        received = self.received()
+        missing = [i for i in range(total_chunks) if i not in received]
+        if missing:
+            raise ValidationError(f"Missing chunks: {missing[:20]}")
+        short = [i for i in range(total_chunks - 1) if received[i]["size"] != self.chunk_size]
+        if short:
+            raise ValidationError(f"Chunks shorter than chunk_size {self.chunk_size}: {short[:20]}")
+        size = max((i * self.chunk_size + c["size"] for i, c in received.items() if i < total_chunks), default=0)
+        if self.total_size is not None and size != self.total_size:
+            raise ValidationError(f"Received {size} bytes, expected {self.total_size}")
+
+        if not self.data_path.exists():
+            self.data_path.touch()
+        os.truncate(self.data_path, size)
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(self.data_path, final_path)
+        except OSError:
+            # tmp и raw на разных томах — остаётся копирование
+            shutil.move(self.data_path, final_path)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        return size
+
+    def status(self) -> dict:
+        received = self.received()
+        total = self.total_chunks()
+        return {
+            "file_id": self.file_id,
+            "chunk_size": self.chunk_size,
+            "total_size": self.total_size,
+            "total_chunks": total,
+            "received": [{"chunk_index": i, **c} for i, c in received.items()],
+            "missing": self.missing(total) if total is not None else None,
+        }
+
+
+class ChunkWriter:
+    """Пишет одну часть через pwrite по её смещению, попутно считая sha256."""
+
+    def __init__(self, session: UploadSession, chunk_index: int):
+        self.session = session
+        self.chunk_index = chunk_index
+        self.offset = chunk_index * session.chunk_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._fd = os.open(session.data_path, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def write(self, data: bytes):
+        if self.size + len(data) > self.session.chunk_size:
+            raise ValidationError(f"Chunk {self.chunk_index} exceeds chunk_size {self.session.chunk_size}")
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, self.offset + self.size)
+            self.size += written
+            view = view[written:]
+        self._hash.update(data)
+
+    def commit(self, checksum: Optional[str] = None) -> dict:
+        """Фиксирует часть: сверяет checksum (sha256 hex) и записывает маркер."""
+        self.close()
+        digest = self._hash.hexdigest()
+        if checksum and checksum.lower() != digest:
+            raise ValidationError(f"Checksum mismatch for chunk {self.chunk_index}")
+        marker = {"size": self.size, "sha256": digest}
+        path = self.session.chunks_dir / f"{self.chunk_index}.json"
+        tmp = path.with_name(f"{self.chunk_index}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(marker))
+        os.replace(tmp, path)
+        return marker
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None